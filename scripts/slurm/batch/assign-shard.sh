@@ -0,0 +1,23 @@
+#!/bin/bash
+
+#SBATCH --time=1:0:0
+#SBATCH --mem=32GB
+#SBATCH --cpus-per-task=1
+#SBATCH -o out/slurm/%j.out
+#SBATCH -e out/slurm/%j.err
+
+# required env vars:
+# SIF_FILE: sif file
+# FTR_FILE: input segmentation polygon feather file for the z slice
+# DT_FILE: input CSV detected transcripts file
+# Z_SLICE: z slice to assign transcripts for
+# DTF_FILE: output feather assigned transcripts file
+# AD_FILE: output partial cell/gene matrix file
+
+module load StdEnv/2023 apptainer
+
+set -euxo pipefail
+apptainer run \
+  -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --writable-tmpfs \
+  "${SIF_FILE}" \
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M assign -i '/bnd/${FTR_FILE}' -d '/bnd/${DT_FILE}' -z ${Z_SLICE} -f '/bnd/${DTF_FILE}' -a '/bnd/${AD_FILE}'"
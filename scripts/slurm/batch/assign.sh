@@ -20,4 +20,4 @@ set -euxo pipefail
 apptainer run \
   -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --writable-tmpfs \
   "${SIF_FILE}" \
-  bash -c "umat assign ${INP_FLAGS} -d '/bnd/${DT_FILE}' -f '/bnd/${DTF_FILE}' -a '/bnd/${AD_FILE}'"
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M assign ${INP_FLAGS} -d '/bnd/${DT_FILE}' -f '/bnd/${DTF_FILE}' -a '/bnd/${AD_FILE}'"
@@ -19,4 +19,4 @@ set -euxo pipefail
 apptainer run \
   -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --writable-tmpfs \
   "${SIF_FILE}" \
-  bash -c "umat boundary -i '/bnd/${NPY_PATH}' -o '/bnd/${OUT_PATH}' -m '/bnd/${MP_PATH}' -z ${Z_SLICE} -j ${SLURM_CPUS_ON_NODE}"
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M boundary -i '/bnd/${NPY_PATH}' -o '/bnd/${OUT_PATH}' -m '/bnd/${MP_PATH}' -z ${Z_SLICE} -j ${SLURM_CPUS_ON_NODE}"
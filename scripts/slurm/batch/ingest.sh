@@ -0,0 +1,19 @@
+#!/bin/bash
+
+#SBATCH --time=1:0:0
+#SBATCH --mem=16GB
+#SBATCH --cpus-per-task=1
+#SBATCH -o out/slurm/%j.out
+#SBATCH -e out/slurm/%j.err
+
+# required env vars:
+# SIF_FILE: sif file
+# DT_FILE: input CSV detected transcripts file
+
+module load StdEnv/2023 apptainer
+
+set -euxo pipefail
+apptainer run \
+  -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --writable-tmpfs \
+  "${SIF_FILE}" \
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M ingest -i '/bnd/${DT_FILE}'"
@@ -0,0 +1,21 @@
+#!/bin/bash
+
+#SBATCH --time=1:0:0
+#SBATCH --mem=16GB
+#SBATCH --cpus-per-task=1
+#SBATCH -o out/slurm/%j.out
+#SBATCH -e out/slurm/%j.err
+
+# required env vars:
+# SIF_FILE: sif file
+# PART_DIR: path containing all partial cell/gene matrix files generated by assign-shard.sh
+# AD_FILE: output cell/gene matrix matrix file
+
+module load StdEnv/2023 apptainer
+
+INP_FLAGS="$(find "${PART_DIR}" -type f -name '*.h5ad' -exec echo '-i '\''/bnd/{}'\''' \; | sort | tr '\n' ' ' | rg  ' $' -r '')"
+set -euxo pipefail
+apptainer run \
+  -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --writable-tmpfs \
+  "${SIF_FILE}" \
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M merge ${INP_FLAGS} -a '/bnd/${AD_FILE}'"
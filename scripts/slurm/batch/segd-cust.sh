@@ -19,4 +19,4 @@ set -euxo pipefail
 apptainer run \
   -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --nv --writable-tmpfs \
   "${SIF_FILE}" \
-  bash -c "umat segd -i '/bnd/${INP_PATH}/images/mosaic_{c}_z{z}.tif' -o '/bnd/${OUT_PATH}' -w '/bnd/${MD_PATH}' -c PolyT -n DAPI -b 128 -pt /tmpdir -lx 4096 -ly 4096 -lz 7 -z 0 -z 1 -z 2 -z 3 -z 4 -z 5 -z 6 -ts 0.25"
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M segd -i '/bnd/${INP_PATH}/images/mosaic_{c}_z{z}.tif' -o '/bnd/${OUT_PATH}' -w '/bnd/${MD_PATH}' -c PolyT -n DAPI -b 128 -pt /tmpdir -lx 4096 -ly 4096 -lz 7 -z 0 -z 1 -z 2 -z 3 -z 4 -z 5 -z 6 -ts 0.25 -u"
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+#SBATCH --time=4:0:0
+#SBATCH --mem=128GB
+#SBATCH --cpus-per-task=8
+#SBATCH -o out/slurm/%j.out
+#SBATCH -e out/slurm/%j.err
+
+# required env vars:
+# SIF_FILE: sif file
+# NPY_PATH: segmentation file path, made of blocks segmented by `umat segd -u` (relabelled in place)
+
+module load StdEnv/2023 apptainer
+
+set -euxo pipefail
+apptainer run \
+  -C -B $PWD:/bnd -B $SLURM_TMPDIR:/tmpdir --writable-tmpfs \
+  "${SIF_FILE}" \
+  bash -c "umat --max-memory ${SLURM_MEM_PER_NODE}M stitch -i '/bnd/${NPY_PATH}' -b 7 4096 4096 -j ${SLURM_CPUS_ON_NODE}"
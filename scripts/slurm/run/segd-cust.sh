@@ -8,15 +8,15 @@ SIF_FILE="${2}"
 INP_DIR="${3}"
 NPY_PATH="${4}"
 FTR_DIR="${5}"
-DTF_PATH="${6}"
+DTF_DIR="${6}"
 AD_PATH="${7}"
 IMG_DIR="${8}"
 CM_PATH="${9}"
 
 mkdir -p "$(dirname "${NPY_PATH}")"
 mkdir -p "${FTR_DIR}"
-mkdir -p "$(dirname "${DTF_PATH}")"
-mkdir -p "$(dirname "${AD_PATH}")"
+mkdir -p "${DTF_DIR}"
+mkdir -p "$(dirname "${AD_PATH}")/parts"
 mkdir -p "${IMG_DIR}"
 
 SEG_ID="$(sbatch --parsable --account="${ACCOUNT}" \
@@ -24,23 +24,45 @@ SEG_ID="$(sbatch --parsable --account="${ACCOUNT}" \
   batch/segd-cust.sh \
 )"
 
-BND_DEP_STR='afterok'
+# blocks are segmented independently (`umat segd -u`), cells crossing blocks are then merged on CPU
+STI_ID="$(sbatch --parsable --account="${ACCOUNT}" \
+  -d "afterok:${SEG_ID}" \
+  --export="SIF_FILE=${SIF_FILE},NPY_PATH=${NPY_PATH}" \
+  batch/stitch.sh \
+)"
+
+DT_FILE="$(find "${INP_DIR}" -maxdepth 1 -name '*detected_transcripts*')"
+PART_DIR="$(dirname "${AD_PATH}")/parts"
+
+# build the columnar transcripts cache once (alongside segmentation), so that shards don't race to create it
+ING_ID="$(sbatch --parsable --account="${ACCOUNT}" \
+  --export="SIF_FILE=${SIF_FILE},DT_FILE=${DT_FILE}" \
+  batch/ingest.sh \
+)"
+
+# assign transcripts of each z slice as soon as its boundaries are available, then sum the partial count matrices
+ASN_DEP_STR='afterok'
 for z in $(seq 0 6); do
-  BND_DEP_STR+=":$(sbatch --parsable --account="${ACCOUNT}" \
-    -d "afterok:${SEG_ID}" \
+  BND_ID="$(sbatch --parsable --account="${ACCOUNT}" \
+    -d "afterok:${STI_ID}" \
     --export="SIF_FILE=${SIF_FILE},NPY_PATH=${NPY_PATH},OUT_PATH=${FTR_DIR}/z${z}.feather,MP_PATH=${INP_DIR}/images/micron_to_mosaic_pixel_transform.csv,Z_SLICE=${z}" \
     batch/boundary.sh \
   )"
+  ASN_DEP_STR+=":$(sbatch --parsable --account="${ACCOUNT}" \
+    -d "afterok:${BND_ID}:${ING_ID}" \
+    --export="SIF_FILE=${SIF_FILE},FTR_FILE=${FTR_DIR}/z${z}.feather,DT_FILE=${DT_FILE},Z_SLICE=${z},DTF_FILE=${DTF_DIR}/z${z}.feather,AD_FILE=${PART_DIR}/z${z}.h5ad" \
+    batch/assign-shard.sh \
+  )"
 done
 
 sbatch --parsable --account="${ACCOUNT}" \
-  -d "${BND_DEP_STR}" \
-  --export="SIF_FILE=${SIF_FILE},FTR_DIR=${FTR_DIR},DT_FILE=$(find "${INP_DIR}" -maxdepth 1 -name '*detected_transcripts*'),DTF_FILE=${DTF_PATH},AD_FILE=${AD_PATH}" \
-  batch/assign.sh
+  -d "${ASN_DEP_STR}" \
+  --export="SIF_FILE=${SIF_FILE},PART_DIR=${PART_DIR},AD_FILE=${AD_PATH}" \
+  batch/merge.sh
 
 for z in $(seq 0 6); do
   sbatch --parsable --account="${ACCOUNT}" \
-    -d "afterok:${SEG_ID}" \
+    -d "afterok:${STI_ID}" \
     --export="SIF_FILE=${SIF_FILE},INP_PATH=${INP_DIR},NPY_PATH=${NPY_PATH},Z_SLICE=${z},OUT_PATH=${IMG_DIR}/z${z}.png" \
     batch/preview.sh
 done
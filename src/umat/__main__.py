@@ -1,8 +1,17 @@
+import os
+import sys
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Annotated
 
 import cappa
 
 from . import conf as c
+from . import profile
+from .memory import format_size, memory, parse_size
+
+# environment variable holding the socket path of a `umat serve` instance to forward invocations to
+SERVER_ENV = "UMAT_SERVER"
 
 
 @cappa.command(name="umat")
@@ -11,55 +20,134 @@ class Umat:
     command: cappa.Subcommands[
         c.AddLabelConf
         | c.AssignConf
+        | c.BenchConf
         | c.BoundaryConf
         | c.DistributedSegConf
         | c.FromProsegConf
+        | c.IndexConf
+        | c.IngestConf
+        | c.LinkConf
+        | c.MergeConf
+        | c.PipelineConf
         | c.PreviewConf
         | c.RetrainConf
         | c.SampleConf
+        | c.ServeConf
         | c.SignalsConf
         | c.SpotConf
+        | c.StitchConf
     ]
+    profile: Annotated[
+        Path | None,
+        cappa.Arg(
+            long="--profile",
+            help="output JSON file path (Chrome trace format) recording wall/CPU time, peak RSS and bytes read/written"
+            " of every phase of the invoked tool",
+        ),
+    ] = None
+    max_memory: Annotated[
+        str | None,
+        cappa.Arg(
+            long="--max-memory",
+            help="memory limit of the invoked tool (including its worker processes), e.g. '64G' or '512M'."
+            " tools size their batches, tiles, caches and worker counts to stay within it, based on their actual usage"
+            " (defaults to the memory available on the machine)",
+        ),
+    ] = None
 
 
-def main():
-    conf = cappa.parse(Umat, completion=False)
-    print(f"config: {conf.command}", flush=True)
-
+def dispatch(command):
+    # run the tool corresponding to a subcommand config, tools are imported lazily to keep startup fast
     # fmt: off
-    match conf.command:
+    match command:
         case c.AddLabelConf():
             from .tools.addlab import run
-            run(conf.command)
+            run(command)
         case c.AssignConf():
             from .tools.assign import run
-            run(conf.command)
+            run(command)
+        case c.BenchConf():
+            from .tools.bench import run
+            run(command)
         case c.BoundaryConf():
             from .tools.boundary import run
-            run(conf.command)
+            run(command)
         case c.DistributedSegConf():
             from .tools.segd import run
-            run(conf.command)
+            run(command)
         case c.FromProsegConf():
             from .tools.from_proseg import run
-            run(conf.command)
+            run(command)
+        case c.IndexConf():
+            from .tools.index import run
+            run(command)
+        case c.IngestConf():
+            from .tools.ingest import run
+            run(command)
+        case c.LinkConf():
+            from .tools.link import run
+            run(command)
+        case c.MergeConf():
+            from .tools.merge import run
+            run(command)
+        case c.PipelineConf():
+            from .tools.pipeline import run
+            run(command)
         case c.PreviewConf():
             from .tools.preview import run
-            run(conf.command)
+            run(command)
         case c.RetrainConf():
             from .tools.retrain import run
-            run(conf.command)
+            run(command)
         case c.SampleConf():
             from .tools.sample import run
-            run(conf.command)
+            run(command)
+        case c.ServeConf():
+            from .tools.serve import run
+            run(command)
         case c.SignalsConf():
             from .tools.signals import run
-            run(conf.command)
+            run(command)
         case c.SpotConf():
             from .tools.spot import run
-            run(conf.command)
+            run(command)
+        case c.StitchConf():
+            from .tools.stitch import run
+            run(command)
     # fmt:on
 
 
+def execute(argv: list[str] | None = None):
+    # parse and run a command line, in-process (also used by `umat serve` for each request)
+    conf = cappa.parse(Umat, argv=argv, completion=False)
+    print(f"config: {conf.command}", flush=True)
+    if conf.max_memory is not None:
+        memory.limit = parse_size(conf.max_memory)
+        print(f"limiting memory usage to {format_size(memory.limit)}", flush=True)
+
+    if conf.profile is None:
+        dispatch(conf.command)
+        return
+
+    profile.enable()
+    try:
+        with profile.phase(type(conf.command).__name__):
+            dispatch(conf.command)
+    finally:
+        profile.write(conf.profile)
+        profile.disable()
+
+
+def main():
+    argv = sys.argv[1:]
+    # forward the command line to a running `umat serve` instance if configured, running in-process if unreachable
+    if (socket_path := os.environ.get(SERVER_ENV)) and "serve" not in argv:
+        from .client import request
+
+        if (code := request(Path(socket_path), argv)) is not None:
+            sys.exit(code)
+    execute(argv)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from pathlib import Path
+from threading import Lock
+from typing import Any
+
+import numpy as np
+
+from .memory import memory
+
+# process-wide LRU cache of loaded datasets (transcript tables, mosaics, decoded mask chunks), keyed by
+# source file path and modification stamp so that changed files are reloaded.
+# disabled (budget of 0) by default, as one-shot invocations never reload the same data.
+# `umat serve` enables it, so that repeated requests on the same data skip loading it again.
+# besides its byte budget, entries are evicted whenever the memory budget (`umat --max-memory`, or system memory) runs low.
+
+
+def nbytes(value: Any) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "memory_usage"):
+        # pandas data frames, not imported here to keep the import of this module cheap
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, tuple):
+        return sum(map(nbytes, value))
+    return 0
+
+
+def stamp(path: Path) -> tuple[str, int, int]:
+    st = path.stat()
+    return (str(path.resolve()), st.st_size, st.st_mtime_ns)
+
+
+class DatasetCache:
+    def __init__(self, budget: int = 0):
+        self.budget = budget
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        if self.budget <= 0:
+            return load()
+
+        with self._lock:
+            if (hit := self._entries.get(key)) is not None:
+                self._entries.move_to_end(key)
+                return hit[0]
+
+        value = load()
+        size = nbytes(value)
+        with self._lock:
+            if key not in self._entries and size <= self.budget:
+                self._entries[key] = (value, size)
+                self._size += size
+            while self._entries and (self._size > self.budget or memory.pressure()):
+                _, (_, old) = self._entries.popitem(last=False)
+                self._size -= old
+        return value
+
+
+datasets = DatasetCache()
@@ -0,0 +1,33 @@
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+
+# thin client of `umat serve`, only importing the standard library so that forwarded invocations start instantly.
+# requests are single JSON lines ({"argv": [...], "cwd": "..."}), answered by a stream of JSON lines:
+# {"out": "...", "stream": "stdout" | "stderr"} for tool output, then {"exit": code} once the command finished.
+
+
+def request(socket_path: Path, argv: list[str]) -> int | None:
+    # exit code of the command run by the server, None if the server is unreachable
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except OSError as e:
+        sock.close()
+        print(f"could not reach umat server at {socket_path} ({e}), running in-process", file=sys.stderr, flush=True)
+        return None
+
+    with sock, sock.makefile("r", encoding="utf-8") as f:
+        sock.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode())
+        for line in f:
+            msg = json.loads(line)
+            if "exit" in msg:
+                return msg["exit"]
+            stream = sys.stderr if msg["stream"] == "stderr" else sys.stdout
+            stream.write(msg["out"])
+            stream.flush()
+
+    print(f"umat server at {socket_path} closed the connection before the command finished", file=sys.stderr, flush=True)
+    return 1
@@ -9,8 +9,22 @@ import cappa
 @dataclass
 class AddLabelConf:
     hdf5_path: Annotated[Path, cappa.Arg(short="-i", help="input hdf5 file containing sampled images")]
-    sample: Annotated[int, cappa.Arg(short="-s", help="sample group name")]
-    lab_path: Annotated[Path, cappa.Arg(short="-l", help="input label file (can be ImageJ roi format or numpy npy format)")]
+    sample: Annotated[
+        list[str],
+        cappa.Arg(
+            short="-s",
+            action=cappa.ArgAction("append"),
+            help="sample group name. can be provided multiple times, each paired with the label file at the same position.",
+        ),
+    ]
+    lab_path: Annotated[
+        list[Path],
+        cappa.Arg(
+            short="-l",
+            action=cappa.ArgAction("append"),
+            help="input label file (can be ImageJ roi format or numpy npy format). can be provided multiple times.",
+        ),
+    ]
 
 
 @cappa.command(name="assign")
@@ -29,6 +43,99 @@ class AssignConf:
         Path, cappa.Arg(short="-f", help="output feather file path, containing updated transcript cell assignments")
     ]
     dt_path: Annotated[Path, cappa.Arg(short="-d", help="input detected transcripts CSV file path")]
+    compact: Annotated[
+        bool,
+        cappa.Arg(
+            short="-c",
+            action=cappa.ArgAction("store_true"),
+            help="pass to write the transcript table as plain arrow columns (x, y, z, dictionary-encoded gene and uint32 label,"
+            " 0 for unassigned transcripts) instead of a geopandas table",
+        ),
+    ] = False
+    z_subset: Annotated[
+        list[int] | None,
+        cappa.Arg(
+            short="-z",
+            action=cappa.ArgAction("append"),
+            help="z slice(s) of transcripts to assign, can be provided multiple times. implies -p",
+        ),
+    ] = None
+    tile: Annotated[
+        tuple[float, float, float, float] | None,
+        cappa.Arg(
+            short="-t",
+            help="only assign transcripts within this (min_x, min_y, max_x, max_y) micron bounding box"
+            " (min inclusive, max exclusive). implies -p",
+        ),
+    ] = None
+    partial: Annotated[
+        bool,
+        cappa.Arg(
+            short="-p",
+            action=cappa.ArgAction("store_true"),
+            help="pass to write a partial count matrix (all genes, blanks kept in the matrix) to be combined with other shards"
+            " using `umat merge`",
+        ),
+    ] = False
+    expand: Annotated[
+        float | None,
+        cappa.Arg(
+            short="-e",
+            help="assign transcripts outside of every cell to the cell with the closest boundary within this distance (microns)."
+            " assignment distances (0 for transcripts within cells) are added to the transcript table",
+        ),
+    ] = None
+    ncpus: Annotated[int, cappa.Arg(short="-j", help="number of threads used for cell expansion queries")] = 1
+    link_path: Annotated[
+        Path | None,
+        cappa.Arg(
+            short="-l",
+            help="relabel map generated by `umat link`, counting transcripts per 3D cell instead of per z slice label"
+            " (assigned transcripts additionally record their 3D cell)",
+        ),
+    ] = None
+
+
+@cappa.command(name="merge")
+@dataclass
+class MergeConf:
+    inp_paths: Annotated[
+        list[Path],
+        cappa.Arg(
+            short="-i",
+            action=cappa.ArgAction("append"),
+            help="input partial anndata h5ad file(s) generated by `umat assign` for a single shard, can be provided multiple times",
+        ),
+    ]
+    ad_path: Annotated[Path, cappa.Arg(short="-a", help="output anndata h5ad file path")]
+
+
+@cappa.command(name="bench")
+@dataclass
+class BenchConf:
+    data_dir: Annotated[Path, cappa.Arg(short="-d", help="directory in which synthetic datasets are generated")]
+    out_path: Annotated[Path, cappa.Arg(short="-o", help="output JSON file path containing benchmark results")]
+    sizes: Annotated[
+        list[int],
+        cappa.Arg(
+            short="-s",
+            action=cappa.ArgAction("append"),
+            help="side length (in pixels) of generated mosaics, can be provided multiple times to benchmark multiple scales",
+        ),
+    ] = field(default_factory=lambda: [1024, 2048])
+    n_z: Annotated[int, cappa.Arg(short="-z", help="amount of z slices in generated datasets")] = 2
+    tasks: Annotated[
+        list[str] | None,
+        cappa.Arg(
+            short="-t",
+            action=cappa.ArgAction("append"),
+            help="task(s) to benchmark (any of: segd ingestion, fromproseg, boundary, ingest, assign, spot, signals, preview),"
+            " can be provided multiple times. all tasks are benchmarked if unset",
+        ),
+    ] = None
+    repeats: Annotated[int, cappa.Arg(short="-r", help="amount of times each task is timed")] = 1
+    transcripts_per_cell: Annotated[int, cappa.Arg(short="-n", help="amount of generated transcripts per cell and z slice")] = 100
+    seed: Annotated[int, cappa.Arg(long="--seed", help="random seed used to generate datasets")] = 0
 
 
 @cappa.command(name="boundary")
@@ -48,6 +155,14 @@ class BoundaryConf:
         ),
     ] = None
     ncpus: Annotated[int, cappa.Arg(short="-j", help="amount of CPU cores to use")] = 1
+    simplify: Annotated[
+        float | None,
+        cappa.Arg(short="-s", help="simplify cell polygons (preserving topology) with this tolerance (microns)"),
+    ] = None
+    precision: Annotated[
+        float | None,
+        cappa.Arg(short="-p", help="snap cell polygon coordinates to a grid of this size (microns)"),
+    ] = None
 
 
 @cappa.command(name="signals")
@@ -100,6 +215,124 @@ class FromProsegConf:
     mp_path: Annotated[Path, cappa.Arg(short="-m", help="mosaic micron to mosaic pixel transform file path")]
     out_path: Annotated[Path, cappa.Arg(short="-o", help="path for output masks file (npy or zarr)")]
     z_slice: Annotated[int | None, cappa.Arg(short="-z", help="specify just one z-slice to run mask generation on")] = None
+    no_cache: Annotated[
+        bool,
+        cappa.Arg(
+            short="-n",
+            action=cappa.ArgAction("store_true"),
+            help="pass to stream polygons directly from the geojson file instead of using (and creating if absent)"
+            " the per-layer GeoParquet cache stored next to it",
+        ),
+    ] = False
+    codec: Annotated[
+        str, cappa.Arg(short="-k", help="compression codec used for zarr output (one of: zstd, lz4, gzip, none)")
+    ] = "zstd"
+
+
+@cappa.command(name="ingest")
+@dataclass
+class IngestConf:
+    dt_path: Annotated[Path, cappa.Arg(short="-i", help="input detected transcripts CSV file path")]
+    force: Annotated[
+        bool,
+        cappa.Arg(short="-f", action=cappa.ArgAction("store_true"), help="pass to rebuild the cache even if it is up to date"),
+    ] = False
+
+
+@cappa.command(name="index")
+@dataclass
+class IndexConf:
+    inp_path: Annotated[
+        Path,
+        cappa.Arg(short="-i", help="input masks file path (npy or zarr), the label index is written next to it"),
+    ]
+    ncpus: Annotated[int, cappa.Arg(short="-j", help="number of threads used to decode masks chunks")] = 1
+
+
+@cappa.command(name="link")
+@dataclass
+class LinkConf:
+    inp_path: Annotated[Path, cappa.Arg(short="-i", help="input masks file path (npy or zarr)")]
+    out_path: Annotated[
+        Path,
+        cappa.Arg(
+            short="-o",
+            help="output feather file path containing the relabel map, assigning a 3D cell to every (global_z, label) pair",
+        ),
+    ]
+    threshold: Annotated[
+        float,
+        cappa.Arg(
+            short="-t",
+            help="minimum intersection over union between labels of adjacent z slices for them to be linked into the same 3D cell"
+            " (labels are only linked to their best match)",
+        ),
+    ] = 0.5
+    ncpus: Annotated[int, cappa.Arg(short="-j", help="number of threads used to decode masks chunks")] = 1
+
+
+@cappa.command(name="pipeline")
+@dataclass
+class PipelineConf:
+    img_fmt: Annotated[
+        str,
+        cappa.Arg(
+            short="-i",
+            help="pattern for input mosaic files, in python format string format."
+            " following patterns assumed present: 'c' (for channel) and 'z' (for z stack level)."
+            " example: 'data_dir/region_0/images/mosaic_{c}_z{z}.tif'",
+        ),
+    ]
+    cyt_pat: Annotated[str, cappa.Arg(short="-c", help="name of cytoplasm channel. example: 'PolyT'.")]
+    nuc_pat: Annotated[str, cappa.Arg(short="-n", help="name of nuclear channel. example: 'DAPI'.")]
+    z_slices: Annotated[
+        list[int],
+        cappa.Arg(
+            short="-z",
+            action=cappa.ArgAction("append"),
+            help="z slices to process. can be provided multiple times to specify multiple slices.",
+        ),
+    ]
+    mp_path: Annotated[Path, cappa.Arg(short="-m", help="mosaic micron to mosaic pixel transform file path")]
+    dt_path: Annotated[Path, cappa.Arg(short="-d", help="input detected transcripts CSV file path")]
+    out_dir: Annotated[
+        Path,
+        cappa.Arg(short="-o", help="output directory, containing all stage outputs and the cache records used to skip stages"),
+    ]
+    masks_path: Annotated[
+        Path | None,
+        cappa.Arg(short="-s", help="optional existing masks file (npy or zarr) to use instead of running `umat segd`"),
+    ] = None
+    model_path: Annotated[
+        Path | None,
+        cappa.Arg(short="-w", help="optional path to cellpose model weights used by `umat segd` (uses cpsam if unset)"),
+    ] = None
+    simplify: Annotated[
+        float | None, cappa.Arg(short="-t", help="cell polygon simplification tolerance (microns), see `umat boundary -s`")
+    ] = None
+    precision: Annotated[
+        float | None, cappa.Arg(short="-p", help="cell polygon coordinate grid size (microns), see `umat boundary -p`")
+    ] = None
+    expand: Annotated[
+        float | None, cappa.Arg(short="-e", help="cell expansion distance (microns), see `umat assign -e`")
+    ] = None
+    compact: Annotated[
+        bool,
+        cappa.Arg(
+            short="-a",
+            action=cappa.ArgAction("store_true"),
+            help="pass to write compact assigned transcript tables, see `umat assign -c`",
+        ),
+    ] = False
+    previews: Annotated[
+        bool,
+        cappa.Arg(short="-v", action=cappa.ArgAction("store_true"), help="pass to also generate segmentation previews"),
+    ] = False
+    ncpus: Annotated[int, cappa.Arg(short="-j", help="amount of stages to run concurrently")] = 1
+    force: Annotated[
+        bool,
+        cappa.Arg(short="-f", action=cappa.ArgAction("store_true"), help="pass to rerun every stage, even if up to date"),
+    ] = False
 
 
 @cappa.command(name="preview")
@@ -137,6 +370,24 @@ class RetrainConf:
             help="optional path to cellpose model weights to use (uses cpsam if unset)",
         ),
     ] = None
+    streaming: Annotated[
+        bool,
+        cappa.Arg(
+            short="-s",
+            action=cappa.ArgAction("store_true"),
+            help="pass to stream random augmented crops from the training file during training instead of loading every sample up front",
+        ),
+    ] = False
+    batch_size: Annotated[int, cappa.Arg(short="-b", help="batch size used for streamed training")] = 8
+    bsize: Annotated[int, cappa.Arg(short="-x", help="side length of crops used for streamed training (must be 256 for cpsam)")] = 256
+    workers: Annotated[int, cappa.Arg(short="-j", help="amount of worker processes reading crops for streamed training")] = 1
+    bench_batches: Annotated[
+        int | None,
+        cappa.Arg(
+            short="-t",
+            help="if set, only measure streamed loader throughput over the given amount of batches (no training is done)",
+        ),
+    ] = None
 
 
 @cappa.command(name="sample")
@@ -148,8 +399,8 @@ class SampleConf:
             short="-i",
             help=(
                 "pattern for input mosaic files, in python format string format."
-                " following patterns assumed present: 'c' (for channel)."
-                " example: 'data_dir/region_0/images/mosaic_{c}_z3.tif'."
+                " following patterns assumed present: 'c' (for channel), and 'z' (for z stack level) if z slices are provided."
+                " example: 'data_dir/region_0/images/mosaic_{c}_z{z}.tif'."
             ),
         ),
     ]
@@ -165,11 +416,48 @@ class SampleConf:
             short="-f",
             help=(
                 "pattern for group name assigned to each sample."
-                " following patterns assumed present: 'i' (for channel)."
-                " example: 'z3 - sample: {i}'."
+                " following patterns assumed present: 'i' (for sample index), and optionally 'z' (for z stack level)."
+                " example: 'z{z} - sample: {i}'."
             ),
         ),
     ]
+    z_slices: Annotated[
+        list[int] | None,
+        cappa.Arg(
+            short="-z",
+            action=cappa.ArgAction("append"),
+            help="z slice(s) to sample from (each sample uses a randomly selected slice). can be provided multiple times.",
+        ),
+    ] = None
+    channels: Annotated[
+        list[str],
+        cappa.Arg(
+            short="-e",
+            action=cappa.ArgAction("append"),
+            help="name of extra channel(s) to sample alongside the cytoplasm and nuclear channels. can be provided multiple times.",
+        ),
+    ] = field(default_factory=list)
+    ncpus: Annotated[int, cappa.Arg(short="-j", help="amount of threads used to read sample windows")] = 1
+
+
+@cappa.command(name="serve")
+@dataclass
+class ServeConf:
+    socket_path: Annotated[
+        Path,
+        cappa.Arg(
+            short="-s",
+            help="unix socket file path to listen on, clients use it when the UMAT_SERVER environment variable is set to it",
+        ),
+    ]
+    cache_mib: Annotated[
+        int,
+        cappa.Arg(
+            short="-c",
+            help="maximum size (in MiB) of loaded datasets (transcripts, mosaics, mask chunks) kept in memory between requests,"
+            " entries are also evicted whenever available system memory drops below a tenth of total memory",
+        ),
+    ] = 4096
 
 
 @cappa.command(name="segd")
@@ -227,6 +515,18 @@ class DistributedSegConf:
             help="optional stitch_threshold specified to 'Cellpose.eval', leave unset to use 'true' 3D segmentation",
         ),
     ] = None
+    codec: Annotated[
+        str, cappa.Arg(short="-k", help="compression codec used for zarr output (one of: zstd, lz4, gzip, none)")
+    ] = "zstd"
+    blockwise: Annotated[
+        bool,
+        cappa.Arg(
+            short="-u",
+            action=cappa.ArgAction("store_true"),
+            help="pass to write the labels of every block as is (unique across blocks) instead of merging cells across blocks,"
+            " to be stitched afterwards with `umat stitch -b <lz> <lx> <ly>`",
+        ),
+    ] = False
 
 
 @cappa.command(name="spot")
@@ -244,3 +544,37 @@ class SpotConf:
             help="pass to ignore z-axis when generating spots (i.e. flattening the data)",
         ),
     ] = False
+
+
+@cappa.command(name="stitch")
+@dataclass
+class StitchConf:
+    inp_path: Annotated[
+        Path,
+        cappa.Arg(
+            short="-i",
+            help="masks file (npy or zarr) made of independently segmented blocks, relabelled in place."
+            " labels are expected to be unique across blocks",
+        ),
+    ]
+    blocks: Annotated[
+        tuple[int, int, int] | None,
+        cappa.Arg(short="-b", help="(z, y, x) shape of the segmented blocks, defaults to the chunk shape of zarr masks"),
+    ] = None
+    threshold: Annotated[
+        float,
+        cappa.Arg(
+            short="-t",
+            help="minimum overlap between the footprints of labels on either side of a block face, relative to the smaller"
+            " footprint, for them to be merged (labels are only merged with their best match)",
+        ),
+    ] = 0.5
+    planar: Annotated[
+        bool,
+        cappa.Arg(
+            short="-p",
+            action=cappa.ArgAction("store_true"),
+            help="pass to only stitch blocks within z slices, e.g. for per-slice (2D) segmentations",
+        ),
+    ] = False
+    ncpus: Annotated[int, cappa.Arg(short="-j", help="number of worker processes reading block faces and relabelling chunks")] = 1
@@ -0,0 +1,454 @@
+import json
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zarr
+from numcodecs import GZip, Blosc
+
+from .cache import datasets, stamp
+from .memory import memory
+
+CODECS = {
+    "zstd": Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+    "lz4": Blosc(cname="lz4", clevel=5, shuffle=Blosc.BITSHUFFLE),
+    "gzip": GZip(level=5),
+    "none": None,
+}
+
+# smallest band/strip height used when streaming over masks, however low on memory
+MIN_ROWS = 64
+# default on-disk chunking for written masks, one z slice deep so that per-slice readers never decode other slices
+CHUNKS = (1, 2048, 2048)
+
+
+def label_dtype(max_label: int | np.integer) -> np.dtype:
+    for dt in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if max_label <= np.iinfo(dt).max:
+            return np.dtype(dt)
+    raise ValueError(f"label value {max_label} does not fit in any unsigned integer dtype")
+
+
+def strips(shape: tuple[int, ...], height: int) -> Iterator[tuple[int, slice]]:
+    # (z, row strip) pairs covering a 3D array, used to stream over masks without loading full slices
+    for z in range(shape[0]):
+        for y0 in range(0, shape[1], height):
+            yield z, slice(y0, min(y0 + height, shape[1]))
+
+
+def blocks(shape: tuple[int, int, int], src_chunks: tuple[int, ...], out_chunks: tuple[int, ...]) -> Iterator[tuple[slice, ...]]:
+    # (z, row, column) regions covering a 3D array, spanning whole source chunks (e.g. z-deep segmentation blocks)
+    # rounded up to whole output chunks, so that every output chunk is written once and every source chunk is decoded
+    # once (as long as output chunks divide source chunks, as with segd's blocks and the default masks chunks)
+    ext = [-(-c // o) * o for c, o in zip(src_chunks, out_chunks)]
+    for z0 in range(0, shape[0], ext[0]):
+        for y0 in range(0, shape[1], ext[1]):
+            for x0 in range(0, shape[2], ext[2]):
+                yield tuple(slice(b0, min(b0 + e, s)) for b0, e, s in zip((z0, y0, x0), ext, shape))
+
+
+def label_rows(reader: "MaskReader", z_idxs: list[int]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (labels, first row, last row + 1) of every label present in any of the given z slices,
+    # looked up in the label index if present, otherwise determined in a streaming pass over row strips sized to the memory budget
+    if (index := reader.index()) is not None:
+        index = index[index["z"].isin(z_idxs)]
+        rows = index.groupby("label", sort=True).agg(first=("y0", "min"), last=("y1", "max"))
+        return rows.index.to_numpy(reader.dtype), rows["first"].to_numpy(np.int64), rows["last"].to_numpy(np.int64)
+
+    found = []
+    for z in z_idxs:
+        for c0 in range(0, reader.shape[1], reader.chunks[1]):
+            # chunks are decoded once, their labelled pixels (along with their rows and the sorting temporaries
+            # of np.unique) are then gathered over sub-strips sized to the memory budget
+            chunk_row = reader[z, c0 : c0 + reader.chunks[1], :]
+            height = memory.batch(len(chunk_row), reader.shape[2] * (3 * reader.dtype.itemsize + 20), minimum=MIN_ROWS)
+            for y0 in range(0, len(chunk_row), height):
+                strip = chunk_row[y0 : y0 + height]
+                fg = strip != 0
+                lab = strip[fg]
+                rows = np.repeat(np.arange(c0 + y0, c0 + y0 + len(strip), dtype=np.int32), np.count_nonzero(fg, axis=1))
+                del fg
+                # labelled pixels are listed in row order, so first/last occurrences hold the extreme rows
+                u, first = np.unique(lab, return_index=True)
+                last = len(lab) - 1 - np.unique(lab[::-1], return_index=True)[1]
+                found.append((u, rows[first], rows[last] + 1))
+
+    if not found:
+        return np.zeros(0, reader.dtype), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    lab, first, last = (np.concatenate(a) for a in zip(*found))
+    order = np.argsort(lab, kind="stable")
+    lab, first, last = lab[order], first[order].astype(np.int64), last[order].astype(np.int64)
+    start = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+    return lab[start], np.minimum.reduceat(first, start), np.maximum.reduceat(last, start)
+
+
+def index_path(path: Path) -> Path:
+    # label index sidecar of a masks file, e.g. masks.zarr.labels.parquet
+    return path.with_name(f"{path.name}.labels.parquet")
+
+
+def masks_stamp(path: Path) -> dict[str, int]:
+    # zarr metadata is rewritten whenever masks are written (and touched when relabelled in place)
+    st = (path / ".zarray" if path.suffix == ".zarr" else path).stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+# per (z, label) statistics of masks (bounding box, pixel count, centroid and the chunks it touches),
+# accumulated over the strips of a single streaming pass and saved as a parquet sidecar of the masks file,
+# so that tools look cells up instead of scanning whole slices.
+# chunks are identified by their flat (row-major) index within the (y, x) chunk grid of a z slice
+class LabelIndex:
+    def __init__(self, shape: tuple[int, int, int], chunks: tuple[int, int, int]):
+        self.shape = shape
+        self.chunks = chunks
+        self._parts: list[tuple[np.ndarray, ...]] = []
+
+    def add(self, z: int, y0: int, strip: np.ndarray, x0: int = 0):
+        # strips start on a chunk row and column, and may span multiple chunk rows and columns
+        ch, cw = self.chunks[1:]
+        n_cols = -(-self.shape[2] // cw)
+        for r0 in range(0, strip.shape[0], ch):
+            for c0 in range(0, strip.shape[1], cw):
+                block = strip[r0 : r0 + ch, c0 : c0 + cw]
+                ys, xs = np.nonzero(block)
+                if len(ys) == 0:
+                    continue
+                lab = block[ys, xs]
+                # pixels are listed in row-major order, which the stable sort keeps within every label
+                order = np.argsort(lab, kind="stable")
+                lab, ys, xs = lab[order], ys[order] + (y0 + r0), xs[order] + (x0 + c0)
+                start = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+                end = np.r_[start[1:], len(lab)] - 1
+                chunk = ((y0 + r0) // ch) * n_cols + (x0 + c0) // cw
+                self._parts.append(
+                    (
+                        np.full(len(start), z, dtype=np.int64),
+                        lab[start].astype(np.uint64),
+                        ys[start],
+                        np.minimum.reduceat(xs, start),
+                        ys[end] + 1,
+                        np.maximum.reduceat(xs, start) + 1,
+                        np.diff(np.r_[start, len(lab)]),
+                        np.add.reduceat(ys, start),
+                        np.add.reduceat(xs, start),
+                        np.full(len(start), chunk, dtype=np.int32),
+                    )
+                )
+
+    def table(self, dtype: np.dtype) -> pa.Table:
+        # one row per (z, label), combining the statistics of every chunk the label touches
+        if self._parts:
+            z, lab, y0, x0, y1, x1, area, sy, sx, chunk = (np.concatenate(a) for a in zip(*self._parts))
+        else:
+            z, lab, y0, x0, y1, x1, area, sy, sx = (np.zeros(0, np.int64) for _ in range(9))
+            chunk = np.zeros(0, np.int32)
+        order = np.lexsort((chunk, lab, z))
+        z, lab, y0, x0, y1, x1, area, sy, sx, chunk = (a[order] for a in (z, lab, y0, x0, y1, x1, area, sy, sx, chunk))
+        new = np.r_[True, (z[1:] != z[:-1]) | (lab[1:] != lab[:-1])] if len(z) > 0 else np.zeros(0, bool)
+        start = np.flatnonzero(new)
+        reduce = (lambda f, a: f.reduceat(a, start)) if len(start) > 0 else (lambda f, a: a)
+        area_sum = reduce(np.add, area)
+        return pa.table(
+            {
+                "z": pa.array(z[start].astype(np.uint16)),
+                "label": pa.array(lab[start].astype(dtype)),
+                "y0": pa.array(reduce(np.minimum, y0).astype(np.int32)),
+                "x0": pa.array(reduce(np.minimum, x0).astype(np.int32)),
+                "y1": pa.array(reduce(np.maximum, y1).astype(np.int32)),
+                "x1": pa.array(reduce(np.maximum, x1).astype(np.int32)),
+                "area": pa.array(area_sum.astype(np.int64)),
+                "cy": pa.array(reduce(np.add, sy) / np.maximum(area_sum, 1)),
+                "cx": pa.array(reduce(np.add, sx) / np.maximum(area_sum, 1)),
+                "chunks": pa.ListArray.from_arrays(pa.array(np.r_[start, len(z)].astype(np.int32)), pa.array(chunk)),
+            }
+        )
+
+    def write(self, masks_path: Path, dtype: np.dtype):
+        # stamped with the masks file it describes, so that indexes of rewritten masks are ignored.
+        # the label statistics zarr masks record as array attributes are stored along, so that npy masks get them too
+        tbl = self.table(dtype)
+        z, label = tbl["z"].to_numpy(), tbl["label"].to_numpy()
+        bbox = []
+        for zi in range(self.shape[0]):
+            sel = z == zi
+            cols = [tbl[c].to_numpy()[sel] for c in ("y0", "x0", "y1", "x1")]
+            bbox.append(None if not sel.any() else [int(cols[0].min()), int(cols[1].min()), int(cols[2].max()), int(cols[3].max())])
+        attrs = {"max_label": int(label.max(initial=0)), "n_labels": len(np.unique(label)), "bbox": bbox}
+        meta = {"stamp": masks_stamp(masks_path), "shape": list(self.shape), "chunks": list(self.chunks), "attrs": attrs}
+        tbl = tbl.replace_schema_metadata({"umat": json.dumps(meta)})
+        pq.write_table(tbl, index_path(masks_path), compression="zstd")
+
+
+def index_meta(masks_path: Path) -> dict | None:
+    # metadata of the label index of a masks file, None if missing or outdated (masks rewritten or relabelled since)
+    path = index_path(masks_path)
+    if not path.is_file():
+        return None
+    meta = json.loads(pq.read_schema(path).metadata[b"umat"])
+    if meta["stamp"] != masks_stamp(masks_path):
+        print(f"ignoring outdated label index {path}", flush=True)
+        return None
+    return meta
+
+
+def read_index(masks_path: Path) -> pd.DataFrame | None:
+    # label index of a masks file, None if missing or outdated
+    if index_meta(masks_path) is None:
+        return None
+    return pq.read_table(index_path(masks_path)).to_pandas()
+
+
+def index_masks(path: Path, workers: int = 0):
+    # build the label index of an existing masks file, in a streaming pass over its chunk rows
+    with MaskReader(path, workers=workers) as masks:
+        index = LabelIndex(masks.shape, masks.chunks)
+        for z, ys in strips(masks.shape, masks.chunks[1]):
+            index.add(z, ys.start, masks[z, ys, :])
+    print(f"writing label index to {index_path(path)}", flush=True)
+    index.write(path, masks.dtype)
+
+
+def keep_labels(masks: np.ndarray, labels: np.ndarray):
+    # zero out (in place) all labels of masks except the given ones, through a lookup table rather than np.isin's sort
+    lut = np.zeros(int(max(masks.max(initial=0), labels.max(initial=0))) + 1, dtype=bool)
+    lut[labels] = True
+    masks[~lut[masks]] = 0
+
+
+def row_bands(first: np.ndarray, last: np.ndarray, height: int) -> Iterator[tuple[slice, np.ndarray]]:
+    # (rows, label indices) groups of labels by the row strip of the given height their first row falls in.
+    # every band spans the rows of all its labels, and as such may exceed the strip height (by at most one cell)
+    if len(first) == 0:
+        return
+    band = first // max(height, 1)
+    order = np.argsort(band, kind="stable")
+    bounds = np.flatnonzero(np.r_[True, band[order][1:] != band[order][:-1], True])
+    for b0, b1 in zip(bounds[:-1], bounds[1:]):
+        idx = order[b0:b1]
+        yield slice(int(first[idx].min()), int(last[idx].max())), idx
+
+
+def write_masks(
+    path: Path,
+    masks: np.ndarray | zarr.Array,
+    codec: str = "zstd",
+    chunks: tuple[int, int, int] = CHUNKS,
+):
+    if codec not in CODECS:
+        raise ValueError(f"unknown codec '{codec}', expected one of: {', '.join(CODECS)}")
+    if masks.ndim not in (2, 3):
+        raise ValueError(f"expected 2D or 3D masks array, got shape {masks.shape}")
+
+    # 2D masks are handled as a single slice stack, and written back out as 2D
+    flat = masks.ndim == 2
+    src = np.asarray(masks)[None] if flat else masks
+    shape3 = src.shape
+    # both passes read blocks aligned to the source chunks (e.g. z-deep segmentation blocks), decoding each once per pass
+    src_chunks = src.chunks if isinstance(src, zarr.Array) else chunks
+
+    # first pass: determine label statistics (used for dtype selection and stored as metadata)
+    max_label = 0
+    uniques = []
+    bbox: list[list[int] | None] = [None] * shape3[0]
+    for zs, ys, xs in blocks(shape3, src_chunks, chunks):
+        block = np.asarray(src[zs, ys, xs])
+        if block.size == 0 or not block.any():
+            continue
+        if block.min() < 0:
+            raise ValueError(f"expected non-negative labels, got minimum value {block.min()} at z={zs.start}-{zs.stop - 1}")
+        max_label = max(max_label, int(block.max()))
+        uniques.append(np.unique(block))
+
+        for z, plane in zip(range(zs.start, zs.stop), block):
+            rows = np.flatnonzero(plane.any(axis=1)) + ys.start
+            cols = np.flatnonzero(plane.any(axis=0)) + xs.start
+            if len(rows) == 0:
+                continue
+            curr = [int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1]
+            prev = bbox[z]
+            bbox[z] = curr if prev is None else [min(prev[0], curr[0]), min(prev[1], curr[1]), max(prev[2], curr[2]), max(prev[3], curr[3])]
+
+    uniques = np.unique(np.concatenate(uniques)) if uniques else np.zeros(0, np.uint8)
+    n_labels = int(np.count_nonzero(uniques))
+    dtype = label_dtype(max_label)
+
+    print(f"writing {n_labels} labels (max label: {max_label}) as {dtype} masks to {path}", flush=True)
+
+    # second pass: write narrowed blocks
+    if path.suffix == ".zarr":
+        out = zarr.open(
+            str(path),
+            mode="w",
+            shape=masks.shape,
+            chunks=chunks[1:] if flat else chunks,
+            dtype=dtype,
+            compressor=CODECS[codec],
+        )
+        out.attrs.update({"max_label": max_label, "n_labels": n_labels, "bbox": bbox})
+    else:
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=masks.shape)
+
+    # the label index is accumulated from the written blocks, without another pass over the masks
+    index = LabelIndex(shape3, chunks)
+    for zs, ys, xs in blocks(shape3, src_chunks, chunks):
+        if all(bbox[z] is None for z in range(zs.start, zs.stop)):
+            # nothing to write, zarr fill value/npy zero initialization already cover empty slices
+            continue
+        block = np.asarray(src[zs, ys, xs]).astype(dtype, copy=False)
+        for z, plane in zip(range(zs.start, zs.stop), block):
+            index.add(z, ys.start, plane, xs.start)
+        if flat:
+            out[ys, xs] = block[0]
+        else:
+            out[zs, ys, xs] = block
+
+    if isinstance(out, np.memmap):
+        out.flush()
+        del out
+
+    print(f"writing label index to {index_path(path)}", flush=True)
+    index.write(path, dtype)
+
+
+# lazy, chunk-cached read access to a 3D (z, y, x) masks file (npy or zarr).
+# slicing (e.g. `reader[z, y0:y1, x0:x1]`) only decodes the chunks overlapping the requested region,
+# keeping decoded chunks in a bounded LRU cache so that tiled/overlapping reads reuse them.
+# npy files are memory-mapped and split into a virtual chunk grid, so both formats behave identically.
+# if `workers` is above 0, chunks are decoded on a thread pool, and `prefetch` can be used to
+# schedule reads of an upcoming region in the background.
+class MaskReader:
+    def __init__(self, path: Path, cache_bytes: int | None = None, workers: int = 0):
+        self.path = path
+        if path.suffix == ".zarr":
+            arr = zarr.open(str(path), mode="r")
+            assert isinstance(arr, zarr.Array), f"expected input file {path} to contain zarr.Array, got {type(arr)}"
+            self.attrs = dict(arr.attrs)
+        else:
+            arr = np.load(path, mmap_mode="r")
+            # npy files have no attributes, the label statistics are stored in the label index instead
+            self.attrs = {} if (meta := index_meta(path)) is None else meta.get("attrs", {})
+        if arr.ndim != 3:
+            raise ValueError(f"expected 3D (z, y, x) masks in {path}, got shape {arr.shape}")
+
+        self._arr = arr
+        # identifies the file contents in the dataset cache, zarr metadata is rewritten whenever masks are written
+        self._stamp = stamp(path / ".zarray" if path.suffix == ".zarr" else path)
+        self.shape: tuple[int, int, int] = arr.shape
+        self.dtype = arr.dtype
+        self.chunks: tuple[int, int, int] = (
+            arr.chunks if isinstance(arr, zarr.Array) else tuple(min(c, s) for c, s in zip(CHUNKS, arr.shape))  # pyright: ignore
+        )
+
+        self._cache: OrderedDict[tuple[int, int, int], np.ndarray] = OrderedDict()
+        # by default, up to 512MiB but no more than a quarter of the memory budget, while holding at least
+        # a chunk so that consecutive reads within a chunk (e.g. narrow bands) do not decode it again
+        chunk_bytes = int(np.prod(self.chunks)) * self.dtype.itemsize
+        self._cache_bytes = max(min(1 << 29, memory.available() // 4), chunk_bytes) if cache_bytes is None else cache_bytes
+        self._cached_bytes = 0
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(workers) if workers > 0 else None
+        self._index: pd.DataFrame | None | bool = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    def index(self) -> pd.DataFrame | None:
+        # label index sidecar (see `LabelIndex`), loaded on first use, None if missing or outdated
+        if self._index is False:
+            self._index = datasets.get(("label index", self._stamp), lambda: read_index(self.path))
+        return self._index  # pyright: ignore
+
+    def _chunk(self, idx: tuple[int, int, int]) -> np.ndarray:
+        with self._lock:
+            if (hit := self._cache.get(idx)) is not None:
+                self._cache.move_to_end(idx)
+                return hit
+
+        sel = tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(idx, self.chunks, self.shape))
+        data = datasets.get(("masks", self._stamp, idx), lambda: np.array(self._arr[sel]))
+
+        with self._lock:
+            if idx not in self._cache and data.nbytes <= self._cache_bytes:
+                self._cache[idx] = data
+                self._cached_bytes += data.nbytes
+                while self._cached_bytes > self._cache_bytes:
+                    _, old = self._cache.popitem(last=False)
+                    self._cached_bytes -= old.nbytes
+        return data
+
+    def _bounds(self, key) -> tuple[list[tuple[int, int]], list[bool]]:
+        # normalize a key of ints/contiguous slices into per-axis [start, stop) bounds,
+        # along with whether each axis should be kept in the output
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError(f"too many indices for 3D masks: {key}")
+        key = key + (slice(None),) * (3 - len(key))
+
+        bounds, keep = [], []
+        for k, s in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(s)
+                if step != 1:
+                    raise IndexError("strided slicing of masks is not supported")
+                bounds.append((start, max(start, stop)))
+                keep.append(True)
+            elif isinstance(k, int | np.integer):
+                i = int(k) + s if k < 0 else int(k)
+                if not 0 <= i < s:
+                    raise IndexError(f"index {k} out of bounds for axis with size {s}")
+                bounds.append((i, i + 1))
+                keep.append(False)
+            else:
+                raise IndexError(f"unsupported index for masks: {k}")
+        return bounds, keep
+
+    def _chunk_ids(self, bounds: list[tuple[int, int]]) -> list[tuple[int, int, int]]:
+        ranges = [range(b0 // c, -(-b1 // c)) for (b0, b1), c in zip(bounds, self.chunks)]
+        return [(i, j, k) for i in ranges[0] for j in ranges[1] for k in ranges[2]]
+
+    def __getitem__(self, key) -> np.ndarray:
+        bounds, keep = self._bounds(key)
+        ids = self._chunk_ids(bounds)
+        chunks = list(self._pool.map(self._chunk, ids)) if self._pool is not None and len(ids) > 1 else map(self._chunk, ids)
+
+        out = np.empty(tuple(b1 - b0 for b0, b1 in bounds), dtype=self.dtype)
+        for idx, data in zip(ids, chunks):
+            # overlap between chunk and requested region, in chunk-local and output-local coordinates
+            src, dst = [], []
+            for i, c, (b0, b1) in zip(idx, self.chunks, bounds):
+                lo, hi = max(i * c, b0), min((i + 1) * c, b1)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - b0, hi - b0))
+            out[tuple(dst)] = data[tuple(src)]
+
+        return out[tuple(slice(None) if k else 0 for k in keep)]
+
+    def prefetch(self, key):
+        # schedule background decoding of the chunks overlapping key (no-op without workers),
+        # only scheduling as many chunks as the cache can hold
+        if self._pool is None:
+            return
+        budget = self._cache_bytes
+        for idx in self._chunk_ids(self._bounds(key)[0]):
+            budget -= int(np.prod(self.chunks)) * self.dtype.itemsize
+            if budget < 0:
+                break
+            self._pool.submit(self._chunk, idx)
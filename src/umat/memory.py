@@ -0,0 +1,132 @@
+import os
+import re
+from time import monotonic
+
+# process-wide memory budget (`umat --max-memory`), consulted by tools to size their batches, tiles, caches and worker counts.
+# usage is measured at runtime as the resident set size of this process and its child processes (from /proc),
+# so that the limit holds identically on any Linux machine, regardless of scheduler (SLURM, cgroups) accounting.
+# without a limit, sizes are derived from the memory available to the whole system instead.
+# tools query the budget right before allocating, so that they degrade to smaller batches as usage grows
+# instead of failing, falling back to a minimal batch size when nothing is left.
+
+# fraction of the limit kept free for allocations the tools do not account for (interpreter, libraries, temporaries)
+HEADROOM = 0.1
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+# seconds for which a resident set size reading is reused, as budget queries may come in bulk (e.g. per batch or tile)
+RSS_TTL = 0.5
+# last resident set size reading, as (pid, children, time, bytes)
+_last_rss: tuple[int, bool, float, int] | None = None
+
+
+def parse_size(size: str) -> int:
+    # amount of bytes from a human readable size, e.g. "64G", "512MiB", "1.5T", "1000000" (binary units)
+    m = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([KMGT]?)(?:I?B)?\s*", size.upper())
+    if m is None:
+        raise ValueError(f"invalid memory size '{size}', expected a number optionally followed by K, M, G or T")
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+def format_size(n: int) -> str:
+    for unit in ("T", "G", "M", "K"):
+        if abs(n) >= UNITS[unit]:
+            return f"{n / UNITS[unit]:.1f}{unit}iB"
+    return f"{n}B"
+
+
+def mem_available() -> tuple[int, int] | None:
+    # (available, total) system memory in bytes, None where unsupported
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f}
+    except OSError:
+        return None
+    return info["MemAvailable"], info["MemTotal"]
+
+
+def _status_rss(pid: int | str) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int) -> list[int]:
+    # direct child processes, as listed by the kernel for every thread of the process
+    try:
+        children = []
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(map(int, f.read().split()))
+        return children
+    except (OSError, ValueError):
+        pass
+    # otherwise (kernels without CONFIG_PROC_CHILDREN, or threads exiting meanwhile) from the parent pid field of every process' stat file
+    children = []
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                # the command name (2nd field) may contain spaces, fields after it are space separated
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(entry.name))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def rss(children: bool = True, max_age: float = RSS_TTL) -> int:
+    # resident set size of this process (and its descendants, e.g. pool workers), in bytes, reusing readings up to max_age seconds old.
+    # shared pages of forked workers are counted once per process, overestimating usage rather than underestimating it
+    global _last_rss
+    key, now = (os.getpid(), children), monotonic()
+    if _last_rss is not None and _last_rss[:2] == key and now - _last_rss[2] < max_age:
+        return _last_rss[3]
+    total = _status_rss("self")
+    if children:
+        todo = _children(os.getpid())
+        while todo:
+            pid = todo.pop()
+            total += _status_rss(pid)
+            todo.extend(_children(pid))
+    _last_rss = (*key, now, total)
+    return total
+
+
+class MemoryBudget:
+    def __init__(self, limit: int | None = None):
+        self.limit = limit
+
+    def available(self) -> int:
+        # bytes that can still be allocated, after keeping the headroom free
+        if self.limit is None:
+            mem = mem_available()
+            return 1 << 62 if mem is None else max(mem[0] - int(mem[1] * HEADROOM), 0)
+        return max(int(self.limit * (1 - HEADROOM)) - rss(), 0)
+
+    def pressure(self) -> bool:
+        # whether usage is within the headroom of the limit (or the system is running low on memory)
+        if self.limit is None:
+            mem = mem_available()
+            return mem is not None and mem[0] < mem[1] * HEADROOM
+        return rss() > self.limit * (1 - HEADROOM)
+
+    def fits(self, n_bytes: int, fraction: float = 1.0) -> bool:
+        return n_bytes <= self.available() * fraction
+
+    def batch(self, n: int, item_bytes: float, fraction: float = 0.5, minimum: int = 1) -> int:
+        # amount of items (of item_bytes each) to process at once out of n, using at most a fraction of available memory
+        if n <= 0:
+            return 0
+        return int(min(max(self.available() * fraction // max(item_bytes, 1), minimum), n))
+
+    def workers(self, requested: int, worker_bytes: float, fraction: float = 0.5) -> int:
+        # amount of worker processes/threads (at most requested, at least 1) that fit in a fraction of available memory
+        return self.batch(requested, worker_bytes, fraction=fraction, minimum=1)
+
+
+memory = MemoryBudget()
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import numpy as np
+import zarr
+from tifffile import imread, memmap
+from zarr import create as zcreate
+
+from .cache import datasets, stamp
+
+
+def open_mosaic(path: Path) -> np.ndarray | zarr.Array:
+    # lazily open a 2D mosaic TIFF file, so that only the regions which are sliced out are read from disk.
+    # uncompressed, contiguous images (e.g. MERSCOPE mosaics) are memory-mapped,
+    # other (tiled/compressed) images are opened as a zarr array only decoding the overlapped tiles/strips
+    try:
+        return memmap(path, mode="r")
+    except ValueError:
+        arr = zarr.open(imread(path, aszarr=True), mode="r")
+        # use full resolution level for pyramidal files
+        return arr["0"] if isinstance(arr, zarr.Group) else arr
+
+
+def read_mosaic(path: Path) -> np.ndarray:
+    # fully read a 2D mosaic TIFF file, through the dataset cache (used by `umat serve`).
+    # the returned array may be shared with later calls, and as such is read-only
+    def load() -> np.ndarray:
+        arr = imread(path, aszarr=False)
+        arr.flags.writeable = False
+        return arr
+
+    return datasets.get(("mosaic", stamp(path)), load)
+
+
+def stack_mosaics(paths: list[Path], store: Path, chunks: tuple[int, int, int]) -> zarr.Array:
+    # stack 2D mosaics (one per z slice) into a chunked 3D zarr array, as ingested by `umat segd`.
+    # slices are read and written one chunk deep group at a time, so that the full stack never resides in memory
+    first = open_mosaic(paths[0])
+    arr = zcreate(shape=(len(paths), *first.shape), chunks=chunks, dtype=first.dtype, store=store)
+    for z0 in range(0, len(paths), chunks[0]):
+        arr[z0 : z0 + chunks[0]] = np.stack([imread(p, aszarr=False) for p in paths[z0 : z0 + chunks[0]]], axis=0)
+    return arr
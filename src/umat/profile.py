@@ -0,0 +1,141 @@
+import json
+import os
+import resource
+from contextlib import contextmanager
+from pathlib import Path
+from threading import get_ident
+from time import perf_counter
+
+# lightweight, opt-in (`umat --profile`) phase timing. tools wrap named phases in `with phase("..."):` blocks,
+# which record wall and CPU time, peak RSS and bytes read/written (from /proc/self/io, when available) while enabled,
+# and cost nothing more than a flag check otherwise.
+# recorded phases are written as a Chrome trace (viewable in chrome://tracing or https://ui.perfetto.dev),
+# with per-phase totals under the additional "summary" key.
+
+_enabled = False
+_start = 0.0
+_events: list[dict] = []
+# peak RSS observed so far by each currently open phase, innermost last
+_open: list[list[int]] = []
+
+
+def enable():
+    global _enabled, _start
+    _enabled = True
+    _start = perf_counter()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    _events.clear()
+    _open.clear()
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def cpu_time() -> float:
+    # CPU time of this process (all threads) and of its terminated child processes (e.g. multiprocessing pools)
+    s, c = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+
+def io_counters() -> dict[str, int]:
+    # rchar/wchar count all bytes passing through read/write calls (including page cache hits),
+    # read_bytes/write_bytes only those actually fetched from/sent to storage
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {k: int(counters[k]) for k in ("rchar", "wchar", "read_bytes", "write_bytes") if k in counters}
+
+
+def peak_rss() -> int:
+    # peak resident set size since the last reset (or process start), in bytes
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    # so that the peak RSS of a phase is not hidden by an earlier, larger one (no-op where unsupported)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def phase(name: str, **args):
+    if not _enabled:
+        yield
+        return
+
+    # fold the peak so far into every open phase before resetting it for this one
+    rss = peak_rss()
+    for peak in _open:
+        peak[0] = max(peak[0], rss)
+    reset_peak_rss()
+    own = [0]
+    _open.append(own)
+
+    io0, cpu0, t0 = io_counters(), cpu_time(), perf_counter()
+    try:
+        yield
+    finally:
+        t1, cpu1, io1 = perf_counter(), cpu_time(), io_counters()
+        _open.pop()
+        own[0] = max(own[0], peak_rss())
+        if _open:
+            _open[-1][0] = max(_open[-1][0], own[0])
+
+        _events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (t0 - _start) * 1e6,
+                "dur": (t1 - t0) * 1e6,
+                "pid": os.getpid(),
+                "tid": get_ident(),
+                "args": args
+                | {"cpu_s": cpu1 - cpu0, "peak_rss_bytes": own[0]}
+                | {k: io1[k] - io0[k] for k in io1.keys() & io0.keys()},
+            }
+        )
+
+
+def collect() -> list[dict]:
+    # recorded events, cleared afterwards (used to gather events recorded in worker processes)
+    events = list(_events)
+    _events.clear()
+    return events
+
+
+def merge(events: list[dict]):
+    _events.extend(events)
+
+
+def write(path: Path):
+    summary: dict[str, dict] = {}
+    for e in _events:
+        s = summary.setdefault(e["name"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_bytes": 0})
+        s["count"] += 1
+        s["wall_s"] += e["dur"] / 1e6
+        s["cpu_s"] += e["args"]["cpu_s"]
+        s["peak_rss_bytes"] = max(s["peak_rss_bytes"], e["args"]["peak_rss_bytes"])
+        for k in ("rchar", "wchar", "read_bytes", "write_bytes"):
+            if k in e["args"]:
+                s[k] = s.get(k, 0) + e["args"][k]
+
+    print(f"writing profile of {len(_events)} phase(s) to {path}", flush=True)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms", "summary": summary}, f, indent=1)
@@ -0,0 +1,87 @@
+import numpy as np
+
+# label merging helpers, shared by tools resolving label identities across z slices (`umat link`)
+# and across the blocks of blockwise segmentations (`umat stitch`)
+
+# label pairs are packed into single uint64 keys, so that overlaps can be counted with a sparse bincount
+SHIFT = np.uint64(32)
+LOW = np.uint64(0xFFFFFFFF)
+
+
+def sparse_count(keys: np.ndarray, counts: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    # (sorted unique keys, summed counts), a bincount over sparse keys
+    if counts is None:
+        return np.unique(keys, return_counts=True)
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    start = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) > 0 else np.zeros(0, np.int64)
+    return keys[start], np.add.reduceat(counts, start) if len(keys) > 0 else counts
+
+
+def pair_keys(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # packed (label in a, label in b) keys of every pixel labelled in both arrays
+    fg = (a != 0) & (b != 0)
+    return (a[fg].astype(np.uint64) << SHIFT) | b[fg].astype(np.uint64)
+
+
+def best(key: np.ndarray, score: np.ndarray) -> np.ndarray:
+    # mask of the highest scoring entry for every key (ties broken by position)
+    order = np.lexsort((-score, key))
+    first = np.zeros(len(key), dtype=bool)
+    first[order[np.r_[True, key[order][1:] != key[order][:-1]]] if len(key) > 0 else order] = True
+    return first
+
+
+def match(
+    key: np.ndarray,
+    inter: np.ndarray,
+    labels_a: np.ndarray,
+    areas_a: np.ndarray,
+    labels_b: np.ndarray,
+    areas_b: np.ndarray,
+    threshold: float,
+    union: bool = True,
+) -> tuple[np.ndarray, np.ndarray]:
+    # (index in labels_a, index in labels_b) of the overlapping label pairs (packed keys, intersection sizes) whose
+    # intersection over union (or over the smaller of both areas) is at least threshold, and which are each other's
+    # best match, so that neighbouring cells are never merged through a label overlapping both
+    a, b = key >> SHIFT, key & LOW
+    ia, ib = np.searchsorted(labels_a, a), np.searchsorted(labels_b, b)
+    score = inter / (areas_a[ia] + areas_b[ib] - inter if union else np.minimum(areas_a[ia], areas_b[ib]))
+    keep = (score >= threshold) & best(a, score) & best(b, score)
+    return ia[keep], ib[keep]
+
+
+def components(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # vectorized union-find over n nodes and the (a, b) edges between them, returning the root of every node
+    # (the smallest node of its component). every round hooks the larger root of each edge onto the smaller one,
+    # then compresses paths by pointer jumping until every node points at its root, so that the amount of numpy
+    # calls only depends on the depth of the merges rather than on the amount of edges
+    parent = np.arange(n)
+    a, b = np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+    while True:
+        ra, rb = parent[a], parent[b]
+        merge = ra != rb
+        if not merge.any():
+            return parent
+        lo, hi = np.minimum(ra[merge], rb[merge]), np.maximum(ra[merge], rb[merge])
+        np.minimum.at(parent, hi, lo)
+        while not np.array_equal(grand := parent[parent], parent):
+            parent = grand
+        # edges within a single component can be dropped from later rounds
+        a, b = a[merge], b[merge]
+
+
+def relabel(data: np.ndarray, keys: np.ndarray, values: np.ndarray) -> bool:
+    # replace (in place) every occurrence of the sorted keys in data by the matching values,
+    # only looking up pixels within the key range. returns whether anything was replaced
+    if len(keys) == 0:
+        return False
+    cand = np.flatnonzero((data >= keys[0]) & (data <= keys[-1]))
+    if len(cand) == 0:
+        return False
+    flat = data.reshape(-1)
+    idx = np.searchsorted(keys, flat[cand])
+    hit = keys[np.minimum(idx, len(keys) - 1)] == flat[cand]
+    flat[cand[hit]] = values[idx[hit]]
+    return bool(hit.any())
@@ -0,0 +1,169 @@
+import gzip
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import shapely
+from scipy.spatial import cKDTree
+from tifffile import imwrite
+
+from .masks import write_masks
+
+# reproducible synthetic MERSCOPE-like datasets, used by `umat bench`.
+# cells are jittered grid points shared by all z slices (with a small per-slice drift), rasterized into masks
+# as the pixels within a radius of their closest center (so that neighbouring cells touch like real segmentations),
+# with matching mosaics (cytoplasm signal within cells, nuclear signal around centers),
+# transcripts clustered around cell centers and proseg-style cell polygons.
+
+# microns per mosaic pixel, as in MERSCOPE mosaics
+PIXEL_SIZE = 0.108
+# fraction of transcripts placed around cell centers, the others are spread uniformly
+CELL_FRACTION = 0.8
+
+
+def mosaic_fmt(data_dir: Path) -> str:
+    return str(data_dir / "images" / "mosaic_{c}_z{z}.tif")
+
+
+def micron_to_pixel(offset: tuple[float, float] = (-1000.0, -2000.0)) -> np.ndarray:
+    # micron to mosaic pixel transform, with an arbitrary offset between both coordinate systems
+    return np.array(
+        [
+            [1 / PIXEL_SIZE, 0.0, -offset[0] / PIXEL_SIZE],
+            [0.0, 1 / PIXEL_SIZE, -offset[1] / PIXEL_SIZE],
+            [0.0, 0.0, 1.0],
+        ]
+    )
+
+
+def cell_centers(rng: np.random.Generator, side: int, n_z: int, diameter: float) -> np.ndarray:
+    # (z, cell, (row, column)) pixel coordinates of cell centers
+    grid = np.arange(diameter / 2, side - diameter / 4, diameter)
+    base = np.stack(np.meshgrid(grid, grid, indexing="ij"), axis=-1).reshape(-1, 2)
+    base = base + rng.uniform(-0.3, 0.3, base.shape) * diameter
+    # leave some gaps between cells
+    base = base[rng.random(len(base)) < 0.9]
+    return np.stack([base + rng.normal(0, diameter * 0.03, base.shape) for _ in range(n_z)])
+
+
+def rasterize(centers: np.ndarray, side: int, radius: float, block: int = 256) -> tuple[np.ndarray, np.ndarray]:
+    # (labels, distance to the cell center) of every pixel of a z slice, processed in row blocks to bound memory
+    tree = cKDTree(centers)
+    labels = np.zeros((side, side), dtype=np.uint32)
+    dist = np.full((side, side), np.inf, dtype=np.float32)
+    cols = np.arange(side)
+    for r0 in range(0, side, block):
+        rows = np.arange(r0, min(r0 + block, side))
+        pts = np.stack(np.meshgrid(rows, cols, indexing="ij"), axis=-1).reshape(-1, 2)
+        d, i = tree.query(pts, k=1, distance_upper_bound=radius)
+        found = np.isfinite(d)
+        labels[rows[0] : rows[-1] + 1] = np.where(found, i + 1, 0).reshape(len(rows), side)
+        dist[rows[0] : rows[-1] + 1] = d.reshape(len(rows), side)
+    return labels, dist
+
+
+def mosaic(rng: np.random.Generator, signal: np.ndarray) -> np.ndarray:
+    # uint16 image from a [0, 1] signal, with background and shot noise
+    return np.clip(rng.normal(200 + 3000 * signal, 60 + 100 * signal), 0, 65535).astype(np.uint16)
+
+
+def transcripts(
+    rng: np.random.Generator, centers_um: np.ndarray, radius_um: float, extent_um: np.ndarray, n: int, n_genes: int
+) -> pa.Table:
+    n_z = centers_um.shape[0]
+    z = rng.integers(0, n_z, n)
+    n_cell = int(n * CELL_FRACTION)
+
+    xy = np.empty((n, 2))
+    cell = rng.integers(0, centers_um.shape[1], n_cell)
+    xy[:n_cell] = centers_um[z[:n_cell], cell] + rng.normal(0, radius_um / 2, (n_cell, 2))
+    xy[n_cell:] = rng.uniform(extent_um[0], extent_um[1], (n - n_cell, 2))
+
+    # a few highly expressed genes, many lowly expressed ones, and blank barcodes
+    names = np.array([f"Gene{i}" for i in range(n_genes)] + [f"Blank-{i}" for i in range(max(n_genes // 20, 1))])
+    weights = 1 / np.arange(1, len(names) + 1)
+    barcode = rng.choice(len(names), n, p=weights / weights.sum())
+
+    order = np.lexsort((xy[:, 0], z))
+    return pa.table(
+        {
+            "": np.arange(n),
+            "barcode_id": barcode[order],
+            "global_x": xy[order, 0],
+            "global_y": xy[order, 1],
+            "global_z": z[order].astype(np.float64),
+            "x": np.zeros(n),
+            "y": np.zeros(n),
+            "fov": np.zeros(n, dtype=np.int64),
+            "gene": names[barcode[order]],
+            "transcript_id": np.array([f"T{i}" for i in range(n)]),
+        }
+    )
+
+
+def write_proseg(path: Path, centers_um: np.ndarray, radius_um: float):
+    # proseg-style layer-resolved cell polygons (circles around cell centers), as a gzipped GeoJSON file
+    with gzip.open(path, "wt") as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        first = True
+        for layer, centers in enumerate(centers_um):
+            geoms = shapely.multipolygons(
+                shapely.buffer(shapely.points(centers), radius_um, quad_segs=8), indices=np.arange(len(centers))
+            )
+            for cell, geojson in enumerate(shapely.to_geojson(geoms), start=1):
+                sep = "" if first else ", "
+                f.write(f'{sep}{{"type": "Feature", "properties": {{"cell": {cell}, "layer": {layer}}}, "geometry": {geojson}}}')
+                first = False
+        f.write("]}")
+
+
+def generate(
+    data_dir: Path,
+    side: int,
+    n_z: int,
+    diameter: float = 80.0,
+    transcripts_per_cell: int = 100,
+    n_genes: int = 300,
+    seed: int = 0,
+) -> dict[str, Path]:
+    # write a synthetic dataset of n_z (side, side) pixel slices to data_dir, returning the paths of its files
+    rng = np.random.default_rng(seed)
+    (data_dir / "images").mkdir(parents=True, exist_ok=True)
+
+    tfm = micron_to_pixel()
+    mp_path = data_dir / "images" / "micron_to_mosaic_pixel_transform.csv"
+    np.savetxt(mp_path, tfm)
+
+    centers = cell_centers(rng, side, n_z, diameter)
+    radius = diameter * 0.55
+    print(f"generating {centers.shape[1]} cells over {n_z} z slices of {side}x{side} pixels in {data_dir}", flush=True)
+
+    masks = np.zeros((n_z, side, side), dtype=np.uint32)
+    for z in range(n_z):
+        masks[z], dist = rasterize(centers[z], side, radius)
+        cyt = (masks[z] > 0) * (1 - 0.5 * np.minimum(dist / radius, 1))
+        nuc = np.clip(1 - dist / (radius * 0.4), 0, 1)
+        imwrite(mosaic_fmt(data_dir).format(c="PolyT", z=z), mosaic(rng, cyt))
+        imwrite(mosaic_fmt(data_dir).format(c="DAPI", z=z), mosaic(rng, nuc))
+
+    masks_path = data_dir / "masks.zarr"
+    write_masks(masks_path, masks)
+    npy_path = data_dir / "masks.npy"
+    np.save(npy_path, masks)
+
+    # (row, column) pixels to (x, y) microns
+    inv = np.linalg.inv(tfm)
+    centers_um = centers[..., ::-1] * inv[[0, 1], [0, 1]] + inv[[0, 1], [2, 2]]
+    extent_um = np.array([inv[[0, 1], [2, 2]], inv[[0, 1], [2, 2]] + side * PIXEL_SIZE])
+
+    dt_path = data_dir / "detected_transcripts.csv"
+    pacsv.write_csv(
+        transcripts(rng, centers_um, radius * PIXEL_SIZE, extent_um, centers.shape[1] * n_z * transcripts_per_cell, n_genes),
+        dt_path,
+    )
+
+    proseg_path = data_dir / "cell-polygons-layers.geojson.gz"
+    write_proseg(proseg_path, centers_um, radius * PIXEL_SIZE)
+
+    return {"mp": mp_path, "masks": masks_path, "npy": npy_path, "dt": dt_path, "proseg": proseg_path}
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import numpy as np
 from h5py import Dataset, Group
 from h5py import File as H5File
@@ -5,37 +7,63 @@ from roifile import ImagejRoi, roiread
 from skimage.draw import polygon2mask
 
 from ..conf import AddLabelConf
+from ..masks import label_dtype
 
 
-def run(conf: AddLabelConf):
-    with H5File(conf.hdf5_path, "r+") as hf:
-        grp = hf[conf.sample]
-        if not isinstance(grp, Group):
-            raise ValueError(f"entry '{conf.sample}' in provided hdf5 file {conf.hdf5_path} is not a group.")
-        seg = grp["channel: cytoplasm"]
-        if not isinstance(seg, Dataset):
-            raise ValueError(
-                f"entry 'sample: {conf.sample}/channel: cytoplasm' in provided hdf5 file {conf.hdf5_path} is not a dataset."
-            )
+def rasterize_rois(lab_path: Path, shape: tuple[int, int]) -> np.ndarray:
+    rois = roiread(lab_path)
+    if isinstance(rois, ImagejRoi):
+        coords = rois.coordinates(multi=True)
+    else:
+        coords = [e for r in rois for e in r.coordinates(multi=True)]
+
+    labs = np.zeros(shape, dtype=label_dtype(len(coords)))
+    for i, xy in enumerate(coords):
+        # (x, y) ROI vertices to (row, column) coordinates
+        rc = np.asarray(xy)[:, [1, 0]]
+
+        # rasterize over the ROI bounding box (clipped to the sample) instead of the full sample
+        r0, c0 = np.maximum(np.floor(rc.min(axis=0)).astype(int), 0)
+        r1, c1 = np.minimum(np.ceil(rc.max(axis=0)).astype(int) + 1, shape)
+        if r0 >= r1 or c0 >= c1:
+            continue
+
+        # handle overlapping masks by overriding with new mask where masks overlap
+        view = labs[r0:r1, c0:c1]
+        view[polygon2mask(view.shape, rc - [r0, c0])] = i + 1
 
-        if conf.lab_path.suffix in (".roi", ".zip"):
+    return labs
 
-            def p2m(x) -> np.ndarray:
-                return polygon2mask(seg.shape, x[:, [1, 0]])
 
-            masks = roiread(conf.lab_path)
-            if isinstance(masks, ImagejRoi):
-                masks_iter = enumerate(masks.coordinates(multi=True))
+def run(conf: AddLabelConf):
+    if len(conf.sample) != len(conf.lab_path):
+        raise ValueError(
+            f"expected as many label files as samples, got {len(conf.lab_path)} label files for {len(conf.sample)} samples"
+        )
+
+    with H5File(conf.hdf5_path, "r+") as hf:
+        for sample, lab_path in zip(conf.sample, conf.lab_path):
+            grp = hf[sample]
+            if not isinstance(grp, Group):
+                raise ValueError(f"entry '{sample}' in provided hdf5 file {conf.hdf5_path} is not a group.")
+            seg = grp["channel: cytoplasm"]
+            if not isinstance(seg, Dataset):
+                raise ValueError(f"entry '{sample}/channel: cytoplasm' in provided hdf5 file {conf.hdf5_path} is not a dataset.")
+
+            print(f"sample={sample}: loading labels from {lab_path}", flush=True)
+            if lab_path.suffix in (".roi", ".zip"):
+                labs = rasterize_rois(lab_path, seg.shape)
+            elif lab_path.suffix == ".npy":
+                labs = np.load(lab_path)
+                labs = labs.astype(label_dtype(labs.max()), copy=False)
             else:
-                masks_iter = enumerate(e for r in masks for e in r.coordinates(multi=True))
-            labs = p2m(next(masks_iter)[1])
-            for i, e in masks_iter:
-                curr_mask = (p2m(e) * (i + 1)).astype(int)
-                # handle overlapping masks by overriding with new mask where masks overlap
-                labs = (labs * (curr_mask == 0)) + curr_mask
-        elif conf.lab_path.suffix == ".npy":
-            labs = np.load(conf.lab_path)
-        else:
-            raise ValueError(f"provided label file {conf.lab_path} is not of supported format")
-
-        grp.create_dataset("labels", data=labs)
+                raise ValueError(f"provided label file {lab_path} is not of supported format")
+
+            print(f"sample={sample}: writing labels (max label: {labs.max()})", flush=True)
+            grp.create_dataset(
+                "labels",
+                data=labs,
+                chunks=True,
+                compression="gzip",
+                shuffle=True,
+            )
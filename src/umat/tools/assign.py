@@ -1,73 +1,196 @@
+from pathlib import Path
 from warnings import catch_warnings
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import shapely
 from anndata import AnnData, ImplicitModificationWarning
-from scipy.sparse import csr_array
+from scipy.sparse import coo_array, csr_array
+from scipy.spatial import cKDTree
 
 from ..conf import AssignConf
+from ..memory import memory
+from ..profile import phase
+from ..transcripts import ROW_GROUP_SIZE, iter_transcripts, load_transcripts, transcript_count, transcript_genes, transcript_slices
 
+# bytes held per transcript of a z slice while assigning it (transcript table, coordinates, candidate cells, outputs)
+TRANSCRIPT_BYTES = 256
+# label value used for unassigned transcripts in compact output (mask label 0 is background)
+UNASSIGNED = 0
+COMPACT_SCHEMA = pa.schema(
+    [
+        ("transcript_index", pa.int64()),
+        ("x", pa.float32()),
+        ("y", pa.float32()),
+        ("z", pa.float32()),
+        ("gene", pa.dictionary(pa.int32(), pa.string())),
+        ("label", pa.uint32()),
+    ]
+)
 
-def run(conf: AssignConf):
-    print(f"loading cell boundary tables from {conf.b_paths}", flush=True)
-    cdf = gpd.GeoDataFrame(pd.concat(map(gpd.read_feather, conf.b_paths), ignore_index=True), geometry="coords")
 
-    print(f"loading detected transcripts table from {conf.dt_path}", flush=True)
-    tdf = pd.read_csv(
-        conf.dt_path,
-        usecols=["gene", "global_x", "global_y", "global_z"],  # pyright: ignore
-    )
-    tdf = (
-        gpd.GeoDataFrame(tdf[["gene", "global_z"]], geometry=gpd.points_from_xy(tdf["global_x"], tdf["global_y"]))
-        .rename_geometry("coords")
-        .reset_index(names="index_transcript")  # pyright: ignore
-    )
+# uniform grid over cell bounding boxes, used to find cells containing points
+# without having to build shapely geometries for the points themselves
+class CellIndex:
+    def __init__(self, geoms: np.ndarray):
+        self.geoms = geoms
+        shapely.prepare(geoms)
+        self.bounds = shapely.bounds(geoms)
+        cent = shapely.centroid(geoms)
+        self.cx, self.cy = shapely.get_x(cent), shapely.get_y(cent)
 
-    print("running spatial join between cells and transcripts", flush=True)
-    jdf = (
-        tdf.sjoin(
-            cdf,
-            on_attribute="global_z",  # pyright: ignore
-            predicate="within",
-        )[["index_right", "coords", "index_transcript", "gene"]]
-        .merge(
-            cdf.rename_geometry("cell"),
-            left_on="index_right",
-            right_index=True,
-        )
-        .assign(
-            distance=lambda x: x["cell"].centroid.distance(x["coords"]),
-            label=lambda x: x["label"].astype("Int64"),
+        # tile side of twice the median cell extent, keeping the amount of candidates per point low
+        ext = np.maximum(self.bounds[:, 2] - self.bounds[:, 0], self.bounds[:, 3] - self.bounds[:, 1])
+        self.side = max(float(np.median(ext)) * 2, 1e-6) if len(geoms) > 0 else 1.0
+        self.origin = self.bounds[:, :2].min(axis=0) if len(geoms) > 0 else np.zeros(2)
+
+        ix0, iy0 = self._tile(self.bounds[:, 0], self.bounds[:, 1])
+        ix1, iy1 = self._tile(self.bounds[:, 2], self.bounds[:, 3])
+        self.ntx = int(ix1.max()) + 1 if len(geoms) > 0 else 0
+        self.nty = int(iy1.max()) + 1 if len(geoms) > 0 else 0
+
+        # expand every cell into the (tile, cell) pairs covered by its bounding box, grouped by tile
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        cell = np.repeat(np.arange(len(geoms)), nx * ny)
+        k = np.arange(len(cell)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+        tile = (iy0[cell] + k // nx[cell]) * self.ntx + ix0[cell] + k % nx[cell]
+        order = np.argsort(tile, kind="stable")
+        self.tile_cells = cell[order]
+        self.tile_start = np.searchsorted(tile[order], np.arange(self.ntx * self.nty + 1))
+        # KD-tree over boundary vertices (and their cell indices), built by the first `nearest` query
+        self._tree: tuple[cKDTree, np.ndarray] | None = None
+
+    def _tile(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        return (
+            np.floor((x - self.origin[0]) / self.side).astype(np.int64),
+            np.floor((y - self.origin[1]) / self.side).astype(np.int64),
         )
-        .sort_values("distance")
-        .drop_duplicates("index_transcript")
-    )
 
-    print(f"saving assigned transcript table to {conf.ft_path}")
-    tdf.merge(jdf[["index_transcript", "label"]], how="left", on="index_transcript").set_index(
-        "index_transcript"
-    ).sort_index().rename_axis(index=None).to_feather(conf.ft_path)
+    def query(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (point index, cell index) pairs for every cell strictly containing a point
+        tx, ty = self._tile(x, y)
+        pt = np.flatnonzero((tx >= 0) & (tx < self.ntx) & (ty >= 0) & (ty < self.nty))
+        tile = ty[pt] * self.ntx + tx[pt]
+        start, cnt = self.tile_start[tile], self.tile_start[tile + 1] - self.tile_start[tile]
 
-    print("constructing count matrix", flush=True)
-    mtx = (
-        jdf.groupby(["label", "gene"])["gene"]
-        .count()
-        .to_frame(name="n")
-        .reset_index()
-        .pivot(index="label", columns="gene", values="n")
-        .fillna(0)
-        .astype(int)
-    )
+        pt = np.repeat(pt, cnt)
+        cell = self.tile_cells[np.repeat(start, cnt) + np.arange(len(pt)) - np.repeat(np.cumsum(cnt) - cnt, cnt)]
 
-    print("constructing anndata object", flush=True)
+        b = self.bounds[cell]
+        keep = (x[pt] >= b[:, 0]) & (x[pt] <= b[:, 2]) & (y[pt] >= b[:, 1]) & (y[pt] <= b[:, 3])
+        pt, cell = pt[keep], cell[keep]
+
+        keep = shapely.contains_xy(self.geoms[cell], x[pt], y[pt])
+        return pt[keep], cell[keep]
+
+    def assign(self, x: np.ndarray, y: np.ndarray, batch_size: int = 1 << 20) -> tuple[np.ndarray, np.ndarray]:
+        # index of the cell each point falls within (-1 if none), along with the distance to that cell's centroid.
+        # points within multiple cells are assigned to the one with the closest centroid
+        cell = np.full(len(x), -1, dtype=np.int64)
+        dist = np.full(len(x), np.nan, dtype=np.float64)
+        for b in range(0, len(x), batch_size):
+            pt, c = self.query(x[b : (b + batch_size)], y[b : (b + batch_size)])
+            d = np.hypot(self.cx[c] - x[b + pt], self.cy[c] - y[b + pt])
+            order = np.lexsort((d, pt))
+            first = order[np.r_[True, pt[order][1:] != pt[order][:-1]]] if len(order) > 0 else order
+            cell[b + pt[first]] = c[first]
+            dist[b + pt[first]] = d[first]
+        return cell, dist
+
+    def nearest(
+        self, x: np.ndarray, y: np.ndarray, max_dist: float, workers: int = 1, batch_size: int = 1 << 20
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # index of the cell with the closest boundary vertex within max_dist of each point (-1 if none),
+        # along with the distance to that vertex. boundaries are dense (pixel step) contours,
+        # so the closest vertex is a close approximation of the closest point on the boundary
+        cell = np.full(len(x), -1, dtype=np.int64)
+        dist = np.full(len(x), np.nan, dtype=np.float64)
+        if len(self.geoms) == 0 or len(x) == 0:
+            return cell, dist
+
+        if self._tree is None:
+            # built once per slice, and reused by the queries of every transcript batch of the slice
+            coords, vert_cell = shapely.get_coordinates(self.geoms, return_index=True)
+            self._tree = (cKDTree(coords), vert_cell)
+        tree, vert_cell = self._tree
+        for b in range(0, len(x), batch_size):
+            pts = np.column_stack([x[b : (b + batch_size)], y[b : (b + batch_size)]])
+            d, i = tree.query(pts, k=1, distance_upper_bound=max_dist, workers=workers)
+            # points without a vertex within max_dist get an infinite distance and an out of range index
+            found = np.isfinite(d)
+            cell[b + np.flatnonzero(found)] = vert_cell[i[found]]
+            dist[b + np.flatnonzero(found)] = d[found]
+        return cell, dist
+
+
+def read_assigned(path: Path, geometry: bool = False) -> pd.DataFrame:
+    # read a compact (`-c`) assigned transcripts file, optionally as a geopandas table with point geometries
+    df = pd.read_feather(path)
+    if not geometry:
+        return df
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["x"], df["y"])).rename_geometry("coords")
+
+
+def read_link(path: Path) -> tuple[np.ndarray, np.ndarray]:
+    # (sorted packed (global_z, label) keys, 3D cell of every key) from a `umat link` relabel map
+    mdf = pd.read_feather(path)
+    keys = link_keys(mdf["global_z"].to_numpy(), mdf["label"].to_numpy())
+    order = np.argsort(keys)
+    return keys[order], mdf["cell"].to_numpy(np.uint32)[order]
+
+
+def link_keys(z: np.ndarray | int, label: np.ndarray) -> np.ndarray:
+    return (np.asarray(z, dtype=np.uint64) << np.uint64(32)) | label.astype(np.uint64)
+
+
+def link_cells(link: tuple[np.ndarray, np.ndarray], z: int, label: np.ndarray) -> np.ndarray:
+    # 3D cell of every (z, label) pair, labels missing from the relabel map mean it was built from different masks
+    keys, cells = link
+    queries = link_keys(z, label)
+    idx = np.searchsorted(keys, queries)
+    found = idx < len(keys)
+    found[found] = keys[idx[found]] == queries[found]
+    if not found.all():
+        missing = np.unique(label[~found])
+        raise ValueError(f"z={z}: labels {missing[:10].tolist()} missing from the relabel map, expected one generated from the same masks")
+    return cells[idx]
+
+
+def count_matrix(label: np.ndarray, gene: np.ndarray, n_genes: int) -> tuple[np.ndarray, csr_array]:
+    # (sorted unique labels, label by gene count matrix) for assigned transcripts, summing duplicate pairs
+    labels, row = np.unique(label, return_inverse=True)
+    mtx = coo_array((np.ones(len(label), dtype=np.int64), (row, gene)), shape=(len(labels), n_genes)).tocsr()
+    return labels, mtx
+
+
+def to_anndata(labels: np.ndarray, mtx: csr_array, genes: pd.Index, partial: bool = False, linked: bool = False) -> AnnData:
+    # partial matrices keep every gene (including blanks) so that shards share the same columns
+    if not partial:
+        # only keep genes with at least one assigned transcript
+        observed = np.flatnonzero(mtx.sum(axis=0) > 0)
+        mtx = mtx[:, observed]
+        genes = genes[observed]
 
     with catch_warnings(action="ignore", category=ImplicitModificationWarning):
-        ad = AnnData(mtx)
+        ad = AnnData(
+            mtx,
+            obs=pd.DataFrame(index=pd.Index(labels.astype(str), name="cell" if linked else "label")),
+            var=pd.DataFrame(index=pd.Index(genes.astype(str), name="gene")),
+        )
+
+    if linked:
+        # observations are 3D cells from `umat link` rather than masks labels
+        ad.uns["linked"] = True
+    if partial:
+        ad.uns["partial"] = True
+        return ad
 
     # remove blanks from gene matrix, keep as obsm slot
     blank_filter = ad.var_names.str.startswith("Blank-")
     ad.obsm["blanks"] = pd.DataFrame(
-        ad[:, blank_filter].X,  # pyright: ignore
+        ad[:, blank_filter].X.toarray(),  # pyright: ignore
         index=ad.obs_names,
         columns=ad.var_names[blank_filter],
     )
@@ -75,6 +198,154 @@ def run(conf: AssignConf):
 
     # switch to CSR matrix for data storage
     ad.X = csr_array(ad.X)
+    return ad
+
+
+def run(conf: AssignConf):
+    # a z subset or tile restricts assignment to a single shard, whose counts are summed by `umat merge`
+    partial = conf.partial or conf.z_subset is not None or conf.tile is not None
+
+    slices = transcript_slices(conf.dt_path)
+    if conf.z_subset is not None:
+        slices = [z for z in slices if z in conf.z_subset]
+    if len(slices) == 0 and conf.z_subset is None:
+        raise ValueError(f"no transcripts found in {conf.dt_path}")
+    if len(slices) == 0:
+        # like an empty tile, a z subset without any transcripts still produces (empty) partial outputs
+        print(f"no transcripts found in {conf.dt_path} for z slices {conf.z_subset}", flush=True)
+    genes = transcript_genes(conf.dt_path)
+
+    print(f"loading cell boundary tables from {conf.b_paths}", flush=True)
+    with phase("load boundaries"):
+        cdf = gpd.GeoDataFrame(pd.concat(map(gpd.read_feather, conf.b_paths), ignore_index=True), geometry="coords")
+        if len(cdf) > 0 and cdf["label"].max() > np.iinfo(np.uint32).max:
+            raise ValueError(f"expected cell labels fitting in 32 bits, got a maximum label of {cdf['label'].max()}")
+        if conf.tile is not None:
+            # cells overlapping the tile (or within expansion distance of it) are the only ones its transcripts can be assigned to
+            tile = shapely.box(*conf.tile) if conf.expand is None else shapely.box(*conf.tile).buffer(conf.expand)
+            cdf = cdf[shapely.intersects(cdf.geometry.to_numpy(), tile)]
+
+    link = None
+    if conf.link_path is not None:
+        print(f"loading relabel map from {conf.link_path}", flush=True)
+        link = read_link(conf.link_path)
+
+    writer = None
+    if conf.compact:
+        # assignment distances are only recorded when expanding cells, 3D cells when linking labels
+        schema = COMPACT_SCHEMA if conf.expand is None else COMPACT_SCHEMA.append(pa.field("distance", pa.float32()))
+        schema = schema if link is None else schema.append(pa.field("cell", pa.uint32()))
+        print(f"writing assigned transcript table to {conf.ft_path}", flush=True)
+        writer = pa.ipc.new_file(conf.ft_path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+    legacy = []
+    counts = []
+
+    for z in slices:
+        cells = cdf[cdf["global_z"] == z]
+        with phase("point in polygon", z=z):
+            index = CellIndex(cells.geometry.to_numpy())
+
+        # slices whose transcripts do not fit in memory are assigned in batches, in the same order
+        n_rows = transcript_count(conf.dt_path, z)
+        batch_rows = memory.batch(n_rows, TRANSCRIPT_BYTES, minimum=ROW_GROUP_SIZE)
+        if batch_rows >= n_rows:
+            with phase("load transcripts", z=z):
+                batches = [load_transcripts(conf.dt_path, z=[z], bbox=conf.tile)]
+        else:
+            print(f"z={z}: transcripts exceed available memory, assigning batches of {batch_rows} transcripts", flush=True)
+            batches = iter_transcripts(conf.dt_path, z, bbox=conf.tile, batch_rows=batch_rows)
+
+        for tdf in batches:
+            codes = tdf["gene"].cat.codes.to_numpy(np.int32)
+            if len(tdf) > 0:
+                assert genes.equals(tdf["gene"].cat.categories), f"bug: inconsistent gene dictionary for z={z}"
+
+            print(f"z={z}: assigning {len(tdf)} transcripts to {len(cells)} cells", flush=True)
+            with phase("point in polygon", z=z):
+                x, y = tdf["global_x"].to_numpy(np.float64), tdf["global_y"].to_numpy(np.float64)
+                cell, _ = index.assign(x, y)
+                assigned = cell >= 0
+            if conf.expand is not None:
+                with phase("expand", z=z):
+                    # transcripts within a cell are at distance 0, others are assigned to the closest cell within range
+                    dist = np.where(assigned, 0.0, np.nan)
+                    out = np.flatnonzero(~assigned)
+                    near, near_dist = index.nearest(x[out], y[out], conf.expand, workers=conf.ncpus)
+                    cell[out], dist[out] = near, near_dist
+                    print(
+                        f"z={z}: assigned {np.count_nonzero(near >= 0)}/{len(out)} transcripts outside cells within {conf.expand}",
+                        flush=True,
+                    )
+                    assigned = cell >= 0
+            label = np.full(len(tdf), UNASSIGNED, dtype=np.uint32)
+            label[assigned] = cells["label"].to_numpy()[cell[assigned]]
+            if link is not None:
+                # counts are summed per 3D cell, unassigned transcripts get cell 0 like their label
+                cell_3d = np.full(len(tdf), UNASSIGNED, dtype=np.uint32)
+                cell_3d[assigned] = link_cells(link, z, label[assigned])
+                counts.append((cell_3d[assigned], codes[assigned]))
+            else:
+                counts.append((label[assigned], codes[assigned]))
+
+            with phase("write transcripts", z=z):
+                if writer is not None:
+                    cols = [
+                        pa.array(tdf["transcript_index"].to_numpy()),
+                        pa.array(tdf["global_x"].to_numpy(np.float32)),
+                        pa.array(tdf["global_y"].to_numpy(np.float32)),
+                        pa.array(np.full(len(tdf), z, dtype=np.float32)),
+                        pa.DictionaryArray.from_arrays(pa.array(codes), pa.array(genes, pa.string())),
+                        pa.array(label),
+                    ]
+                    if conf.expand is not None:
+                        cols.append(pa.array(dist.astype(np.float32), from_pandas=True))
+                    if link is not None:
+                        cols.append(pa.array(cell_3d))
+                    writer.write_batch(pa.record_batch(cols, schema=schema))
+                else:
+                    legacy_label = pd.array(label.astype(np.int64), dtype="Int64")
+                    legacy_label[~assigned] = pd.NA
+                    tdf = tdf[["transcript_index", "gene", "global_z", "global_x", "global_y"]].assign(label=legacy_label)
+                    if conf.expand is not None:
+                        tdf["distance"] = dist
+                    if link is not None:
+                        legacy_cell = pd.array(cell_3d.astype(np.int64), dtype="Int64")
+                        legacy_cell[~assigned] = pd.NA
+                        tdf["cell"] = legacy_cell
+                    legacy.append(tdf)
+
+    if writer is not None:
+        writer.close()
+    else:
+        with phase("write transcripts"):
+            print(f"saving assigned transcript table to {conf.ft_path}", flush=True)
+            # the default output keeps the column types of the original (CSV based) output, for existing readers
+            if not legacy:
+                # no slice to assign, an empty table with the columns of assigned transcripts
+                empty = load_transcripts(conf.dt_path, z=conf.z_subset, bbox=conf.tile)
+                legacy = [empty.assign(label=pd.array([], dtype="Int64"), distance=np.zeros(0), cell=pd.array([], dtype="Int64"))]
+            tdf = pd.concat(legacy, ignore_index=True).astype({"gene": object, "global_z": np.float64})
+            del legacy
+            columns = ["transcript_index", "gene", "global_z", "label"] + (["distance"] if conf.expand is not None else [])
+            columns += ["cell"] if link is not None else []
+            gpd.GeoDataFrame(
+                tdf[columns],
+                geometry=gpd.points_from_xy(tdf["global_x"], tdf["global_y"]),
+            ).rename_geometry("coords")[columns[:3] + ["coords"] + columns[3:]].set_index(
+                "transcript_index"
+            ).sort_index().rename_axis(index=None).to_feather(conf.ft_path)
+
+    print("constructing count matrix", flush=True)
+    with phase("count matrix"):
+        # shards without any transcripts (e.g. an empty tile) still produce an (empty) partial matrix
+        label = np.concatenate([c[0] for c in counts] or [np.zeros(0, np.uint32)])
+        gene = np.concatenate([c[1] for c in counts] or [np.zeros(0, np.int32)])
+        labels, mtx = count_matrix(label, gene, len(genes))
+
+    print("constructing anndata object", flush=True)
+    with phase("anndata"):
+        ad = to_anndata(labels, mtx, genes, partial=partial, linked=link is not None)
 
-    print(f"saving anndata to {conf.ad_path}", flush=True)
-    ad.write_h5ad(conf.ad_path)
+    print(f"saving {'partial ' if partial else ''}anndata to {conf.ad_path}", flush=True)
+    with phase("write h5ad"):
+        ad.write_h5ad(conf.ad_path)
@@ -0,0 +1,145 @@
+import json
+import os
+import platform
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from importlib import import_module
+from pathlib import Path
+from shutil import rmtree
+from time import perf_counter
+
+import numpy as np
+
+from .. import profile
+from ..conf import (
+    AssignConf,
+    BenchConf,
+    BoundaryConf,
+    FromProsegConf,
+    IngestConf,
+    PreviewConf,
+    SignalsConf,
+    SpotConf,
+)
+from ..memory import memory
+from ..mosaic import stack_mosaics
+from ..synth import generate, mosaic_fmt
+
+TASKS = ["segd ingestion", "fromproseg", "boundary", "ingest", "assign", "spot", "signals", "preview"]
+# tasks whose outputs are used by other tasks, which are run (without being recorded) even if not selected
+DEPS = {"assign": ["boundary", "ingest"], "spot": ["ingest"]}
+
+
+def segd_ingestion(data_dir: Path, n_z: int):
+    # the part of `umat segd` preceding cellpose evaluation, stacking mosaics into chunked zarr arrays
+    for c in ("PolyT", "DAPI"):
+        paths = [Path(mosaic_fmt(data_dir).format(c=c, z=z)) for z in range(n_z)]
+        stack_mosaics(paths, data_dir / "bench" / f"{c}.zarr", (n_z, 1024, 1024))
+
+
+def dispatch(command):
+    from ..__main__ import dispatch
+
+    dispatch(command)
+
+
+def timed(module: str | None, fn, *args) -> dict:
+    # executed in a fresh worker process, so that peak RSS only covers the task itself.
+    # the tool module is imported before timing the task, its import time being reported separately.
+    # tool output is discarded to keep the benchmark log readable
+    t0 = perf_counter()
+    if module is not None:
+        import_module("..__main__", __package__)
+        import_module(f".{module}", __package__)
+    import_s = perf_counter() - t0
+    profile.reset_peak_rss()
+    cpu0, t0 = profile.cpu_time(), perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        fn(*args)
+    t1, cpu1 = perf_counter(), profile.cpu_time()
+    return {"wall_s": t1 - t0, "cpu_s": cpu1 - cpu0, "peak_rss_bytes": profile.peak_rss(), "import_s": import_s}
+
+
+def tasks(data_dir: Path, paths: dict[str, Path], side: int, n_z: int) -> dict[str, tuple]:
+    # (tool module to import before timing, function, *arguments) of every task
+    out = data_dir / "bench"
+    fmt = mosaic_fmt(data_dir)
+    return {
+        "segd ingestion": (None, segd_ingestion, data_dir, n_z),
+        "fromproseg": (
+            "from_proseg",
+            dispatch,
+            FromProsegConf(paths["proseg"], side, side, paths["mp"], out / "proseg.zarr", no_cache=True),
+        ),
+        "boundary": ("boundary", dispatch, BoundaryConf(paths["masks"], out / "boundary.feather", paths["mp"])),
+        "ingest": ("ingest", dispatch, IngestConf(paths["dt"], force=True)),
+        "assign": (
+            "assign",
+            dispatch,
+            AssignConf([out / "boundary.feather"], out / "assign.h5ad", out / "assign.arrow", paths["dt"], compact=True),
+        ),
+        "spot": ("spot", dispatch, SpotConf(paths["dt"], out / "spot.h5ad", spot_side=20.0, z_micron_distance=1.5)),
+        "signals": ("signals", dispatch, SignalsConf(fmt, ["PolyT", "DAPI"], paths["masks"], out / "signals.tsv")),
+        "preview": ("preview", dispatch, PreviewConf(fmt, "PolyT", "DAPI", paths["masks"], 0, out / "preview.png")),
+    }
+
+
+def run(conf: BenchConf):
+    selected = set(TASKS if conf.tasks is None else conf.tasks)
+    if unknown := selected - set(TASKS):
+        raise ValueError(f"unknown benchmark task(s) {unknown}, expected any of: {', '.join(TASKS)}")
+    needed = selected | {d for t in selected for d in DEPS.get(t, [])}
+
+    results = []
+    for side in conf.sizes:
+        data_dir = conf.data_dir / f"side={side}_z={conf.n_z}_seed={conf.seed}"
+        print(f"side={side}: generating synthetic dataset in {data_dir}", flush=True)
+        start = perf_counter()
+        if data_dir.exists():
+            rmtree(data_dir)
+        paths = generate(data_dir, side, conf.n_z, transcripts_per_cell=conf.transcripts_per_cell, seed=conf.seed)
+        (data_dir / "bench").mkdir()
+        print(f"side={side}: generated dataset in {perf_counter() - start:.2f}s", flush=True)
+
+        n_cells = int(np.load(paths["npy"], mmap_mode="r").max())
+        with open(paths["dt"]) as f:
+            n_transcripts = sum(1 for _ in f) - 1
+        # every task runs in its own process, tasks are listed in dependency order (e.g. boundary before assign)
+        for task, args in tasks(data_dir, paths, side, conf.n_z).items():
+            if task not in needed:
+                continue
+            if task not in selected:
+                print(f"side={side}: running {task} (needed by selected tasks)", flush=True)
+                timed(*args)
+                continue
+            for rep in range(conf.repeats):
+                with ProcessPoolExecutor(1, max_tasks_per_child=1) as pool:
+                    res = pool.submit(timed, *args).result()
+                print(
+                    f"side={side}: {task} (repeat {rep}): {res['wall_s']:.3f}s wall, {res['cpu_s']:.3f}s CPU,"
+                    f" {res['peak_rss_bytes'] / (1 << 20):.0f}MiB peak RSS ({res['import_s']:.3f}s import)",
+                    flush=True,
+                )
+                results.append(
+                    {"task": task, "side": side, "n_z": conf.n_z, "n_cells": n_cells, "n_transcripts": n_transcripts}
+                    | {"repeat": rep}
+                    | res
+                )
+
+    print(f"saving benchmark results to {conf.out_path}", flush=True)
+    with open(conf.out_path, "w") as f:
+        json.dump(
+            {
+                "created": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                # tasks run within the `umat --max-memory` limit if provided
+                "max_memory_bytes": memory.limit,
+                "conf": {k: str(v) if isinstance(v, Path) else v for k, v in vars(conf).items()},
+                "results": results,
+            },
+            f,
+            indent=1,
+        )
@@ -1,23 +1,28 @@
 from functools import partial
 from multiprocessing import Pool
-from pathlib import Path
-from typing import Callable
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-import zarr
+import shapely
 from shapely import MultiPolygon, Polygon, union_all
 from shapely.affinity import affine_transform
 from shapely.validation import explain_validity
 from skimage.measure import find_contours, regionprops_table
 
 from ..conf import BoundaryConf
+from ..masks import MIN_ROWS, MaskReader, label_rows, row_bands
+from ..memory import memory
+from ..profile import phase
+
+# copies of a slice's size held while determining cell polygons (slice, regionprops labelling and bbox crops)
+SLICE_COPIES = 3
 
 
 def process_cell(
     z_slice: np.ndarray,
     tfm: list[float],
+    offset: tuple[int, int],
     props: tuple[np.int64, np.int64, np.int64, np.int64, np.int64],
 ) -> tuple[np.int64, MultiPolygon | None]:
     label, min_r, min_c, max_r, max_c = props
@@ -32,7 +37,7 @@ def process_cell(
 
     # generate list of polygons by:
     # - finding contour in bbox sub-region
-    # - returning to global array coordinates,
+    # - returning to global array coordinates (z_slice being a crop of the whole slice starting at offset),
     # - transforming into a valid shapely polygon (buffer to remove invalidating self-intersections)
     # early return None instead of geometry if:
     # - find_contours fails
@@ -41,7 +46,7 @@ def process_cell(
     try:
         polys = [
             Polygon(
-                (arr + [min_r, min_c])[
+                (arr + [min_r + offset[0], min_c + offset[1]])[
                     :,  #    inversion of second axis necessary since skimage.measure.find_contours returns array of (row,column) points,
                     ::-1,  # which corresponds to (y,x) points, but shapely.Polygon constructor expects an array of (x,y) points
                 ],
@@ -74,61 +79,160 @@ def process_cell(
     return (label, mp)
 
 
-def mk_table(z_slice: np.ndarray, z_idx: int, tfm: list[float], ncpus: int) -> pd.DataFrame:
-    print(f"z={z_idx}: determining region properties", flush=True)
-    props = list(zip(*regionprops_table(z_slice, properties=["label", "bbox"]).values()))
+def index_bboxes(index: pd.DataFrame, z_idx: int, min_r: int, min_c: int, labels: np.ndarray | None = None) -> np.ndarray:
+    # (label, min row, min column, max row, max column) of the cells of a slice from the label index,
+    # relative to a crop of the slice starting at (min_r, min_c)
+    index = index[index["z"] == z_idx]
+    if labels is not None:
+        index = index[index["label"].isin(labels)]
+    bboxes = index[["label", "y0", "x0", "y1", "x1"]].to_numpy(np.int64)
+    bboxes[:, [1, 3]] -= min_r
+    bboxes[:, [2, 4]] -= min_c
+    return bboxes
+
+
+def mk_table(
+    z_slice: np.ndarray,
+    z_idx: int,
+    tfm: list[float],
+    ncpus: int,
+    labels: np.ndarray | None = None,
+    bboxes: np.ndarray | None = None,
+    offset: tuple[int, int] = (0, 0),
+) -> pd.DataFrame:
+    if bboxes is not None:
+        # bounding boxes looked up in the label index (already restricted to the given labels)
+        props = list(map(tuple, bboxes))
+    else:
+        print(f"z={z_idx}: determining region properties", flush=True)
+        with phase("regionprops", z=z_idx):
+            table = regionprops_table(z_slice, properties=["label", "bbox"])
+            if labels is not None:
+                # only cells starting within a band, others are handled by their own band
+                keep = np.isin(table["label"], labels)
+                table = {k: v[keep] for k, v in table.items()}
+            props = list(zip(*table.values()))
 
     print(f"z={z_idx}: determining cell polygons", flush=True)
 
     # TODO: figure out why using multiprocessing doesn't provide any speedup
-    if ncpus > 1:
-        with Pool(ncpus) as p:
-            o = p.map(
-                partial(process_cell, z_slice, tfm),
-                props,
-                chunksize=round(len(props) / ncpus),
-            )
-    else:
-        o = list(map(partial(process_cell, z_slice, tfm), props))
+    with phase("contours", z=z_idx):
+        if ncpus > 1:
+            with Pool(ncpus) as p:
+                o = p.map(
+                    partial(process_cell, z_slice, tfm, offset),
+                    props,
+                    chunksize=round(len(props) / ncpus),
+                )
+        else:
+            o = list(map(partial(process_cell, z_slice, tfm, offset), props))
 
     print(f"z={z_idx}: saving cell polygons to table", flush=True)
 
-    return pd.DataFrame(
-        {
-            k: v
-            for k, v in zip(
-                ("label", "coords"),
-                # filter out elements where processing failed
-                zip(*filter(lambda t: t[1] is not None, o)),
-            )
-        }
-        | {"global_z": z_idx}
+    # filter out elements where processing failed
+    found = [t for t in o if t[1] is not None]
+    return pd.DataFrame({"label": [t[0] for t in found], "coords": [t[1] for t in found], "global_z": z_idx})
+
+
+def reduce_geoms(cdf: pd.DataFrame, z_idx: int, tolerance: float | None, grid_size: float | None) -> pd.DataFrame:
+    # simplify (topology preserving) and snap cell polygons to a coordinate grid, in bulk
+    if cdf.empty:
+        return cdf
+    geoms = cdf["coords"].to_numpy()
+    n_coords, n_bytes = shapely.get_num_coordinates(geoms).sum(), sum(map(len, shapely.to_wkb(geoms)))
+
+    if tolerance is not None:
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    if grid_size is not None:
+        geoms = shapely.set_precision(geoms, grid_size)
+
+    # both operations may turn multipolygons with a single remaining part into polygons, or collapse small cells
+    is_poly = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+    geoms[is_poly] = shapely.multipolygons(geoms[is_poly], indices=np.arange(np.count_nonzero(is_poly)))
+    keep = (shapely.get_type_id(geoms) == shapely.GeometryType.MULTIPOLYGON) & ~shapely.is_empty(geoms)
+    geoms = geoms[keep]
+
+    new_coords, new_bytes = shapely.get_num_coordinates(geoms).sum(), sum(map(len, shapely.to_wkb(geoms)))
+    print(
+        f"z={z_idx}: reduced cell polygons from {n_coords} to {new_coords} vertices, {n_bytes} to {new_bytes} bytes"
+        f" ({np.count_nonzero(~keep)} collapsed cells dropped)",
+        flush=True,
     )
-
-
-def mk_get(inp_path: Path) -> tuple[int, Callable[[int], np.ndarray]]:
-    if inp_path.suffix == ".zarr":
-        arr = zarr.open(str(inp_path), mode="r")
-        assert isinstance(arr, zarr.Array), f"expected input file {inp_path} to contain zarr.Array, got {type(arr)}"
-        get_fn = lambda z: arr[z, :, :]  # noqa: E731
-    else:
-        arr = np.load(inp_path, mmap_mode="r")
-        get_fn = lambda z: np.copy(arr[z, :, :])  # noqa: E731
-
-    return arr.shape[0], get_fn
+    return cdf[keep].assign(coords=geoms)
+
+
+def band_table(masks: MaskReader, z_idx: int, cols: slice, height: int, tfm: list[float], ncpus: int) -> pd.DataFrame:
+    # cell polygons computed over bands of rows, each holding all pixels of the cells starting within it,
+    # so that results are identical to the full slice computation while only loading a band at a time
+    with phase("label rows", z=z_idx):
+        labels, first, last = label_rows(masks, [z_idx])
+    tables = []
+    for band, idx in row_bands(first, last, height):
+        print(f"z={z_idx}: rows {band.start}-{band.stop}: slicing band of {len(idx)} cells", flush=True)
+        with phase("read masks", z=z_idx):
+            z_band = masks[z_idx, band, cols]
+        cells = None if (index := masks.index()) is None else index_bboxes(index, z_idx, band.start, cols.start, labels[idx])
+        tables.append(mk_table(z_band, z_idx, tfm, ncpus, labels[idx], cells, (band.start, cols.start)))
+    if not tables:
+        return pd.DataFrame({"label": [], "coords": [], "global_z": z_idx})
+    return pd.concat(tables).sort_values("label").reset_index(drop=True)
 
 
 def run(conf: BoundaryConf):
     print(f"loading micron to pixel transform from {conf.mp_path}", flush=True)
     tfm = np.linalg.inv(np.genfromtxt(conf.mp_path))[[0, 0, 1, 1, 0, 1], [0, 1, 0, 1, 2, 2]].tolist()
 
-    max_z, get = mk_get(conf.inp_path)
-    cdf = pd.DataFrame()
-    for z_idx in range(max_z) if conf.z_subset is None else conf.z_subset:
-        print(f"z={z_idx}: slicing 2D z slice of masks from {conf.inp_path}", flush=True)
-        z_slice = get(z_idx)
-
-        cdf = pd.concat([cdf, mk_table(z_slice, z_idx, tfm, conf.ncpus)])
+    with MaskReader(conf.inp_path, workers=conf.ncpus) as masks:
+        # use the label bounding boxes recorded by the masks writer (if present) to skip empty slices and crop to the labelled region
+        bboxes = masks.attrs.get("bbox")
+
+        def window(z: int) -> tuple | None:
+            if bboxes is None:
+                return (z,)
+            bb = bboxes[z]
+            return None if bb is None else (z, slice(bb[0], bb[2]), slice(bb[1], bb[3]))
+
+        z_idxs = list(range(masks.shape[0]) if conf.z_subset is None else conf.z_subset)
+        zdfs = []
+        for n, z_idx in enumerate(z_idxs):
+            if (win := window(z_idx)) is None:
+                print(f"z={z_idx}: masks file metadata reports no labels, skipping", flush=True)
+                continue
+
+            rows = slice(0, masks.shape[1]) if len(win) == 1 else win[1]
+            cols = slice(0, masks.shape[2]) if len(win) == 1 else win[2]
+            # the slice, along with the label masks and contours derived from it
+            height = memory.batch(
+                rows.stop - rows.start, (cols.stop - cols.start) * masks.dtype.itemsize * SLICE_COPIES, minimum=MIN_ROWS
+            )
+            if height < rows.stop - rows.start:
+                print(f"z={z_idx}: slice exceeds available memory, processing bands of {height} rows", flush=True)
+                zdf = band_table(masks, z_idx, cols, height, tfm, conf.ncpus)
+            else:
+                print(f"z={z_idx}: slicing 2D z slice of masks from {conf.inp_path}", flush=True)
+                with phase("read masks", z=z_idx):
+                    z_slice = masks[z_idx, rows, cols]
+
+                # decode the next slice in the background while polygons are generated for this one, if both fit in memory
+                next_win = window(z_idxs[n + 1]) if n + 1 < len(z_idxs) else None
+                if next_win is not None and memory.fits(z_slice.nbytes * (SLICE_COPIES + 1)):
+                    masks.prefetch(next_win)
+
+                cells = None if (index := masks.index()) is None else index_bboxes(index, z_idx, rows.start, cols.start)
+                zdf = mk_table(z_slice, z_idx, tfm, conf.ncpus, bboxes=cells, offset=(rows.start, cols.start))
+            if conf.simplify is not None or conf.precision is not None:
+                with phase("simplify", z=z_idx):
+                    zdf = reduce_geoms(zdf, z_idx, conf.simplify, conf.precision)
+            zdfs.append(zdf)
+
+    if zdfs:
+        cdf = gpd.GeoDataFrame(pd.concat(zdfs), geometry="coords")
+    else:
+        # every slice skipped, an empty table with the columns of cell tables
+        cdf = gpd.GeoDataFrame(
+            {"label": pd.Series(dtype=np.int64), "coords": gpd.GeoSeries(), "global_z": pd.Series(dtype=np.int64)}, geometry="coords"
+        )
 
     print(f"saving cell table to {conf.out_path}", flush=True)
-    gpd.GeoDataFrame(cdf, geometry="coords").to_feather(conf.out_path)
+    with phase("write feather"):
+        cdf.to_feather(conf.out_path)
@@ -1,36 +1,200 @@
 import gzip
+import json
+import re
+from collections.abc import Iterator
+from pathlib import Path
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from typing import TextIO
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import shapely as shp
-import zarr
 from skimage.draw import polygon2mask
 
 from ..conf import FromProsegConf
+from ..masks import label_dtype, write_masks
+from ..memory import memory
+from ..profile import phase
 
+# GeoParquet metadata for the per-layer cache files, geometries are kept in
+# proseg (micron) space so no CRS is recorded
+GEO_META = {
+    b"geo": json.dumps(
+        {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": [], "crs": None}},
+        }
+    ).encode()
+}
+LAYER_SCHEMA = pa.schema([("cell", pa.int64()), ("geometry", pa.binary())], metadata=GEO_META)
+# rough in-memory size of a decoded cell polygon feature (shapely geometry, coordinates and bookkeeping)
+FEATURE_BYTES = 4096
+# amount of features streamed without a cache between checks of the memory left for buffering more
+SPILL_BATCH = 65536
 
-def r2m(cell: int | np.integer, geom: shp.MultiPolygon, shape: tuple[int, int]) -> np.ndarray:
+
+def iter_features(fh: TextIO, bufsize: int = 1 << 22) -> Iterator[dict]:
+    # incrementally decode the members of the top-level "features" array,
+    # keeping at most one read buffer (plus one partially decoded feature) in memory
+    dec = json.JSONDecoder()
+    buf = ""
+    while (m := re.search(r'"features"\s*:\s*\[', buf)) is None:
+        chunk = fh.read(bufsize)
+        if not chunk:
+            raise ValueError("could not find 'features' array in provided geojson file")
+        buf += chunk
+
+    pos = m.end()
+    while True:
+        # skip separators between features
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == "]":
+            return
+
+        try:
+            if pos == len(buf):
+                raise json.JSONDecodeError("buffer exhausted", buf, pos)
+            feat, pos = dec.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            chunk = fh.read(bufsize)
+            if not chunk:
+                raise ValueError("unexpected end of geojson file while parsing features")
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        yield feat
+
+
+def open_geojson(path: Path) -> TextIO:
+    return gzip.open(path, "rt") if path.suffix == ".gz" else open(path)
+
+
+def append_layer(writers: dict[int, pq.ParquetWriter], out_dir: Path, layer: int, cells: list[int], geoms: list):
+    # append features to the GeoParquet file of their layer in out_dir, opening its writer on first use
+    if layer not in writers:
+        writers[layer] = pq.ParquetWriter(out_dir / f"layer={layer}.parquet", LAYER_SCHEMA, compression="zstd")
+    writers[layer].write_table(
+        pa.table({"cell": pa.array(cells, pa.int64()), "geometry": pa.array(shp.to_wkb(geoms), pa.binary())}, LAYER_SCHEMA)
+    )
+
+
+def cache_path(geojson_path: Path) -> Path:
+    return geojson_path.with_name(f"{geojson_path.name}.layers")
+
+
+def source_stamp(geojson_path: Path) -> dict[str, int]:
+    st = geojson_path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def cache_valid(geojson_path: Path, cache_dir: Path) -> bool:
+    stamp_path = cache_dir / "source.json"
+    if not stamp_path.is_file():
+        return False
+    with open(stamp_path) as f:
+        return json.load(f) == source_stamp(geojson_path)
+
+
+def build_cache(geojson_path: Path, cache_dir: Path, batch_size: int = 65536):
+    # write into a temporary directory first, so that an interrupted conversion never leaves behind a valid-looking cache
+    tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp")
+    if tmp_dir.exists():
+        rmtree(tmp_dir)
+    tmp_dir.mkdir()
+
+    writers: dict[int, pq.ParquetWriter] = {}
+    buffers: dict[int, tuple[list[int], list]] = {}
+
+    def flush(layer: int):
+        append_layer(writers, tmp_dir, layer, *buffers.pop(layer))
+
+    with open_geojson(geojson_path) as fh:
+        for n, feat in enumerate(iter_features(fh), start=1):
+            layer = int(feat["properties"]["layer"])
+            cells, geoms = buffers.setdefault(layer, ([], []))
+            cells.append(feat["properties"]["cell"])
+            geoms.append(shp.geometry.shape(feat["geometry"]))
+            if len(cells) >= batch_size:
+                flush(layer)
+            if n % 1_000_000 == 0:
+                print(f"converted {n} features", flush=True)
+
+    for layer in list(buffers):
+        flush(layer)
+    for w in writers.values():
+        w.close()
+
+    with open(tmp_dir / "source.json", "w") as f:
+        json.dump(source_stamp(geojson_path), f)
+
+    if cache_dir.exists():
+        rmtree(cache_dir)
+    tmp_dir.rename(cache_dir)
+
+
+def cached_layers(cache_dir: Path) -> list[int]:
+    return sorted(int(p.stem.removeprefix("layer=")) for p in cache_dir.glob("layer=*.parquet"))
+
+
+def read_layer(cache_dir: Path, layer: int) -> gpd.GeoDataFrame:
+    return gpd.read_parquet(cache_dir / f"layer={layer}.parquet")
+
+
+def read_uncached(geojson_path: Path, z_slice: int | None, tmp_parent: Path) -> Iterator[tuple[int, gpd.GeoDataFrame]]:
+    # stream features without writing a cache, dropping unwanted layers before building geometries.
+    # features are bucketed per layer, buckets being spilled to temporary per-layer files (within tmp_parent)
+    # whenever another batch of features would not fit in memory, so that only one layer is ever held at once
+    buffers: dict[int, tuple[list[int], list]] = {}
+    writers: dict[int, pq.ParquetWriter] = {}
+    with TemporaryDirectory(prefix=".umat-proseg-", dir=tmp_parent) as tmp:
+        tmp_dir = Path(tmp)
+        with open_geojson(geojson_path) as fh:
+            for n, feat in enumerate(iter_features(fh), start=1):
+                layer = int(feat["properties"]["layer"])
+                if z_slice is not None and layer != z_slice:
+                    continue
+                cells, geoms = buffers.setdefault(layer, ([], []))
+                cells.append(feat["properties"]["cell"])
+                geoms.append(shp.geometry.shape(feat["geometry"]))
+                if n % SPILL_BATCH == 0 and not memory.fits(SPILL_BATCH * FEATURE_BYTES):
+                    print(f"spilling {sum(len(c) for c, _ in buffers.values())} buffered features to {tmp_dir}", flush=True)
+                    for layer in list(buffers):
+                        append_layer(writers, tmp_dir, layer, *buffers.pop(layer))
+
+        for layer in sorted(buffers.keys() | writers.keys()):
+            cells, geoms = buffers.pop(layer, ([], []))
+            if layer not in writers:
+                yield layer, gpd.GeoDataFrame({"cell": pd.Series(cells, dtype=np.int64)}, geometry=geoms)
+                continue
+            if cells:
+                append_layer(writers, tmp_dir, layer, cells, geoms)
+            writers.pop(layer).close()
+            yield layer, read_layer(tmp_dir, layer)
+
+
+def r2m(geom: shp.MultiPolygon, shape: tuple[int, int]) -> np.ndarray:
     val_polys = []
     for pol in geom.geoms:
         pol = shp.make_valid(pol)
         assert isinstance(pol, shp.Polygon), f"expected Polygon when iterating over MultiPolygon, got {pol.wkt}"
         val_polys.append(polygon2mask(shape, np.array(pol.exterior.coords)[:, [1, 0]]))
 
-    return (np.logical_or.reduce(val_polys, axis=0) * cell).astype(int)
+    return np.logical_or.reduce(val_polys, axis=0)
 
 
 def process_zslice(df: pd.DataFrame, shape: tuple[int, int]) -> np.ndarray:
-    row_iter = df.itertuples()
-    row = next(row_iter)
-
-    # for type checker
-    assert isinstance(row.cell, int | np.integer)
-    assert isinstance(row.geometry, shp.MultiPolygon)
+    # allocate masks using the narrowest dtype able to hold every cell id of the slice
+    masks = np.zeros(shape, dtype=label_dtype(df["cell"].max() if len(df) > 0 else 0))
 
-    masks = r2m(row.cell, row.geometry, shape)
-
-    for row in row_iter:
+    for row in df.itertuples():
         # for type checker
         assert isinstance(row.cell, int | np.integer)
         assert isinstance(row.geometry, shp.MultiPolygon)
@@ -39,12 +203,12 @@ def process_zslice(df: pd.DataFrame, shape: tuple[int, int]) -> np.ndarray:
         x_min, y_min, x_max, y_max = map(round, geom.bounds)
 
         # create mask over bbox-bounded view of full z-slice
-        curr_mask = r2m(row.cell, shp.affinity.translate(geom, -x_min, -y_min), (y_max - y_min + 1, x_max - x_min + 1))
+        view = masks[y_min : (y_max + 1), x_min : (x_max + 1)]
+        curr_mask = r2m(shp.affinity.translate(geom, -x_min, -y_min), (y_max - y_min + 1, x_max - x_min + 1))
 
-        # add mask (accounting for overlapping masks) to full view
-        masks[y_min : (y_max + 1), x_min : (x_max + 1)] = (
-            masks[y_min : (y_max + 1), x_min : (x_max + 1)] * (curr_mask == 0)
-        ) + curr_mask
+        # add mask to full view (overriding previous masks where they overlap),
+        # cropping the part of the bbox that extends past the image edge
+        view[curr_mask[: view.shape[0], : view.shape[1]]] = row.cell
 
     return masks
 
@@ -53,35 +217,47 @@ def run(conf: FromProsegConf):
     print(f"loading micron to pixel transform from {conf.mp_path}", flush=True)
     tfm = np.genfromtxt(conf.mp_path)[[0, 0, 1, 1, 0, 1], [0, 1, 0, 1, 2, 2]].tolist()
 
-    print(f"loading proseg-generated cell polygons from {conf.geojson_path}", flush=True)
-    gdf = gpd.read_file(
-        gzip.open(conf.geojson_path) if conf.geojson_path.suffix == ".gz" else conf.geojson_path,
-        use_arrow=True,
-    )
+    if conf.no_cache:
+        print(f"streaming proseg-generated cell polygons from {conf.geojson_path}", flush=True)
+        layer_iter = read_uncached(conf.geojson_path, conf.z_slice, conf.out_path.parent)
+    else:
+        cache_dir = cache_path(conf.geojson_path)
+        if cache_valid(conf.geojson_path, cache_dir):
+            print(f"using cached per-layer cell polygons from {cache_dir}", flush=True)
+        else:
+            print(f"converting proseg-generated cell polygons from {conf.geojson_path} to per-layer cache {cache_dir}", flush=True)
+            with phase("build cache"):
+                build_cache(conf.geojson_path, cache_dir)
 
-    if conf.z_slice is not None:
-        gdf = gdf.loc[gdf.layer == conf.z_slice]
+        layers = cached_layers(cache_dir)
+        if conf.z_slice is not None:
+            if conf.z_slice not in layers:
+                raise ValueError(f"z={conf.z_slice} not present in {conf.geojson_path}, available layers: {layers}")
+            layers = [conf.z_slice]
+        layer_iter = ((i, read_layer(cache_dir, i)) for i in layers)
 
-    gdf.geometry = gdf.geometry.affine_transform(tfm)
+    crop = shp.box(0, 0, conf.x_shape, conf.y_shape)
 
-    # crop to size of image
-    gdf = gdf[gdf.within(shp.box(0, 0, conf.x_shape, conf.y_shape))]
+    stacks = []
+    for i, gdf_slice in layer_iter:
+        print(f"z={i}: loaded {len(gdf_slice)} cell polygons", flush=True)
+        with phase("transform", z=i):
+            gdf_slice.geometry = gdf_slice.geometry.affine_transform(tfm)
 
-    if conf.z_slice is None:
-        stacks = []
-        for i, gdf_slice in gdf.groupby("layer", sort=True):
-            print(f"z={i}: computing masks", flush=True)
+            # crop to size of image
+            gdf_slice = gdf_slice[gdf_slice.within(crop)]
+
+        print(f"z={i}: computing masks", flush=True)
+        with phase("rasterize", z=i):
             stacks.append(process_zslice(gdf_slice, (conf.y_shape, conf.x_shape)))
 
+    if conf.z_slice is None:
         print(f"generating 3D stack from {len(stacks)} detected z-slices", flush=True)
         masks = np.stack(stacks, axis=0)
     else:
-        print(f"z={conf.z_slice}: computing masks", flush=True)
-        masks = process_zslice(gdf, (conf.y_shape, conf.x_shape))
+        assert len(stacks) == 1, f"expected polygons for z={conf.z_slice} in {conf.geojson_path}, found none"
+        masks = stacks[0]
 
     print(f"saving {'3' if conf.z_slice is None else '2'}D masks file to {conf.out_path}", flush=True)
-    if conf.out_path.suffix == ".zarr":
-        zarr.save_array(str(conf.out_path), masks)
-    else:
-        with open(conf.out_path, "wb") as nf:
-            np.save(nf, masks)
+    with phase("write masks"):
+        write_masks(conf.out_path, masks, codec=conf.codec)
@@ -0,0 +1,9 @@
+from ..conf import IndexConf
+from ..masks import index_masks
+from ..profile import phase
+
+
+def run(conf: IndexConf):
+    print(f"indexing labels of {conf.inp_path}", flush=True)
+    with phase("index labels"):
+        index_masks(conf.inp_path, workers=conf.ncpus)
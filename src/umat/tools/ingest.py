@@ -0,0 +1,7 @@
+from ..conf import IngestConf
+from ..transcripts import ensure_cache
+
+
+def run(conf: IngestConf):
+    cache_dir = ensure_cache(conf.dt_path, force=conf.force)
+    print(f"columnar transcripts cache available at {cache_dir}", flush=True)
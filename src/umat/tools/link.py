@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from ..conf import LinkConf
+from ..masks import MaskReader
+from ..profile import phase
+from ..relabel import components, match, pair_keys, sparse_count
+
+
+def run(conf: LinkConf):
+    with MaskReader(conf.inp_path, workers=conf.ncpus) as masks:
+        if masks.dtype.itemsize > 4:
+            raise ValueError(f"expected masks with labels fitting in 32 bits, got dtype {masks.dtype}")
+        n_z, height, width = masks.shape
+        ch, cw = masks.chunks[1:]
+
+        # per slice label areas and per adjacent slice pair overlaps, streamed over the (y, x) chunk grid
+        # so that every chunk is decoded once and only two slices of a chunk are held at a time
+        areas: list[list[tuple[np.ndarray, np.ndarray]]] = [[] for _ in range(n_z)]
+        overlaps: list[list[tuple[np.ndarray, np.ndarray]]] = [[] for _ in range(n_z - 1)]
+        print(f"counting label overlaps between adjacent z slices of {conf.inp_path}", flush=True)
+        with phase("overlaps"):
+            for y0 in range(0, height, ch):
+                for x0 in range(0, width, cw):
+                    prev = None
+                    for z in range(n_z):
+                        curr = masks[z, y0 : y0 + ch, x0 : x0 + cw]
+                        lab = curr[curr != 0]
+                        areas[z].append(sparse_count(lab.astype(np.uint64)))
+                        if prev is not None:
+                            overlaps[z - 1].append(sparse_count(pair_keys(prev, curr)))
+                        prev = curr
+
+            # one node per (z, label) pair, numbered in (z, label) order
+            labels, sizes = [], []
+            for z in range(n_z):
+                lab, size = sparse_count(*(np.concatenate(a) for a in zip(*areas[z])))
+                labels.append(lab)
+                sizes.append(size)
+            offsets = np.r_[0, np.cumsum([len(lab) for lab in labels])]
+
+    print(f"linking {offsets[-1]} labels across {n_z} z slices (minimum intersection over union: {conf.threshold})", flush=True)
+    with phase("union find"):
+        src, dst = [], []
+        for z in range(n_z - 1):
+            key, inter = sparse_count(*(np.concatenate(a) for a in zip(*overlaps[z])))
+            ia, ib = match(key, inter, labels[z], sizes[z], labels[z + 1], sizes[z + 1], conf.threshold)
+            src.append(offsets[z] + ia)
+            dst.append(offsets[z + 1] + ib)
+            print(f"z={z}: linked {len(ia)} labels to z={z + 1}", flush=True)
+
+        roots = components(int(offsets[-1]), np.concatenate(src or [[]]), np.concatenate(dst or [[]]))
+        # 3D cell identifiers, numbered from 1 in order of their first (z, label) node
+        _, cell = np.unique(roots, return_inverse=True)
+        if len(cell) > 0 and cell.max() >= np.iinfo(np.uint32).max:
+            raise ValueError(f"expected 3D cells numbered within 32 bits, got {cell.max() + 1} cells")
+
+    mdf = pd.DataFrame(
+        {
+            "global_z": np.repeat(np.arange(n_z, dtype=np.int16), np.diff(offsets)),
+            "label": np.concatenate(labels).astype(np.uint32),
+            "cell": (cell + 1).astype(np.uint32),
+        }
+    )
+    spans = np.bincount(cell)
+    print(
+        f"linked {len(mdf)} labels into {len(spans)} 3D cells ({np.count_nonzero(spans > 1)} spanning multiple z slices)",
+        flush=True,
+    )
+
+    print(f"saving relabel map to {conf.out_path}", flush=True)
+    with phase("write map"):
+        mdf.to_feather(conf.out_path)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from anndata import read_h5ad
+from scipy.sparse import csr_array
+
+from ..conf import MergeConf
+from ..profile import phase
+from .assign import to_anndata
+
+
+def run(conf: MergeConf):
+    genes = None
+    linked = None
+    labels = []
+    mtxs = []
+    for path in conf.inp_paths:
+        print(f"loading partial anndata from {path}", flush=True)
+        with phase("read h5ad"):
+            ad = read_h5ad(path)
+        if not ad.uns.get("partial", False):
+            raise ValueError(f"expected partial anndata file generated by `umat assign -p`, got {path}")
+        # partials counted per 3D cell (`umat assign -l`) and per label can not be summed together
+        if linked is None:
+            linked = bool(ad.uns.get("linked", False))
+        elif linked != ad.uns.get("linked", False):
+            raise ValueError(f"expected all partial anndata files to be counted per 3D cell (`-l`) or none of them, got mismatch for {path}")
+        if genes is None:
+            genes = pd.Index(ad.var_names)
+        elif not genes.equals(ad.var_names):
+            raise ValueError(f"expected all partial anndata files to share the same genes, got mismatch for {path}")
+        labels.append(ad.obs_names.to_numpy().astype(np.int64))
+        mtxs.append(csr_array(ad.X).tocoo())
+
+    assert genes is not None, "no partial anndata files provided"
+
+    # cells split across shards appear in multiple partials, their counts are summed
+    print("summing partial count matrices", flush=True)
+    with phase("count matrix"):
+        row = np.concatenate([lab[m.row] for lab, m in zip(labels, mtxs)])
+        col = np.concatenate([m.col for m in mtxs])
+        data = np.concatenate([m.data for m in mtxs]).astype(np.int64)
+        cells, inv = np.unique(row, return_inverse=True)
+        mtx = csr_array((data, (inv, col)), shape=(len(cells), len(genes)))
+        mtx.sum_duplicates()
+
+        ad = to_anndata(cells, mtx, genes, linked=bool(linked))
+    print(f"saving anndata with {ad.n_obs} cells to {conf.ad_path}", flush=True)
+    with phase("write h5ad"):
+        ad.write_h5ad(conf.ad_path)
@@ -0,0 +1,244 @@
+import json
+import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
+from hashlib import sha256
+from pathlib import Path
+
+from .. import profile
+from ..conf import (
+    AssignConf,
+    BoundaryConf,
+    DistributedSegConf,
+    IngestConf,
+    MergeConf,
+    PipelineConf,
+    PreviewConf,
+    StitchConf,
+)
+from ..memory import memory
+from ..transcripts import cache_path
+
+
+# a single tool invocation in the pipeline, along with what it depends on:
+# - `inputs`: files/directories from outside the pipeline, fingerprinted by size and modification time
+# - `deps`: names of upstream stages, whose keys are included in this stage's key
+# - `outputs`: files/directories that must exist for a cached run of the stage to be reused
+# - `scratch`: temporary directories of the stage, cleared before every run so that reruns start from scratch
+@dataclass
+class Stage:
+    name: str
+    conf: object
+    inputs: list[Path] = field(default_factory=list)
+    deps: list[str] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+    scratch: list[Path] = field(default_factory=list)
+
+
+def fingerprint(path: Path) -> list:
+    # (relative path, size, mtime) of a file, or of every file within a directory (e.g. zarr arrays)
+    if path.is_dir():
+        return sorted(fingerprint(Path(root, f)) for root, _, files in os.walk(path) for f in files)
+    st = path.stat()
+    return [str(path), st.st_size, st.st_mtime_ns]
+
+
+def stage_key(stage: Stage, keys: dict[str, str]) -> str:
+    # hash of the stage config, its external inputs and the keys of the stages it depends on,
+    # such that any upstream change invalidates every downstream stage
+    record = {
+        "name": stage.name,
+        "tool": type(stage.conf).__name__,
+        "conf": asdict(stage.conf),  # pyright: ignore
+        "inputs": [fingerprint(p) for p in stage.inputs],
+        "deps": [keys[d] for d in stage.deps],
+    }
+    return sha256(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def record_path(out_dir: Path, stage: Stage) -> Path:
+    return out_dir / ".pipeline" / f"{stage.name}.json"
+
+
+def cached(out_dir: Path, stage: Stage, key: str) -> bool:
+    path = record_path(out_dir, stage)
+    if not path.is_file() or not all(p.exists() for p in stage.outputs):
+        return False
+    with open(path) as f:
+        return json.load(f)["key"] == key
+
+
+def write_record(out_dir: Path, stage: Stage, key: str):
+    with open(record_path(out_dir, stage), "w") as f:
+        json.dump({"key": key}, f)
+
+
+def mk_stages(conf: PipelineConf) -> list[Stage]:
+    out = conf.out_dir
+    stages = []
+
+    if conf.masks_path is None:
+        masks = out / "masks.zarr"
+        segd_tmp = out / "tmp" / "segd"
+        segd = DistributedSegConf(
+            img_fmt=conf.img_fmt,
+            cyt_pat=conf.cyt_pat,
+            nuc_pat=conf.nuc_pat,
+            z_slices=conf.z_slices,
+            out_path=masks,
+            tempdir=segd_tmp,
+            model_path=conf.model_path,
+            blockwise=True,
+        )
+        stages.append(
+            Stage(
+                "segd",
+                segd,
+                inputs=[Path(conf.img_fmt.format(c=c, z=z)) for c in (conf.cyt_pat, conf.nuc_pat) for z in conf.z_slices]
+                + ([conf.model_path] if conf.model_path is not None else []),
+                outputs=[masks],
+                scratch=[segd_tmp],
+            )
+        )
+        # cells are merged across segmentation blocks on CPU, relabelling the masks in place.
+        # as merged labels take the smallest label of their cell, a rerun after an interruption merges whatever is left
+        stages.append(
+            Stage(
+                "stitch",
+                StitchConf(masks, blocks=(segd.chunk_z, segd.chunk_x, segd.chunk_y), ncpus=conf.ncpus),
+                deps=["segd"],
+                outputs=[masks],
+            )
+        )
+        masks_inputs, masks_deps = [], ["stitch"]
+    else:
+        masks = conf.masks_path
+        masks_inputs, masks_deps = [masks], []
+
+    stages.append(Stage("ingest", IngestConf(conf.dt_path), inputs=[conf.dt_path], outputs=[cache_path(conf.dt_path)]))
+
+    for z in conf.z_slices:
+        bnd_path = out / "boundary" / f"z{z}.feather"
+        stages.append(
+            Stage(
+                f"boundary-z{z}",
+                BoundaryConf(masks, bnd_path, conf.mp_path, z_subset=[z], simplify=conf.simplify, precision=conf.precision),
+                inputs=masks_inputs + [conf.mp_path],
+                deps=masks_deps,
+                outputs=[bnd_path],
+            )
+        )
+
+        ft_path = out / "transcripts" / (f"z{z}.arrow" if conf.compact else f"z{z}.feather")
+        ad_path = out / "parts" / f"z{z}.h5ad"
+        stages.append(
+            Stage(
+                f"assign-z{z}",
+                AssignConf([bnd_path], ad_path, ft_path, conf.dt_path, compact=conf.compact, z_subset=[z], expand=conf.expand),
+                deps=[f"boundary-z{z}", "ingest"],
+                outputs=[ft_path, ad_path],
+            )
+        )
+
+        if conf.previews:
+            img_path = out / "preview" / f"z{z}.png"
+            stages.append(
+                Stage(
+                    f"preview-z{z}",
+                    PreviewConf(conf.img_fmt, conf.cyt_pat, conf.nuc_pat, masks, z, img_path),
+                    inputs=masks_inputs + [Path(conf.img_fmt.format(c=c, z=z)) for c in (conf.cyt_pat, conf.nuc_pat)],
+                    deps=masks_deps,
+                    outputs=[img_path],
+                )
+            )
+
+    stages.append(
+        Stage(
+            "merge",
+            MergeConf([out / "parts" / f"z{z}.h5ad" for z in conf.z_slices], out / "cells.h5ad"),
+            deps=[f"assign-z{z}" for z in conf.z_slices],
+            outputs=[out / "cells.h5ad"],
+        )
+    )
+    return stages
+
+
+def run_stage(stage: Stage) -> list[dict]:
+    # executed in a worker process, going through the same dispatch as the command line.
+    # returns the profiled phases of the stage (if profiling), to be merged into the main process profile
+    from ..__main__ import dispatch
+
+    print(f"stage={stage.name}: config: {stage.conf}", flush=True)
+    # drop any events inherited from the main process when forking
+    profile.collect()
+    with profile.phase(f"stage {stage.name}"):
+        dispatch(stage.conf)
+    return profile.collect()
+
+
+def limit_memory(limit: int | None):
+    memory.limit = limit
+
+
+def run(conf: PipelineConf):
+    stages = mk_stages(conf)
+    by_name = {s.name: s for s in stages}
+
+    # stages are listed after their dependencies, so keys can be computed in order
+    keys: dict[str, str] = {}
+    for stage in stages:
+        keys[stage.name] = stage_key(stage, keys)
+
+    for sub in ("boundary", "transcripts", "parts", "preview", ".pipeline"):
+        (conf.out_dir / sub).mkdir(parents=True, exist_ok=True)
+
+    done: set[str] = set()
+    running: dict[Future, str] = {}
+    ran, skipped = [], []
+    # every worker process gets an equal share of the memory limit, so that concurrent stages never exceed it together
+    share = None if memory.limit is None else memory.limit // conf.ncpus
+    with ProcessPoolExecutor(conf.ncpus, initializer=limit_memory, initargs=(share,)) as pool:
+        while len(done) < len(stages):
+            n_done = len(done)
+            for stage in stages:
+                if stage.name in done or stage.name in running.values() or not all(d in done for d in stage.deps):
+                    continue
+                if running and memory.pressure():
+                    # wait for running stages to release memory before starting others
+                    break
+                if not conf.force and cached(conf.out_dir, stage, keys[stage.name]):
+                    print(f"stage={stage.name}: up to date, skipping", flush=True)
+                    skipped.append(stage.name)
+                    done.add(stage.name)
+                    continue
+                # drop the previous record first, so that an interrupted run is never considered up to date
+                record_path(conf.out_dir, stage).unlink(missing_ok=True)
+                # leftovers of a previous (possibly interrupted) run would make the stage fail on existing files
+                for path in stage.scratch:
+                    shutil.rmtree(path, ignore_errors=True)
+                print(f"stage={stage.name}: starting", flush=True)
+                running[pool.submit(run_stage, stage)] = stage.name
+
+            if len(running) == 0:
+                # skipped stages may have unlocked new ones, which are picked up by the next iteration
+                assert len(done) > n_done, f"bug: no runnable stages left, remaining: {set(by_name) - done}"
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                if (exc := fut.exception()) is not None:
+                    # let already running stages finish, so that their outputs and records stay consistent
+                    for other in wait(running).done:
+                        if other.exception() is None:
+                            write_record(conf.out_dir, by_name[running[other]], keys[running[other]])
+                    raise RuntimeError(f"pipeline stage {name} failed") from exc
+
+                write_record(conf.out_dir, by_name[name], keys[name])
+                profile.merge(fut.result())
+                print(f"stage={name}: done", flush=True)
+                ran.append(name)
+                done.add(name)
+
+    print(f"pipeline finished, ran {len(ran)} stage(s), skipped {len(skipped)} up to date stage(s)", flush=True)
@@ -1,11 +1,12 @@
 from pathlib import Path
 
 import numpy as np
-import zarr
 from PIL import Image
-from tifffile import imread
 
 from ..conf import PreviewConf
+from ..masks import MaskReader
+from ..mosaic import read_mosaic
+from ..profile import phase
 
 
 def rescale_uint8(arr: np.ndarray) -> np.ndarray:
@@ -19,33 +20,34 @@ def run(conf: PreviewConf):
     nuc_path = Path(conf.inp_fmt.format(c=conf.nuc_pat, z=conf.masks_z))
 
     print(f"building green channel using {cyt_path}", flush=True)
-    green = imread(cyt_path, aszarr=False)
+    with phase("read images"):
+        green = read_mosaic(cyt_path)
     print(f"building blue channel using {nuc_path}", flush=True)
-    blue = imread(nuc_path, aszarr=False)
+    with phase("read images"):
+        blue = read_mosaic(nuc_path)
 
     assert blue.dtype == green.dtype, ValueError(
         f"datatype for cytoplasm image ({green.dtype}) and nuclear image ({blue.dtype}) must be identical"
     )
 
-    if conf.seg_masks.suffix == ".zarr":
-        arr_c = zarr.open(str(conf.seg_masks), mode="r")
-        assert isinstance(arr_c, zarr.Array), f"expected input file {conf.seg_masks} to contain zarr.Array, got {type(arr_c)}"
-    else:
-        arr_c = np.load(conf.seg_masks, mmap_mode="r")
-
     print(f"building red channel using masks, loaded from {conf.seg_masks} (z={conf.masks_z})", flush=True)
-    red = ((arr_c[conf.masks_z, :, :] != 0) * 255).astype(np.uint8)
+    with phase("read masks"):
+        with MaskReader(conf.seg_masks) as masks:
+            red = ((masks[conf.masks_z] != 0) * 255).astype(np.uint8)
 
     print("rescaling green and blue channels, switching to uint8 dtype", flush=True)
-    green = rescale_uint8(green)
-    blue = rescale_uint8(blue)
+    with phase("blend"):
+        green = rescale_uint8(green)
+        blue = rescale_uint8(blue)
 
     print(f"building output image, blending with alpha={conf.blend}", flush=True)
-    img = Image.blend(
-        Image.merge("RGB", [Image.fromarray(a) for a in (np.zeros(red.shape, np.uint8), green, blue)]),
-        Image.merge("RGB", [Image.fromarray(a) for a in (red, np.zeros(red.shape, np.uint8), np.zeros(red.shape, np.uint8))]),
-        conf.blend,
-    )
+    with phase("blend"):
+        img = Image.blend(
+            Image.merge("RGB", [Image.fromarray(a) for a in (np.zeros(red.shape, np.uint8), green, blue)]),
+            Image.merge("RGB", [Image.fromarray(a) for a in (red, np.zeros(red.shape, np.uint8), np.zeros(red.shape, np.uint8))]),
+            conf.blend,
+        )
 
     print(f"saving output image to {conf.out_path}", flush=True)
-    img.save(conf.out_path)
+    with phase("write image"):
+        img.save(conf.out_path)
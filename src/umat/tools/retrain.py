@@ -1,61 +1,187 @@
+from math import ceil
+from shutil import move
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
 import numpy as np
+import torch
+from cellpose.dynamics import labels_to_flows
 from cellpose.io import logger_setup
 from cellpose.models import CellposeModel
 from cellpose.train import train_seg
-from h5py import Dataset, Group
+from cellpose.transforms import random_rotate_and_resize
+from cellpose.utils import diameters
 from h5py import File as H5File
 
 from ..conf import RetrainConf
+from ..trainset import CYT_KEY, LAB_KEY, NUC_KEY, CropLoader, get_ds, labelled_samples
+
+
+# same as the `min_train_masks` default of `cellpose.train.train_seg`, below which samples are left out of training
+MIN_TRAIN_MASKS = 5
+# side of the crops read by the streaming loader relative to the training crop side, leaving room for the random
+# scaling (down to 0.75x) and rotation of `random_rotate_and_resize`, which picks the training crop within them
+CROP_SCALE = 2
+
+
+def crop_loader(conf: RetrainConf, names: list[str] | None = None) -> CropLoader:
+    # no intensity jitter, as `train_seg` does not augment intensities
+    return CropLoader(conf.train_file, CROP_SCALE * conf.bsize, conf.batch_size, conf.workers, jitter=0.0, names=names)
+
+
+def bench_loader(conf: RetrainConf, n_batches: int):
+    with crop_loader(conf) as loader:
+        batches = iter(loader)
+        # first batch includes worker startup, exclude it from timing
+        next(batches)
+        start = perf_counter()
+        for _ in range(n_batches):
+            next(batches)
+        elapsed = perf_counter() - start
+
+    print(
+        f"loader throughput: {n_batches * conf.batch_size / elapsed:.1f} samples/s"
+        f" ({n_batches} batches of {conf.batch_size} {loader.side}x{loader.side} crops in {elapsed:.2f}s, {conf.workers} workers)",
+        flush=True,
+    )
+
+
+def lr_schedule(learning_rate: float, n_epochs: int) -> np.ndarray:
+    # same warmup/decay schedule as `cellpose.train.train_seg`
+    lr = np.linspace(0, learning_rate, 10)
+    lr = np.append(lr, learning_rate * np.ones(max(0, n_epochs - 10)))
+    if n_epochs > 300:
+        lr = lr[:-100]
+        for _ in range(10):
+            lr = np.append(lr, lr[-1] / 2 * np.ones(10))
+    elif n_epochs > 99:
+        lr = lr[:-50]
+        for _ in range(10):
+            lr = np.append(lr, lr[-1] / 2 * np.ones(5))
+    return lr
+
+
+def seg_loss(lbl: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    # same loss as `cellpose.train.train_seg` (not part of cellpose's public API):
+    # mean squared error of the (5x scaled) flows plus binary cross entropy of the cell probability
+    flow_loss = torch.nn.functional.mse_loss(y[:, -3:-1], 5.0 * lbl[:, -2:]) / 2.0
+    prob_loss = torch.nn.functional.binary_cross_entropy_with_logits(y[:, -1], (lbl[:, -3] > 0.5).to(y.dtype))
+    return flow_loss + prob_loss
+
+
+def label_stats(conf: RetrainConf) -> tuple[list[str], float]:
+    # samples with enough masks to train on and their mean cell diameter (each at least 5 pixels), the way `train_seg`
+    # selects training images and sets the network's `diam_labels`. labels are read one sample at a time
+    names, diams = [], []
+    with H5File(conf.train_file, "r") as hf:
+        for name in labelled_samples(hf):
+            diam, counts = diameters(get_ds(hf[name], LAB_KEY)[:])
+            if len(counts) >= MIN_TRAIN_MASKS:
+                names.append(name)
+                diams.append(max(diam, 5.0))
+    if len(names) == 0:
+        raise ValueError(f"no samples with at least {MIN_TRAIN_MASKS} labelled cells found in {conf.train_file}")
+    print(f"training on {len(names)} samples with at least {MIN_TRAIN_MASKS} labelled cells", flush=True)
+    return names, float(np.mean(diams))
+
+
+def train_streaming(model: CellposeModel, conf: RetrainConf):
+    net = model.net
+    device = net.device
+
+    names, diam = label_stats(conf)
+    net.diam_labels.data = torch.Tensor([diam]).to(device)
+
+    original_dtype = net.dtype
+    if net.dtype == torch.bfloat16:
+        net.dtype = torch.float32
+
+    lr = lr_schedule(conf.learning_rate, conf.n_epochs)
+    optimizer = torch.optim.AdamW(net.parameters(), lr=conf.learning_rate, weight_decay=conf.weight_decay)
+
+    with crop_loader(conf, names) as loader:
+        n_batches = ceil(len(loader) / conf.batch_size)
+        batches = iter(loader)
+        for epoch in range(conf.n_epochs):
+            # `random_rotate_and_resize` draws from numpy's global generator, seeded per epoch as by `train_seg`
+            np.random.seed(epoch)
+            for group in optimizer.param_groups:
+                group["lr"] = lr[epoch]
+            net.train()
+
+            epoch_loss = 0.0
+            for _ in range(n_batches):
+                imgs, labs = next(batches)
+                # flows of the (flipped/transposed) crops, which are then scaled, rotated and cropped to the training
+                # crop side along with the images, the same augmentation `train_seg` applies to whole samples
+                flows = labels_to_flows(list(labs), device=device)
+                x, lbl = random_rotate_and_resize(
+                    list(imgs), lbls=[f[1:] for f in flows], scale_range=0.5, bsize=conf.bsize, device=device
+                )[:2]
 
+                with torch.autocast(device_type=device.type, dtype=net.dtype):
+                    y = net(x)[0]
+                loss = seg_loss(lbl, y)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                epoch_loss += loss.item()
 
-def get_ds(grp: Group, key: str) -> np.ndarray:
-    o = grp[key]
-    if not isinstance(o, Dataset):
-        raise ValueError(f"expected key {key} for group {grp} to be dataset, got {o}")
-    return o[:]
+            print(f"epoch={epoch}: train_loss={epoch_loss / n_batches:.4f}, lr={lr[epoch]:.6f}", flush=True)
+
+    print(f"saving model weights to {conf.out_path}", flush=True)
+    net.save_model(str(conf.out_path))
+    net.dtype = original_dtype
 
 
 def run(conf: RetrainConf):
+    if conf.bench_batches is not None:
+        bench_loader(conf, conf.bench_batches)
+        return
+
     logger_setup()
 
-    if conf.model_path is None:
-        model = CellposeModel(gpu=True, pretrained_model=str(conf.model_path))  # pyright: ignore
+    if conf.model_path is not None:
+        model = CellposeModel(gpu=True, pretrained_model=str(conf.model_path))
     else:
         model = CellposeModel(gpu=True)
 
-    with H5File(conf.train_file, "r") as hf:
-        samples = [grp for grp in hf.values() if isinstance(grp, Group) and "labels" in grp]
+    if conf.streaming:
+        train_streaming(model, conf)
+        return
 
-        images = []
+    with H5File(conf.train_file, "r") as hf:
+        samples = labelled_samples(hf)
+        images: dict[str, np.ndarray] = {}
         labels = []
 
-        for sample in samples:
-            if "channel: cytoplasm" not in sample.keys():
-                raise ValueError(f"expected sample to have a cytoplasm channel, got: {sample}")
-            if "channel: nuclear" not in sample.keys():
-                raise ValueError(f"expected sample to have a nuclear channel, got: {sample}")
-
-            cyt_chan = get_ds(sample, "channel: cytoplasm")
-            nuc_chan = get_ds(sample, "channel: nuclear")
-            if cyt_chan.size != nuc_chan.size:
-                raise ValueError(f"expected channels to have same size, got: {cyt_chan.size} (cyt) vs {nuc_chan.size} (nuc)")
-
-            labs = get_ds(sample, "labels")
-
-            if cyt_chan.size != labs.size:
-                raise ValueError(
-                    f"expected channels and labels to have same size, got: {cyt_chan.size} (chan) vs {labs.size} (labs)"
-                )
-
-            images.append(np.stack([cyt_chan, nuc_chan, cyt_chan * 0], axis=-1))
-            labels.append(labs)
-
-    train_seg(
-        model.net,
-        train_data=images,
-        train_labels=labels,
-        weight_decay=conf.weight_decay,
-        learning_rate=conf.learning_rate,
-        n_epochs=conf.n_epochs,
-        save_path=conf.out_path,
-    )
+        # samples of the same shape/dtype are read into a single (n, h, w, 3) array, whose third (zero) channel is
+        # only initialized once, on allocation. images passed to cellpose are views into it
+        groups: dict[tuple, list[str]] = {}
+        for name, shape in samples.items():
+            groups.setdefault((shape, get_ds(hf[name], CYT_KEY).dtype), []).append(name)
+        for (shape, dtype), names in groups.items():
+            stack = np.zeros((len(names), *shape, 3), dtype=dtype)
+            for i, name in enumerate(names):
+                stack[i, ..., 0] = get_ds(hf[name], CYT_KEY)[:]
+                stack[i, ..., 1] = get_ds(hf[name], NUC_KEY)[:]
+                images[name] = stack[i]
+
+        for name in samples:
+            labels.append(get_ds(hf[name], LAB_KEY)[:])
+
+    # cellpose saves weights under `<save_path>/models/<model_name>` (checkpointing during training),
+    # trained into a temporary directory so that both training modes write the weights file to the output path
+    with TemporaryDirectory(dir=conf.out_path.parent) as tmp:
+        weights, *_ = train_seg(
+            model.net,
+            train_data=[images[name] for name in samples],
+            train_labels=labels,
+            weight_decay=conf.weight_decay,
+            learning_rate=conf.learning_rate,
+            n_epochs=conf.n_epochs,
+            save_path=tmp,
+            model_name=conf.out_path.name,
+        )
+        print(f"saving model weights to {conf.out_path}", flush=True)
+        move(weights, conf.out_path)
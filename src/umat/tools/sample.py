@@ -1,47 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from random import randint
+from random import choice, randint
 
+import numpy as np
 from h5py import File as H5File
-from tifffile import imread
 
 from ..conf import SampleConf
+from ..mosaic import open_mosaic
 
+# amount of samples read before being written out together
+BATCH_SIZE = 32
 
-def run(conf: SampleConf):
-    cyt_path = Path(conf.inp_fmt.format(c=conf.cyt_pat))
 
-    print(f"reading segementation image from path {cyt_path}", flush=True)
-    cyt_arr = imread(cyt_path, aszarr=False)
+def run(conf: SampleConf):
+    channels = {"cytoplasm": conf.cyt_pat, "nuclear": conf.nuc_pat} | {c: c for c in conf.channels}
+    z_slices = [None] if conf.z_slices is None else conf.z_slices
+
+    # open every (z, channel) mosaic lazily, only sampled windows get read from disk
+    mosaics = {}
+    for z in z_slices:
+        for name, pat in channels.items():
+            path = Path(conf.inp_fmt.format(c=pat, z=z))
+            print(f"z={z}: opening {name} channel image from path {path}", flush=True)
+            mosaics[z, name] = open_mosaic(path)
+
+    shape = mosaics[z_slices[0], "cytoplasm"].shape
+    for (z, name), arr in mosaics.items():
+        assert arr.shape == shape, (
+            f"z={z}: {name} image shape {arr.shape[1]}x{arr.shape[0]} different from cytoplasm image shape {shape[1]}x{shape[0]}"
+        )
 
     # sanity check re: sampling size vs image size
-    assert cyt_arr.shape[1] >= conf.width, (
-        f"cytoplasm image width {cyt_arr.shape[1]} is less than provided sample width {conf.width}"
-    )
-    assert cyt_arr.shape[1] >= conf.width, (
-        f"cytoplasm image height {cyt_arr.shape[0]} is less than provided sample height {conf.height}"
-    )
-
-    nuc_path = Path(conf.inp_fmt.format(c=conf.nuc_pat))
-    print(f"reading nuclear image from path {nuc_path}", flush=True)
-    nuc_arr = imread(nuc_path, aszarr=False)
-    assert cyt_arr.shape == nuc_arr.shape, (
-        f"cytoplasm image shape {cyt_arr.shape[1]}x{cyt_arr.shape[0]} different from nuclear image shape {nuc_arr.shape[1]}x{nuc_arr.shape[0]}"
-    )
-
-    with H5File(conf.out_path, "a") as hf:
-        for i in range(conf.amount):
-            min_x = randint(0, cyt_arr.shape[1] - conf.width)
-            min_y = randint(0, cyt_arr.shape[0] - conf.height)
-
-            print(f"n={i}: creating group", flush=True)
-            sample_grp = hf.create_group(conf.sample_fmt.format(i=i))
-
-            print(f"n={i}: writing cytoplasm channel data", flush=True)
-            sample_grp.create_dataset(
-                "channel: cytoplasm", data=cyt_arr[min_y : (min_y + conf.height), min_x : (min_x + conf.width)]
-            )
-
-            print(f"n={i}: writing nuclear channel data", flush=True)
-            sample_grp.create_dataset(
-                "channel: nuclear", data=nuc_arr[min_y : (min_y + conf.height), min_x : (min_x + conf.width)]
-            )
+    assert shape[1] >= conf.width, f"image width {shape[1]} is less than provided sample width {conf.width}"
+    assert shape[0] >= conf.height, f"image height {shape[0]} is less than provided sample height {conf.height}"
+
+    samples = [
+        (i, choice(z_slices), randint(0, shape[1] - conf.width), randint(0, shape[0] - conf.height))
+        for i in range(conf.amount)
+    ]
+
+    def read(sample: tuple[int, int | None, int, int]) -> dict[str, np.ndarray]:
+        _, z, min_x, min_y = sample
+        return {
+            name: np.asarray(mosaics[z, name][min_y : (min_y + conf.height), min_x : (min_x + conf.width)])
+            for name in channels
+        }
+
+    with H5File(conf.out_path, "a") as hf, ThreadPoolExecutor(conf.ncpus) as pool:
+        for b in range(0, len(samples), BATCH_SIZE):
+            batch = samples[b : (b + BATCH_SIZE)]
+            print(f"n={batch[0][0]}-{batch[-1][0]}: reading sample windows", flush=True)
+            for (i, z, _, _), windows in zip(batch, pool.map(read, batch)):
+                print(f"n={i}: writing group (z={z})", flush=True)
+                sample_grp = hf.create_group(conf.sample_fmt.format(i=i, z=z))
+                for name, data in windows.items():
+                    sample_grp.create_dataset(f"channel: {name}", data=data, chunks=True, compression="gzip", shuffle=True)
@@ -0,0 +1,125 @@
+import gc
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from importlib import import_module
+from time import perf_counter
+
+from ..__main__ import SERVER_ENV, execute
+from ..cache import datasets
+from ..conf import ServeConf
+from ..memory import memory
+
+# tool modules imported up front, so that their (heavy) dependencies are loaded once for all requests.
+# tools whose dependencies are missing (e.g. cellpose on CPU-only nodes) are still run on request, failing as usual
+TOOLS = [
+    "addlab",
+    "assign",
+    "bench",
+    "boundary",
+    "from_proseg",
+    "index",
+    "ingest",
+    "link",
+    "merge",
+    "pipeline",
+    "preview",
+    "retrain",
+    "sample",
+    "segd",
+    "signals",
+    "spot",
+    "stitch",
+]
+
+
+class SocketWriter(io.TextIOBase):
+    # text stream forwarding every write to the client as a JSON line
+    def __init__(self, conn: socket.socket, stream: str):
+        self.conn = conn
+        self.stream = stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if s:
+            self.conn.sendall((json.dumps({"out": s, "stream": self.stream}) + "\n").encode())
+        return len(s)
+
+
+def exit_code(e: SystemExit) -> int:
+    if e.code is None:
+        return 0
+    return e.code if isinstance(e.code, int) else 1
+
+
+def handle(conn: socket.socket):
+    with conn.makefile("r", encoding="utf-8") as f:
+        req = json.loads(f.readline())
+
+    cwd, limit = os.getcwd(), memory.limit
+    start = perf_counter()
+    out, err = SocketWriter(conn, "stdout"), SocketWriter(conn, "stderr")
+    try:
+        os.chdir(req["cwd"])
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                execute(req["argv"])
+                code = 0
+            except SystemExit as e:
+                code = exit_code(e)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+    finally:
+        os.chdir(cwd)
+        # requests passing `--max-memory` only override the server's own limit for their duration
+        memory.limit = limit
+        # release what the command allocated before waiting for the next request, cached datasets are kept
+        gc.collect()
+
+    print(
+        f"request {req['argv']}: exit code {code} after {perf_counter() - start:.2f}s,"
+        f" cache holds {len(datasets)} dataset(s) ({datasets.size / (1 << 20):.0f}MiB)",
+        flush=True,
+    )
+    conn.sendall((json.dumps({"exit": code}) + "\n").encode())
+
+
+def run(conf: ServeConf):
+    start = perf_counter()
+    for tool in TOOLS:
+        try:
+            import_module(f".{tool}", __package__)
+        except ImportError as e:
+            print(f"not preloading {tool} tool: {e}", flush=True)
+    print(f"preloaded tools in {perf_counter() - start:.2f}s", flush=True)
+
+    datasets.budget = conf.cache_mib << 20
+
+    # exit cleanly (removing the socket file) when terminated, e.g. on SLURM job end
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # a socket file left behind by a server that did not shut down cleanly
+    conf.socket_path.unlink(missing_ok=True)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(conf.socket_path))
+        server.listen()
+        print(f"serving on {conf.socket_path}, set {SERVER_ENV}={conf.socket_path} to forward invocations", flush=True)
+        try:
+            # requests are handled one at a time, others wait in the listen backlog
+            while True:
+                conn, _ = server.accept()
+                with conn:
+                    try:
+                        handle(conn)
+                    except (OSError, ValueError) as e:
+                        # client gone (e.g. interrupted) or malformed request, keep serving others
+                        print(f"dropping request: {e!r}", flush=True)
+        finally:
+            conf.socket_path.unlink(missing_ok=True)
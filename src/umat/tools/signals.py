@@ -1,41 +1,149 @@
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-import zarr
 from skimage.measure import regionprops_table
-from tifffile import imread
 
 from ..conf import SignalsConf
+from ..masks import MIN_ROWS, MaskReader, index_path, keep_labels, label_rows, row_bands
+from ..memory import format_size, memory
+from ..mosaic import open_mosaic, read_mosaic
+from ..profile import phase
 
+# (z, row, column) coordinate properties and the indices of their row values, shifted by the first row of bands
+ROW_PROPS = {"bbox": (1, 4), "centroid": (1,), "centroid_weighted": (1,)}
+# properties holding per-pixel coordinates, which are not supported when processing bands
+PIXEL_PROPS = {"coords", "coords_scaled", "slice", "image", "image_convex", "image_filled", "image_intensity"}
+# properties derivable from the label index alone, without reading masks or images
+INDEX_PROPS = {"area", "bbox", "centroid"}
 
-def run(conf: SignalsConf):
-    print(f"loading masks from {conf.masks_path}")
-    if conf.masks_path.suffix == ".zarr":
-        arr = zarr.open(str(conf.masks_path), mode="r")
-        assert isinstance(arr, zarr.Array), f"expected input file {conf.masks_path} to contain zarr.Array, got {type(arr)}"
-        masks = arr[slice(None) if conf.z_subset is None else sorted(conf.z_subset), :, :]  # noqa: E731
-    else:
-        arr = np.load(conf.masks_path, mmap_mode="r")
-        masks = arr[slice(None) if conf.z_subset is None else sorted(conf.z_subset), :, :]  # noqa: E731
-
-    imgs = []
-    for c in conf.channels:
-        chan = []
-        for z in range(masks.shape[0]) if conf.z_subset is None else sorted(conf.z_subset):
-            path = conf.inp_fmt.format(z=z, c=c)
-            print(f"z={z}, c={c}: loading image from {path}", flush=True)
-            chan.append(imread(path))
-        imgs.append(np.stack(chan, axis=0))
-    imgs = np.stack(imgs, axis=-1)
-
-    assert masks.shape[:3] == imgs.shape[:3], (
-        f"expected first 3 dimensions of masks and images to be the same, got: {masks.shape[:3]} (masks), {imgs.shape[:3]} (images)"
+
+def index_table(conf: SignalsConf, index: pd.DataFrame, z_idxs: list[int]) -> pd.DataFrame:
+    # region properties of the (z, y, x) stack of the considered slices, combining the per slice statistics of every label
+    index = index[index["z"].isin(z_idxs)].assign(
+        # position of the slice within the stack
+        z=lambda df: np.searchsorted(z_idxs, df["z"].to_numpy()),
+        wz=lambda df: df["z"] * df["area"],
+        wy=lambda df: df["cy"] * df["area"],
+        wx=lambda df: df["cx"] * df["area"],
     )
+    agg = index.groupby("label", sort=True).agg(
+        z0=("z", "min"), y0=("y0", "min"), x0=("x0", "min"), z1=("z", "max"), y1=("y1", "max"), x1=("x1", "max"),
+        area=("area", "sum"), wz=("wz", "sum"), wy=("wy", "sum"), wx=("wx", "sum"),
+    )  # fmt: skip
+    df = pd.DataFrame({"label": agg.index.to_numpy(np.int64)})
+    for prop in conf.props:
+        if prop == "area":
+            df["area"] = agg["area"].to_numpy(np.float64)
+        elif prop == "bbox":
+            for i, col in enumerate(("z0", "y0", "x0")):
+                df[f"bbox-{i}"] = agg[col].to_numpy(np.int64)
+            df["bbox-3"] = agg["z1"].to_numpy(np.int64) + 1
+            for i, col in enumerate(("y1", "x1")):
+                df[f"bbox-{i + 4}"] = agg[col].to_numpy(np.int64)
+        else:
+            for i, col in enumerate(("wz", "wy", "wx")):
+                df[f"centroid-{i}"] = agg[col].to_numpy() / agg["area"].to_numpy()
+    return df
+
+
+def full_table(conf: SignalsConf, reader: MaskReader, z_idxs: list[int]) -> pd.DataFrame:
+    print(f"loading masks from {conf.masks_path}")
+    with phase("read masks"):
+        masks = reader[:] if conf.z_subset is None else np.stack([reader[z] for z in z_idxs], axis=0)
+
+    with phase("read images"):
+        imgs = []
+        for c in conf.channels:
+            chan = []
+            for z in z_idxs:
+                path = conf.inp_fmt.format(z=z, c=c)
+                print(f"z={z}, c={c}: loading image from {path}", flush=True)
+                chan.append(read_mosaic(Path(path)))
+            imgs.append(np.stack(chan, axis=0))
+        imgs = np.stack(imgs, axis=-1)
 
     print("determining region properties", flush=True)
-    df = pd.DataFrame(regionprops_table(masks, imgs, properties=["label", *conf.props]))
+    with phase("regionprops"):
+        return pd.DataFrame(regionprops_table(masks, imgs, properties=["label", *conf.props]))
+
+
+def band_table(conf: SignalsConf, reader: MaskReader, z_idxs: list[int], height: int) -> pd.DataFrame:
+    # region properties computed over bands of rows, each holding all pixels of the cells starting within it,
+    # so that results are identical to the full slice computation while only loading a band at a time
+    if unsupported := PIXEL_PROPS & set(conf.props):
+        raise ValueError(f"properties {unsupported} are not supported when images do not fit in memory, raise --max-memory")
+
+    print(f"determining rows spanned by cells in {conf.masks_path}", flush=True)
+    with phase("label rows"):
+        labels, first, last = label_rows(reader, z_idxs)
+
+    def props(rows: slice, keep: np.ndarray) -> pd.DataFrame:
+        with phase("read masks"):
+            masks = np.stack([reader[z, rows, :] for z in z_idxs], axis=0)
+            # cells overlapping the band from neighbouring bands are covered by their own band
+            keep_labels(masks, keep)
+        with phase("read images"):
+            # images are opened for every band, so that pages of memory-mapped images are released after each band
+            band = np.stack(
+                [np.stack([np.array(open_mosaic(Path(conf.inp_fmt.format(z=z, c=c)))[rows]) for z in z_idxs]) for c in conf.channels],
+                axis=-1,
+            )
+        with phase("regionprops"):
+            df = pd.DataFrame(regionprops_table(masks, band, properties=["label", *conf.props]))
+        for prop in ROW_PROPS.keys() & set(conf.props):
+            for col in df.columns:
+                if any(col == f"{prop}-{a}" or col.startswith(f"{prop}-{a}-") for a in ROW_PROPS[prop]):
+                    df[col] += rows.start
+        return df
+
+    tables = []
+    for rows, idx in row_bands(first, last, height):
+        print(f"rows {rows.start}-{rows.stop}: determining region properties of {len(idx)} cells", flush=True)
+        tables.append(props(rows, labels[idx]))
+    if not tables:
+        # no cells, still producing the expected columns
+        tables.append(props(slice(0, 1), labels))
+    return pd.concat(tables).sort_values("label").reset_index(drop=True)
+
+
+def run(conf: SignalsConf):
+    with MaskReader(conf.masks_path) as reader:
+        z_idxs = list(range(reader.shape[0])) if conf.z_subset is None else sorted(conf.z_subset)
+
+        # lazily opened, only reading image headers
+        dtypes = []
+        for c in conf.channels:
+            for z in z_idxs:
+                img = open_mosaic(Path(conf.inp_fmt.format(z=z, c=c)))
+                assert img.shape == reader.shape[1:], (
+                    f"expected images to have the same shape as masks, got: {reader.shape[1:]} (masks), {img.shape} (z={z}, c={c})"
+                )
+                dtypes.append(img.dtype)
+
+        # morphological properties are looked up in the label index (if present), skipping masks and images altogether
+        index = reader.index() if set(conf.props) <= INDEX_PROPS else None
+
+        # masks and images (held twice while stacking) of a single row across considered z slices
+        row_bytes = reader.shape[2] * (len(z_idxs) * reader.dtype.itemsize + 2 * sum(dt.itemsize for dt in dtypes))
+        height = memory.batch(reader.shape[1], row_bytes, minimum=MIN_ROWS)
+        if index is not None:
+            print(f"computing region properties from label index {index_path(conf.masks_path)}", flush=True)
+            with phase("index props"):
+                df = index_table(conf, index, z_idxs)
+        elif height >= reader.shape[1]:
+            df = full_table(conf, reader, z_idxs)
+        else:
+            print(
+                f"slices ({format_size(row_bytes * reader.shape[1])}) exceed available memory"
+                f" ({format_size(memory.available())}), processing bands of {height} rows",
+                flush=True,
+            )
+            df = band_table(conf, reader, z_idxs, height)
 
     for idx, chan in enumerate(conf.channels):
         df.rename(columns={col: col.replace(f"-{idx}", f"-{chan}") for col in df.columns}, inplace=True)
 
     print(f"saving signals table to {conf.out_path}", flush=True)
-    df.to_csv(conf.out_path, sep="\t", index=False)
+    with phase("write table"):
+        df.to_csv(conf.out_path, sep="\t", index=False)
@@ -6,6 +6,14 @@ from scipy.sparse import csr_matrix
 from shapely import box
 
 from ..conf import SpotConf
+from ..memory import memory
+from ..profile import phase
+from ..transcripts import load_transcripts
+
+# bytes held per transcript while joining it to spots (point geometry, candidate spots and their distances)
+TRANSCRIPT_BYTES = 1024
+# smallest batch of transcripts joined at once, however low on memory
+MIN_BATCH = 1 << 14
 
 
 def sjts(tdf: gpd.GeoDataFrame, sdf: gpd.GeoDataFrame) -> pd.DataFrame:
@@ -28,17 +36,25 @@ def sjts(tdf: gpd.GeoDataFrame, sdf: gpd.GeoDataFrame) -> pd.DataFrame:
     )
 
 
+def join(tdf: gpd.GeoDataFrame, sdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    # transcripts are matched to spots independently of each other, so they can be joined in batches sized to the memory budget
+    step = memory.batch(len(tdf), TRANSCRIPT_BYTES, minimum=MIN_BATCH)
+    if step >= len(tdf):
+        return sjts(tdf, sdf)
+    print(f"joining batches of {step} transcripts to fit in available memory", flush=True)
+    return pd.concat([sjts(tdf.iloc[i : i + step], sdf) for i in range(0, len(tdf), step)])  # pyright: ignore
+
+
 def run(conf: SpotConf):
-    print(f"loading detected transcripts table from {conf.dt_path}", flush=True)
-    tdf = pd.read_csv(
-        conf.dt_path,
-        usecols=["gene", "global_x", "global_y", "global_z"],  # pyright: ignore
-    )
-    tdf = (
-        gpd.GeoDataFrame(tdf[["gene", "global_z"]], geometry=gpd.points_from_xy(tdf["global_x"], tdf["global_y"]))
-        .rename_geometry("coords")
-        .reset_index(names="index_transcript")
-    )
+    with phase("load transcripts"):
+        tdf = load_transcripts(conf.dt_path)
+        tdf = (
+            gpd.GeoDataFrame(
+                tdf[["transcript_index", "gene", "global_z"]], geometry=gpd.points_from_xy(tdf["global_x"], tdf["global_y"])
+            )
+            .rename_geometry("coords")
+            .rename(columns={"transcript_index": "index_transcript"})
+        )
 
     bbox_minx, bbox_miny, bbox_maxx, bbox_maxy = tdf.total_bounds
 
@@ -60,40 +76,44 @@ def run(conf: SpotConf):
     )
     if conf.flatten:
         print("running spatial join between transcripts and spots", flush=True)
-        jdf = sjts(
-            tdf,  # pyright: ignore
-            sdf,
-        )
+        with phase("sjoin"):
+            jdf = join(
+                tdf,  # pyright: ignore
+                sdf,
+            )
     else:
         jdf = pd.DataFrame()
         for z, tdf_slice in tdf.groupby("global_z"):
             print(f"z={z}: running spatial join between transcripts and spots", flush=True)
-            jdf = pd.concat(
-                [
-                    jdf,
-                    sjts(
-                        tdf_slice,  # pyright: ignore
-                        sdf,
-                    ).assign(z=z),
-                ]
-            )
+            with phase("sjoin", z=z):
+                jdf = pd.concat(
+                    [
+                        jdf,
+                        join(
+                            tdf_slice,  # pyright: ignore
+                            sdf,
+                        ).assign(z=z),
+                    ]
+                )
 
     # sanity check assignments
     assert jdf.index.size == tdf.index.size, "bug: not all transcripts were assigned a spot"
 
     if not conf.flatten:
-        jdf["label"] = jdf["z"].astype(str) + "_" + jdf["label"].astype(str)
+        # z values are integers (as checked when caching transcripts), named '<z>_<spot>' as for integer CSV z values
+        jdf["label"] = jdf["z"].astype(int).astype(str) + "_" + jdf["label"].astype(str)
 
     print("constructing count matrix", flush=True)
-    mtx = (
-        jdf.groupby(["label", "gene"])["gene"]
-        .count()
-        .to_frame(name="n")
-        .reset_index()
-        .pivot(index="label", columns="gene", values="n")
-        .fillna(0)
-        .astype(int)
-    )
+    with phase("count matrix"):
+        mtx = (
+            jdf.groupby(["label", "gene"], observed=True)["gene"]
+            .count()
+            .to_frame(name="n")
+            .reset_index()
+            .pivot(index="label", columns="gene", values="n")
+            .fillna(0)
+            .astype(int)
+        )
 
     print("constructing anndata object", flush=True)
 
@@ -129,4 +149,5 @@ def run(conf: SpotConf):
     ad.obs["spot_y"] = spatial.geometry.centroid.y
 
     print(f"saving anndata to {conf.ad_path}", flush=True)
-    ad.write_h5ad(conf.ad_path)
+    with phase("write h5ad"):
+        ad.write_h5ad(conf.ad_path)
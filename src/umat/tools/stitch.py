@@ -0,0 +1,138 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import zarr
+
+from ..conf import StitchConf
+from ..masks import CHUNKS, index_masks, index_path
+from ..memory import memory
+from ..profile import phase
+from ..relabel import components, match, pair_keys, relabel, sparse_count
+
+# masks store (and relabel map) of the current worker process, opened once per worker rather than per task
+_store = None
+_keys = _values = None
+
+
+def open_store(path: Path, mode: str = "r") -> zarr.Array | np.ndarray:
+    if path.suffix == ".zarr":
+        arr = zarr.open(str(path), mode=mode)
+        assert isinstance(arr, zarr.Array), f"expected input file {path} to contain zarr.Array, got {type(arr)}"
+        return arr
+    return np.load(path, mmap_mode=mode)
+
+
+def init_worker(path: Path, mode: str, keys: np.ndarray | None = None, values: np.ndarray | None = None):
+    global _store, _keys, _values
+    _store = open_store(path, mode)
+    _keys, _values = keys, values
+
+
+def grid(shape: tuple[int, ...], blocks: tuple[int, ...]) -> list[tuple[slice, ...]]:
+    # regions of every block of a block grid covering shape
+    ranges = [[slice(b0, min(b0 + b, s)) for b0 in range(0, s, b)] for s, b in zip(shape, blocks)]
+    return list(product(*ranges))
+
+
+def faces(shape: tuple[int, int, int], blocks: tuple[int, int, int], axes: list[int]) -> list[tuple[int, int, tuple[slice, ...]]]:
+    # (axis, position, region) of every block face, the region spanning the planes on either side of the face.
+    # faces are split along the other axes by the block grid, so that every task only reads a block's extent
+    out = []
+    for axis in axes:
+        others = [s if a != axis else 1 for a, s in enumerate(shape)]
+        for pos in range(blocks[axis], shape[axis], blocks[axis]):
+            for region in grid(tuple(others), blocks):
+                region = tuple(slice(pos - 1, pos + 1) if a == axis else r for a, r in enumerate(region))
+                out.append((axis, pos, region))
+    return out
+
+
+def face_overlaps(task: tuple[int, int, tuple[slice, ...]]) -> tuple[int, int, tuple[np.ndarray, ...]]:
+    # (packed label pair keys, overlaps) between both sides of a face, along with the (labels, areas) of either side
+    axis, pos, region = task
+    assert _store is not None, "bug: worker store not initialized"
+    data = np.asarray(_store[region])
+    a, b = np.take(data, 0, axis=axis), np.take(data, 1, axis=axis)
+    return axis, pos, (*sparse_count(pair_keys(a, b)), *sparse_count(a[a != 0]), *sparse_count(b[b != 0]))
+
+
+def relabel_block(region: tuple[slice, ...]) -> int:
+    # relabel a block in place (only writing it back if any of its labels changed), returning its maximum label
+    assert _store is not None and _keys is not None and _values is not None, "bug: worker store not initialized"
+    data = np.array(_store[region])
+    if relabel(data, _keys, _values):
+        _store[region] = data
+    return int(data.max(initial=0))
+
+
+def run(conf: StitchConf):
+    arr = open_store(conf.inp_path)
+    if arr.ndim != 3:
+        raise ValueError(f"expected 3D (z, y, x) masks in {conf.inp_path}, got shape {arr.shape}")
+    if arr.dtype.itemsize > 4:
+        raise ValueError(f"expected masks with labels fitting in 32 bits, got dtype {arr.dtype}")
+    shape = arr.shape
+    chunks = arr.chunks if isinstance(arr, zarr.Array) else tuple(min(c, s) for c, s in zip(CHUNKS, shape))
+    blocks = conf.blocks if conf.blocks is not None else chunks
+    axes = [a for a in range(3) if not (conf.planar and a == 0) and blocks[a] < shape[a]]
+
+    # workers hold a face (two planes of a block) or a chunk along with their sorting temporaries
+    block_bytes = max(2 * max(np.prod(blocks) // b for b in blocks), np.prod(chunks)) * 24
+    ncpus = memory.workers(conf.ncpus, block_bytes)
+
+    tasks = faces(shape, blocks, axes)
+    print(f"counting label overlaps across {len(tasks)} faces of {blocks} blocks in {conf.inp_path}", flush=True)
+    with phase("face overlaps"):
+        found: dict[tuple[int, int], list[tuple[np.ndarray, ...]]] = {}
+        with ProcessPoolExecutor(ncpus, initializer=init_worker, initargs=(conf.inp_path, "r")) as pool:
+            for axis, pos, counts in pool.map(face_overlaps, tasks, chunksize=max(len(tasks) // (4 * ncpus), 1)):
+                found.setdefault((axis, pos), []).append(counts)
+
+        # faces split along the block grid are combined, so that matches consider the whole footprint of labels
+        src, dst = [], []
+        for (axis, pos), counts in sorted(found.items()):
+            key, inter, lab_a, area_a, lab_b, area_b = (np.concatenate(c) for c in zip(*counts))
+            key, inter = sparse_count(key, inter)
+            lab_a, area_a = sparse_count(lab_a, area_a)
+            lab_b, area_b = sparse_count(lab_b, area_b)
+            # cells barely crossing a face leave small fragments in the next block, whose footprint on the face is
+            # mostly covered by the cell's, as such overlaps are relative to the smaller footprint rather than the union
+            ia, ib = match(key, inter, lab_a, area_a, lab_b, area_b, conf.threshold, union=False)
+            src.append(lab_a[ia].astype(np.uint64))
+            dst.append(lab_b[ib].astype(np.uint64))
+
+    with phase("union find"):
+        src, dst = np.concatenate(src or [np.zeros(0, np.uint64)]), np.concatenate(dst or [np.zeros(0, np.uint64)])
+        # only labels touching a face are nodes, every other label is left as is
+        nodes, inv = np.unique(np.r_[src, dst], return_inverse=True)
+        roots = components(len(nodes), inv[: len(src)], inv[len(src) :])
+        # merged labels take the smallest label of their cell
+        moved = roots != np.arange(len(nodes))
+        keys, values = nodes[moved].astype(arr.dtype), nodes[roots[moved]].astype(arr.dtype)
+    print(f"merging {len(keys)} labels across {len(src)} matched label pairs", flush=True)
+
+    if len(keys) > 0:
+        # blocks of the store's own chunks, so that concurrent workers never write to the same chunk
+        regions = grid(shape, chunks)
+        print(f"relabelling {len(regions)} chunks in place", flush=True)
+        with phase("relabel"):
+            with ProcessPoolExecutor(ncpus, initializer=init_worker, initargs=(conf.inp_path, "r+", keys, values)) as pool:
+                max_label = max(pool.map(relabel_block, regions, chunksize=max(len(regions) // (4 * ncpus), 1)))
+
+        if isinstance(arr, zarr.Array):
+            out = zarr.open(str(conf.inp_path), mode="r+")
+            if "n_labels" in out.attrs:
+                out.attrs.update({"n_labels": out.attrs["n_labels"] - len(keys), "max_label": max_label})
+            # chunk writes leave the array metadata untouched, which identifies masks contents in the dataset cache
+            os.utime(conf.inp_path / ".zarray")
+        else:
+            os.utime(conf.inp_path)
+
+        # an existing label index no longer matches the relabelled masks
+        if index_path(conf.inp_path).is_file():
+            with phase("index labels"):
+                index_masks(conf.inp_path, workers=ncpus)
+    print(f"stitched masks in {conf.inp_path} ({len(keys)} labels merged)", flush=True)
@@ -0,0 +1,187 @@
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from h5py import Dataset, Group
+from h5py import File as H5File
+
+CYT_KEY = "channel: cytoplasm"
+NUC_KEY = "channel: nuclear"
+LAB_KEY = "labels"
+
+
+def get_ds(grp: Group, key: str) -> Dataset:
+    o = grp[key]
+    if not isinstance(o, Dataset):
+        raise ValueError(f"expected key {key} for group {grp} to be dataset, got {o}")
+    return o
+
+
+def labelled_samples(hf: H5File) -> dict[str, tuple[int, int]]:
+    # name and shape of every sample group that has labels, checking that channels and labels line up
+    samples = {}
+    for name, grp in hf.items():
+        if not isinstance(grp, Group) or LAB_KEY not in grp:
+            continue
+        if CYT_KEY not in grp.keys():
+            raise ValueError(f"expected sample to have a cytoplasm channel, got: {grp}")
+        if NUC_KEY not in grp.keys():
+            raise ValueError(f"expected sample to have a nuclear channel, got: {grp}")
+
+        cyt_shape = get_ds(grp, CYT_KEY).shape
+        nuc_shape = get_ds(grp, NUC_KEY).shape
+        lab_shape = get_ds(grp, LAB_KEY).shape
+        if cyt_shape != nuc_shape:
+            raise ValueError(f"expected channels to have same shape, got: {cyt_shape} (cyt) vs {nuc_shape} (nuc)")
+        if cyt_shape != lab_shape:
+            raise ValueError(f"expected channels and labels to have same shape, got: {cyt_shape} (chan) vs {lab_shape} (labs)")
+
+        samples[name] = cyt_shape
+    return samples
+
+
+# per-process handle to the training file, opened once by each loader worker
+_hf: H5File | None = None
+
+
+def _open(path: Path):
+    global _hf
+    _hf = H5File(path, "r")
+
+
+def _sample_range(name: str) -> tuple[np.ndarray, np.ndarray]:
+    # per-channel (offset, divisor) normalizing a whole sample the way cellpose's `normalize_img` does for training:
+    # to its 1st-99th percentile range, zeroing channels with a (nearly) empty range (infinite divisor) and leaving
+    # constant channels as is. kept in float64, as the percentiles cellpose subtracts and divides by
+    assert _hf is not None, "bug: training file not opened in loader worker"
+    grp = _hf[name]
+    assert isinstance(grp, Group)
+    lo, den = np.zeros(2), np.ones(2)
+    for c, key in enumerate((CYT_KEY, NUC_KEY)):
+        data = get_ds(grp, key)[:].astype(np.float32)
+        if np.ptp(data) == 0:
+            continue
+        p1, p99 = np.percentile(data, 1), np.percentile(data, 99)
+        lo[c], den[c] = (p1, p99 - p1) if p99 - p1 > 1e-3 else (0.0, np.inf)
+    return lo, den
+
+
+def _read_crop(name: str, y0: int, x0: int, side: int, lo: np.ndarray, den: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # read a normalized (2, side, side) channel crop and matching labels, zero-padding samples smaller than the crop
+    # (after normalization, as cellpose pads normalized images)
+    assert _hf is not None, "bug: training file not opened in loader worker"
+    grp = _hf[name]
+    assert isinstance(grp, Group)
+    win = (slice(y0, y0 + side), slice(x0, x0 + side))
+
+    img = np.zeros((2, side, side), dtype=np.float32)
+    labs = np.zeros((side, side), dtype=np.int32)
+    for c, key in enumerate((CYT_KEY, NUC_KEY)):
+        data = get_ds(grp, key)[win].astype(np.float32)
+        data -= lo[c]
+        data /= den[c]
+        img[c, : data.shape[0], : data.shape[1]] = data
+    data = get_ds(grp, LAB_KEY)[win]
+    labs[: data.shape[0], : data.shape[1]] = data
+    return img, labs
+
+
+# streams randomly cropped, augmented batches of labelled samples from a `umat sample`/`umat addlab` training file.
+# crops are read on demand by a pool of worker processes (each holding its own file handle), `prefetch` batches ahead
+# of the consumer. crops are normalized by the percentiles of their whole sample (computed once, on creation), matching
+# the normalization cellpose applies to in-memory training data. augmentations (flips, 90 degree rotations, per-channel
+# intensity jitter) are applied to whole batches at once, to images and labels alike.
+# `names` restricts the loader to a subset of the labelled samples.
+# batches are written into a single (batch_size, 3, side, side) buffer whose third (zero) channel is never written to,
+# as such yielded images are only valid until the next batch is requested.
+class CropLoader:
+    def __init__(
+        self,
+        path: Path,
+        side: int = 256,
+        batch_size: int = 8,
+        workers: int = 1,
+        prefetch: int = 2,
+        jitter: float = 0.1,
+        seed: int | None = None,
+        names: list[str] | None = None,
+    ):
+        self.path = path
+        self.side = side
+        self.batch_size = batch_size
+        self.prefetch = max(prefetch, 1)
+        self.jitter = jitter
+        self.rng = np.random.default_rng(seed)
+
+        with H5File(path, "r") as hf:
+            self.samples = labelled_samples(hf)
+        if names is not None:
+            self.samples = {name: self.samples[name] for name in names}
+        if len(self.samples) == 0:
+            raise ValueError(f"no labelled samples found in {path}")
+        self.names = list(self.samples)
+
+        if workers > 0:
+            self._pool = ProcessPoolExecutor(workers, initializer=_open, initargs=(path,))
+            self.ranges = list(self._pool.map(_sample_range, self.names))
+        else:
+            self._pool = None
+            _open(path)
+            self.ranges = list(map(_sample_range, self.names))
+
+        self._buf = np.zeros((batch_size, 3, side, side), dtype=np.float32)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _submit(self) -> list[Future | tuple[np.ndarray, np.ndarray]]:
+        reqs = []
+        for i in self.rng.integers(0, len(self.names), self.batch_size):
+            name = self.names[i]
+            h, w = self.samples[name]
+            y0, x0 = int(self.rng.integers(0, max(h - self.side, 0) + 1)), int(self.rng.integers(0, max(w - self.side, 0) + 1))
+            args = (name, y0, x0, self.side, *self.ranges[i])
+            reqs.append(_read_crop(*args) if self._pool is None else self._pool.submit(_read_crop, *args))
+        return reqs
+
+    def _augment(self, imgs: np.ndarray, labs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        n = imgs.shape[0]
+
+        # random flips along both axes and transposition cover all 8 dihedral orientations
+        for axis in (-1, -2):
+            sel = self.rng.random(n) < 0.5
+            imgs[sel] = np.flip(imgs[sel], axis=axis)
+            labs[sel] = np.flip(labs[sel], axis=axis)
+        sel = self.rng.random(n) < 0.5
+        imgs[sel] = np.swapaxes(imgs[sel], -1, -2)
+        labs[sel] = np.swapaxes(labs[sel], -1, -2)
+
+        if self.jitter > 0:
+            imgs *= self.rng.uniform(1 - self.jitter, 1 + self.jitter, (n, imgs.shape[1], 1, 1)).astype(np.float32)
+            imgs += self.rng.uniform(-self.jitter, self.jitter, (n, imgs.shape[1], 1, 1)).astype(np.float32)
+
+        return imgs, labs
+
+    def __iter__(self) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        pending: deque[list] = deque(self._submit() for _ in range(self.prefetch))
+        while True:
+            reqs = pending.popleft()
+            pending.append(self._submit())
+            crops = [r.result() if isinstance(r, Future) else r for r in reqs]
+
+            imgs, labs = self._augment(np.stack([c[0] for c in crops]), np.stack([c[1] for c in crops]))
+            self._buf[:, :2] = imgs
+            yield self._buf, labs
@@ -0,0 +1,227 @@
+import json
+from collections.abc import Iterator
+from pathlib import Path
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .cache import datasets, stamp
+from .profile import phase
+
+# columns kept from the MERSCOPE detected transcripts CSV file
+CSV_COLUMNS = ["gene", "global_x", "global_y", "global_z"]
+# rows per parquet row group, row groups are spatially compact thanks to the Z-order sort,
+# so that their min/max statistics allow skipping most of them for bbox queries
+ROW_GROUP_SIZE = 1 << 16
+PARTITIONING = ds.partitioning(pa.schema([("global_z", pa.int16())]), flavor="hive")
+
+
+def cache_path(dt_path: Path) -> Path:
+    return dt_path.with_name(f"{dt_path.name}.parquet")
+
+
+def source_stamp(dt_path: Path) -> dict[str, int]:
+    st = dt_path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def cache_valid(dt_path: Path, cache_dir: Path) -> bool:
+    stamp_path = cache_dir / "_source.json"
+    if not stamp_path.is_file():
+        return False
+    with open(stamp_path) as f:
+        return json.load(f) == source_stamp(dt_path)
+
+
+def morton(x: np.ndarray, y: np.ndarray, bits: int = 16) -> np.ndarray:
+    # Z-order (Morton) code of points, after quantizing coordinates to a 2^bits grid over their bounds
+    def quantize(v: np.ndarray) -> np.ndarray:
+        lo, hi = v.min(), v.max()
+        return ((v - lo) / max(hi - lo, 1e-9) * ((1 << bits) - 1)).astype(np.uint64)
+
+    def spread(v: np.ndarray) -> np.ndarray:
+        v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+        v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+        return v
+
+    return spread(quantize(x)) | (spread(quantize(y)) << np.uint64(1))
+
+
+def ingest(dt_path: Path, cache_dir: Path, block_size: int = 1 << 26):
+    # write into a temporary directory first, so that an interrupted conversion never leaves behind a valid-looking cache
+    tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp")
+    if tmp_dir.exists():
+        rmtree(tmp_dir)
+    (tmp_dir / "spill").mkdir(parents=True)
+
+    # first pass: stream the CSV file, spilling rows to one (unsorted) file per z slice
+    with phase("parse csv"):
+        reader = pacsv.open_csv(
+            dt_path,
+            read_options=pacsv.ReadOptions(block_size=block_size),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=CSV_COLUMNS,
+                column_types={"gene": pa.string(), "global_x": pa.float32(), "global_y": pa.float32(), "global_z": pa.float64()},
+            ),
+        )
+        spills: dict[int, pq.ParquetWriter] = {}
+        genes: set[str] = set()
+        n_rows = 0
+        for batch in reader:
+            z_col = batch.column("global_z").to_numpy()
+            if not np.all(np.mod(z_col, 1) == 0):
+                raise ValueError(f"expected integer global_z values in {dt_path}")
+            z_col = z_col.astype(np.int16)
+
+            tbl = pa.table(
+                {
+                    "transcript_index": pa.array(np.arange(n_rows, n_rows + batch.num_rows, dtype=np.int64)),
+                    "gene": batch.column("gene"),
+                    "global_x": batch.column("global_x"),
+                    "global_y": batch.column("global_y"),
+                }
+            )
+            genes.update(pc.unique(batch.column("gene")).to_pylist())
+            for z in np.unique(z_col):
+                if z not in spills:
+                    spills[z] = pq.ParquetWriter(tmp_dir / "spill" / f"{z}.parquet", tbl.schema)
+                spills[z].write_table(tbl.filter(pa.array(z_col == z)))
+            n_rows += batch.num_rows
+            print(f"read {n_rows} transcripts", flush=True)
+
+        for w in spills.values():
+            w.close()
+
+    # second pass: one z slice at a time, sort rows along a Z-order curve and dictionary-encode genes
+    # using a dictionary shared by all slices
+    gene_dict = pa.array(sorted(genes), pa.string())
+    for z in sorted(spills):
+        with phase("sort slice", z=int(z)):
+            tbl = pq.read_table(tmp_dir / "spill" / f"{z}.parquet")
+            order = np.argsort(morton(tbl.column("global_x").to_numpy(), tbl.column("global_y").to_numpy()), kind="stable")
+            tbl = tbl.take(pa.array(order))
+            tbl = tbl.set_column(
+                tbl.schema.get_field_index("gene"),
+                "gene",
+                pa.DictionaryArray.from_arrays(pc.index_in(tbl.column("gene"), value_set=gene_dict).combine_chunks(), gene_dict),
+            )
+            (tmp_dir / f"global_z={z}").mkdir()
+            pq.write_table(tbl, tmp_dir / f"global_z={z}" / "part-0.parquet", row_group_size=ROW_GROUP_SIZE, compression="zstd")
+        print(f"z={z}: wrote {tbl.num_rows} transcripts", flush=True)
+
+    rmtree(tmp_dir / "spill")
+    with open(tmp_dir / "_source.json", "w") as f:
+        json.dump(source_stamp(dt_path), f)
+
+    if cache_dir.exists():
+        rmtree(cache_dir)
+    tmp_dir.rename(cache_dir)
+
+
+def ensure_cache(dt_path: Path, force: bool = False) -> Path:
+    cache_dir = cache_path(dt_path)
+    if force or not cache_valid(dt_path, cache_dir):
+        print(f"converting detected transcripts from {dt_path} to columnar cache {cache_dir}", flush=True)
+        ingest(dt_path, cache_dir)
+    return cache_dir
+
+
+def transcript_filter(z: list[int] | None, bbox: tuple[float, float, float, float] | None) -> ds.Expression | None:
+    filt = None
+    if z is not None:
+        filt = ds.field("global_z").isin(z)
+    if bbox is not None:
+        min_x, min_y, max_x, max_y = bbox
+        bb_filt = (
+            (ds.field("global_x") >= min_x)
+            & (ds.field("global_x") < max_x)
+            & (ds.field("global_y") >= min_y)
+            & (ds.field("global_y") < max_y)
+        )
+        filt = bb_filt if filt is None else filt & bb_filt
+    return filt
+
+
+def load_transcripts(
+    dt_path: Path,
+    z: list[int] | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+) -> pd.DataFrame:
+    # load transcripts through the columnar cache (creating it if absent/outdated), only reading the z slices
+    # and row groups needed for the (half-open, min_x/min_y inclusive) bbox filter if provided
+    cache_dir = ensure_cache(dt_path)
+    print(f"loading detected transcripts from columnar cache {cache_dir}", flush=True)
+    filt = transcript_filter(z, bbox)
+
+    def load() -> pd.DataFrame:
+        tbl = ds.dataset(cache_dir, format="parquet", partitioning=PARTITIONING).to_table(filter=filt)
+        return tbl.unify_dictionaries().to_pandas()
+
+    # shallow copy, so that callers adding columns never alter cached tables
+    key = ("transcripts", stamp(dt_path), None if z is None else tuple(z), bbox)
+    return datasets.get(key, load).copy(deep=False)
+
+
+def transcript_slices(dt_path: Path) -> list[int]:
+    # z slices present in the columnar cache (creating it if absent/outdated)
+    cache_dir = ensure_cache(dt_path)
+    return sorted(int(p.name.removeprefix("global_z=")) for p in cache_dir.glob("global_z=*"))
+
+
+def transcript_genes(dt_path: Path) -> pd.Index:
+    # gene dictionary shared by all z slices of the columnar cache (creating it if absent/outdated)
+    cache_dir = ensure_cache(dt_path)
+    part = next(cache_dir.glob("global_z=*/part-0.parquet"), None)
+    if part is None:
+        return pd.Index([], dtype=str)
+    col = pq.ParquetFile(part).read_row_group(0, columns=["gene"]).column("gene")
+    return pd.Index(col.chunk(0).dictionary.to_pylist())
+
+
+def transcript_count(dt_path: Path, z: int) -> int:
+    # amount of transcripts in a z slice, from the columnar cache metadata (creating it if absent/outdated)
+    cache_dir = ensure_cache(dt_path)
+    return sum(pq.ParquetFile(p).metadata.num_rows for p in cache_dir.glob(f"global_z={z}/*.parquet"))
+
+
+def iter_transcripts(
+    dt_path: Path,
+    z: int,
+    bbox: tuple[float, float, float, float] | None = None,
+    batch_rows: int = 1 << 22,
+) -> Iterator[pd.DataFrame]:
+    # transcripts of a z slice in the same order as `load_transcripts`, as batches of about batch_rows rows
+    # (bypassing the dataset cache) so that slices larger than memory can be processed.
+    # like `load_transcripts`, a single empty batch is produced when no transcripts match (e.g. an empty tile)
+    cache_dir = ensure_cache(dt_path)
+    print(f"streaming detected transcripts from columnar cache {cache_dir} in batches of {batch_rows}", flush=True)
+    genes = transcript_genes(dt_path)
+    dataset = ds.dataset(cache_dir, format="parquet", partitioning=PARTITIONING)
+    batches = dataset.to_batches(filter=transcript_filter([z], bbox), batch_size=min(batch_rows, ROW_GROUP_SIZE))
+
+    pending, n_pending, n_batches = [], 0, 0
+    while True:
+        with phase("load transcripts", z=z):
+            # row group sized record batches, gathered up to batch_rows
+            for batch in batches:
+                pending.append(batch)
+                n_pending += batch.num_rows
+                if n_pending >= batch_rows:
+                    break
+            if not pending and n_batches > 0:
+                return
+            tbl = pa.Table.from_batches(pending) if pending else dataset.schema.empty_table()
+            tdf = tbl.unify_dictionaries().to_pandas()
+            tdf["gene"] = tdf["gene"].cat.set_categories(genes)
+            pending, n_pending = [], 0
+        n_batches += 1
+        yield tdf
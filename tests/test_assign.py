@@ -0,0 +1,60 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+from anndata import read_h5ad
+
+from umat.conf import AssignConf, BoundaryConf, MergeConf
+from umat.synth import generate
+from umat.tools import assign, boundary, merge
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("synth")
+    paths = generate(data_dir, 512, 2, transcripts_per_cell=4)
+    boundary.run(BoundaryConf(paths["masks"], data_dir / "cells.feather", paths["mp"]))
+    return data_dir, paths
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_empty_z_shard(dataset, tmp_path, compact):
+    data_dir, paths = dataset
+    out = {}
+    for name, z_subset in [("full", [0]), ("empty", [5])]:
+        ad_path, ft_path = tmp_path / f"{name}.h5ad", tmp_path / f"{name}.feather"
+        conf = AssignConf([data_dir / "cells.feather"], ad_path, ft_path, paths["dt"], compact=compact, z_subset=z_subset)
+        assign.run(conf)
+        out[name] = (read_h5ad(conf.ad_path), (assign.read_assigned if compact else gpd.read_feather)(conf.ft_path))
+
+    # a shard without transcripts is written like any other, only without rows
+    (full_ad, full_df), (empty_ad, empty_df) = out["full"], out["empty"]
+    assert full_ad.n_obs > 0 and len(full_df) > 0
+    assert empty_ad.n_obs == 0 and len(empty_df) == 0
+    assert empty_ad.uns["partial"]
+    assert empty_ad.var_names.equals(full_ad.var_names)
+    pd.testing.assert_series_equal(empty_df.dtypes.astype(str), full_df.dtypes.astype(str))
+
+
+def test_tiles_match_unsharded(dataset, tmp_path):
+    data_dir, paths = dataset
+    b_paths = [data_dir / "cells.feather"]
+    # few transcripts per cell, most of them assigned by expansion, often to cells overlapping a neighbouring tile
+    expand = 20.0
+    assign.run(AssignConf(b_paths, tmp_path / "full.h5ad", tmp_path / "full.feather", paths["dt"], expand=expand))
+
+    tdf = pd.read_csv(paths["dt"])
+    min_x, min_y = tdf["global_x"].min(), tdf["global_y"].min()
+    max_x, max_y = tdf["global_x"].max() + 1, tdf["global_y"].max() + 1
+    mid_x, mid_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    tiles = [(min_x, min_y, mid_x, mid_y), (mid_x, min_y, max_x, mid_y), (min_x, mid_y, mid_x, max_y), (mid_x, mid_y, max_x, max_y)]
+    shards = []
+    for i, tile in enumerate(tiles):
+        shards.append(tmp_path / f"tile{i}.h5ad")
+        assign.run(AssignConf(b_paths, shards[-1], tmp_path / f"tile{i}.feather", paths["dt"], tile=tile, expand=expand))
+    merge.run(MergeConf(shards, tmp_path / "merged.h5ad"))
+
+    full, merged = read_h5ad(tmp_path / "full.h5ad"), read_h5ad(tmp_path / "merged.h5ad")
+    assert full.n_obs > 0
+    assert full.obs_names.equals(merged.obs_names) and full.var_names.equals(merged.var_names)
+    assert (full.X != merged.X).nnz == 0
+    pd.testing.assert_frame_equal(full.obsm["blanks"], merged.obsm["blanks"])
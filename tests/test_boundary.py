@@ -0,0 +1,23 @@
+import geopandas as gpd
+import numpy as np
+
+from umat.conf import BoundaryConf
+from umat.masks import write_masks
+from umat.synth import generate
+from umat.tools import boundary
+
+
+def test_no_labels(tmp_path):
+    paths = generate(tmp_path / "synth", 512, 2, transcripts_per_cell=1)
+    full = tmp_path / "full.feather"
+    boundary.run(BoundaryConf(paths["masks"], full, paths["mp"]))
+
+    # every slice is skipped through the masks metadata, still writing a (empty) cell table
+    write_masks(tmp_path / "empty.zarr", np.zeros((2, 512, 512), np.uint16))
+    empty = tmp_path / "empty.feather"
+    boundary.run(BoundaryConf(tmp_path / "empty.zarr", empty, paths["mp"]))
+
+    full_df, empty_df = gpd.read_feather(full), gpd.read_feather(empty)
+    assert len(full_df) > 0 and len(empty_df) == 0
+    assert empty_df.columns.tolist() == full_df.columns.tolist()
+    assert empty_df.dtypes.astype(str).tolist() == full_df.dtypes.astype(str).tolist()
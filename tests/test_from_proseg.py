@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from umat.conf import FromProsegConf
+from umat.memory import memory
+from umat.synth import generate
+from umat.tools import from_proseg
+
+
+@pytest.mark.parametrize("z_slice", [None, 1])
+def test_uncached_matches_cache(tmp_path, monkeypatch, capsys, z_slice):
+    side = 512
+    paths = generate(tmp_path / "synth", side, 3, transcripts_per_cell=1)
+
+    # check whether to spill every few features, rather than once per (many more than generated) batch
+    monkeypatch.setattr(from_proseg, "SPILL_BATCH", 10)
+    out = {}
+    for name, no_cache, limit in [("cached", False, None), ("streamed", True, None), ("spilled", True, 1)]:
+        monkeypatch.setattr(memory, "limit", limit)
+        path = tmp_path / f"{name}.npy"
+        from_proseg.run(FromProsegConf(paths["proseg"], side, side, paths["mp"], path, z_slice=z_slice, no_cache=no_cache))
+        out[name] = np.load(path)
+
+    # nothing left behind by streaming, whether features were spilled or not
+    assert "spilling" in capsys.readouterr().out
+    assert not list(tmp_path.glob(".umat-proseg-*"))
+    assert out["cached"].max() > 0
+    np.testing.assert_array_equal(out["cached"], out["streamed"])
+    np.testing.assert_array_equal(out["cached"], out["spilled"])
@@ -0,0 +1,97 @@
+import os
+from multiprocessing import Pool
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+
+import umat.memory
+from umat.conf import BoundaryConf, SignalsConf
+from umat.memory import MemoryBudget, memory, parse_size
+from umat.synth import generate, mosaic_fmt
+from umat.tools import boundary, signals
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [
+        ("1000000", 1000000),
+        ("64G", 64 << 30),
+        ("512MiB", 512 << 20),
+        ("2kb", 2 << 10),
+        ("1.5T", 3 << 39),
+        (" 8 G ", 8 << 30),
+    ],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+@pytest.mark.parametrize("size", ["", "G", "12X", "-1G", "1.5.2M"])
+def test_parse_size_invalid(size):
+    with pytest.raises(ValueError):
+        parse_size(size)
+
+
+def test_batch_and_workers(monkeypatch):
+    # 900 bytes available out of a 1000 byte limit (after headroom), while nothing is in use
+    monkeypatch.setattr(umat.memory, "rss", lambda *args, **kwargs: 0)
+    budget = MemoryBudget(1000)
+    assert budget.available() == 900
+    assert budget.batch(100, 10) == 45
+    assert budget.batch(100, 10, fraction=1.0) == 90
+    assert budget.batch(10, 10) == 10
+    assert budget.batch(100, 1000) == 1
+    assert budget.batch(100, 1000, minimum=64) == 64
+    assert budget.batch(0, 10) == 0
+    assert budget.workers(8, 100) == 4
+    assert budget.workers(2, 1) == 2
+    assert budget.workers(8, 1 << 30) == 1
+    assert not budget.pressure()
+
+    # nothing left, batches fall back to their minimum size
+    monkeypatch.setattr(umat.memory, "rss", lambda *args, **kwargs: 950)
+    assert budget.available() == 0
+    assert budget.batch(100, 10, minimum=5) == 5
+    assert budget.workers(8, 100) == 1
+    assert budget.pressure()
+
+
+def test_rss_children():
+    with Pool(2) as pool:
+        assert {p.pid for p in pool._pool} <= set(umat.memory._children(os.getpid()))
+        assert umat.memory.rss(max_age=0) > umat.memory.rss(children=False, max_age=0)
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("synth")
+    return data_dir, generate(data_dir, 512, 2, transcripts_per_cell=1)
+
+
+@pytest.mark.parametrize("masks", ["npy", "masks"])
+def test_signals_bands(dataset, masks, monkeypatch, capsys):
+    data_dir, paths = dataset
+    out = {}
+    for limit in (None, 1):
+        monkeypatch.setattr(memory, "limit", limit)
+        conf = SignalsConf(mosaic_fmt(data_dir), ["PolyT", "DAPI"], paths[masks], data_dir / f"signals_{limit}.tsv")
+        signals.run(conf)
+        out[limit] = pd.read_csv(conf.out_path, sep="\t")
+    assert "processing bands of 64 rows" in capsys.readouterr().out
+    assert len(out[None]) > 0
+    pd.testing.assert_frame_equal(out[None], out[1])
+
+
+@pytest.mark.parametrize("masks", ["npy", "masks"])
+def test_boundary_bands(dataset, masks, monkeypatch, capsys):
+    data_dir, paths = dataset
+    out = {}
+    for limit in (None, 1):
+        monkeypatch.setattr(memory, "limit", limit)
+        conf = BoundaryConf(paths[masks], data_dir / f"boundary_{limit}.feather", paths["mp"])
+        boundary.run(conf)
+        out[limit] = gpd.read_feather(conf.out_path)
+    assert "processing bands of 64 rows" in capsys.readouterr().out
+    assert len(out[None]) > 0
+    assert out[None].equals(out[1])
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import zarr
+
+from umat.conf import DistributedSegConf, PipelineConf, StitchConf
+from umat.tools import pipeline
+
+
+def fake_stage(stage: pipeline.Stage) -> list[dict]:
+    # stands in for the tools (segd needs cellpose and GPUs), creating temporary files the way segd does
+    conf = stage.conf
+    if isinstance(conf, DistributedSegConf):
+        zarr.open(str(conf.tempdir / "seg.zarr"), mode="w-", shape=(1, 4, 4), dtype="u2")
+        (conf.tempdir / "cellpose_temp").mkdir()
+        with open(conf.tempdir.parent.parent / "segd_runs.txt", "a") as f:
+            print(conf.model_path, file=f)
+    if isinstance(conf, StitchConf):
+        with open(conf.inp_path.parent / "stitch_runs.txt", "a") as f:
+            print(conf.blocks, file=f)
+    for path in stage.outputs:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    return []
+
+
+def mk_conf(tmp_path: Path, model_path: Path | None) -> PipelineConf:
+    # inputs are fingerprinted by modification time, as such only created once
+    for name in ("mosaic_PolyT_z0.tif", "mosaic_DAPI_z0.tif", "tfm.csv", "dt.csv"):
+        if not (tmp_path / name).exists():
+            (tmp_path / name).touch()
+    return PipelineConf(
+        img_fmt=str(tmp_path / "mosaic_{c}_z{z}.tif"),
+        cyt_pat="PolyT",
+        nuc_pat="DAPI",
+        z_slices=[0],
+        mp_path=tmp_path / "tfm.csv",
+        dt_path=tmp_path / "dt.csv",
+        out_dir=tmp_path / "out",
+        model_path=model_path,
+        ncpus=1,
+    )
+
+
+def test_rerun_with_changed_segd_conf(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "run_stage", fake_stage)
+    pipeline.run(mk_conf(tmp_path, None))
+
+    # a different model invalidates segd, which has to start over despite the temporary files of the first run
+    (tmp_path / "model").write_bytes(b"weights")
+    pipeline.run(mk_conf(tmp_path, tmp_path / "model"))
+
+    assert (tmp_path / "out" / "segd_runs.txt").read_text().split() == ["None", str(tmp_path / "model")]
+    # blocks of both segmentations are stitched
+    assert len((tmp_path / "out" / "stitch_runs.txt").read_text().splitlines()) == 2
+
+
+def test_rerun_unchanged_skips(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "run_stage", fake_stage)
+    pipeline.run(mk_conf(tmp_path, None))
+    pipeline.run(mk_conf(tmp_path, None))
+
+    assert (tmp_path / "out" / "segd_runs.txt").read_text().split() == ["None"]
+    assert len((tmp_path / "out" / "stitch_runs.txt").read_text().splitlines()) == 1
@@ -0,0 +1,57 @@
+from itertools import product
+
+import numpy as np
+import pytest
+import zarr
+
+from umat.conf import StitchConf
+from umat.synth import cell_centers, rasterize
+from umat.tools import stitch
+
+
+def split_blocks(masks: np.ndarray, blocks: tuple[int, int, int]) -> np.ndarray:
+    # labels of every block renumbered independently (and uniquely across blocks), as in blockwise segmentations
+    out = np.zeros(masks.shape, np.uint32)
+    next_label = 1
+    for region in product(*[[slice(b0, b0 + b) for b0 in range(0, s, b)] for s, b in zip(masks.shape, blocks)]):
+        uniq, inv = np.unique(masks[region], return_inverse=True)
+        out[region] = np.where(uniq == 0, 0, np.arange(len(uniq)) + next_label)[inv.reshape(out[region].shape)]
+        next_label += len(uniq)
+    return out
+
+
+def cells(masks: np.ndarray, planar: bool) -> np.ndarray:
+    # (z, label) of every cell for per-slice segmentations, labels otherwise
+    fg = masks != 0
+    return masks[fg].astype(np.int64) + (np.nonzero(fg)[0] << 32 if planar else 0)
+
+
+@pytest.mark.parametrize("fmt, planar", [("npy", True), ("zarr", False)])
+def test_stitch_blocks(tmp_path, fmt, planar):
+    rng = np.random.default_rng(0)
+    side, diameter = 512, 80.0
+    centers = cell_centers(rng, side, 2, diameter)
+    masks = np.stack([rasterize(c, side, diameter * 0.55)[0] for c in centers])
+    if not planar:
+        # cells continuing over the z block face
+        masks = np.concatenate([masks, masks[::-1]])
+    blocks = (1 if planar else 2, 128, 128)
+    split = split_blocks(masks, blocks)
+
+    path = tmp_path / f"masks.{fmt}"
+    if fmt == "zarr":
+        zarr.save_array(str(path), split, chunks=blocks)
+        zarr.open(str(path), mode="r+").attrs["n_labels"] = int(len(np.unique(split)) - 1)
+    else:
+        np.save(path, split)
+    stitch.run(StitchConf(path, blocks=blocks, planar=planar))
+    out = zarr.open(str(path), mode="r")[:] if fmt == "zarr" else np.load(path)
+
+    # every cell gets back a single label, shared with no other cell
+    assert ((out != 0) == (masks != 0)).all()
+    n_cells = len(np.unique(cells(masks, planar)))
+    assert len(np.unique(cells(split, planar))) > n_cells
+    assert len(np.unique(cells(out, planar))) == n_cells
+    assert len(np.unique(np.stack([cells(masks, planar), cells(out, planar)]), axis=1).T) == n_cells
+    if fmt == "zarr":
+        assert zarr.open(str(path), mode="r").attrs["n_labels"] == len(np.unique(out)) - 1
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from h5py import File as H5File
+
+from umat.trainset import CYT_KEY, LAB_KEY, NUC_KEY, CropLoader
+
+SIDE = 32
+
+
+def normalize(img: np.ndarray) -> np.ndarray:
+    # reference of `cellpose.transforms.normalize_img(img, axis=0)`, as applied to in-memory training data
+    out = img.astype(np.float32)
+    for c in range(len(out)):
+        if np.ptp(out[c]) > 0:
+            x01, x99 = np.percentile(out[c], 1), np.percentile(out[c], 99)
+            if x99 - x01 > 1e-3:
+                out[c] -= x01
+                out[c] /= x99 - x01
+            else:
+                out[c] = 0
+    return out
+
+
+def orientations(arr: np.ndarray) -> list[np.ndarray]:
+    # all 8 flips/transpositions of the last two axes
+    flips = [arr, arr[..., ::-1], arr[..., ::-1, :], arr[..., ::-1, ::-1]]
+    return flips + [np.swapaxes(a, -1, -2) for a in flips]
+
+
+@pytest.fixture
+def train_file(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / "train.h5"
+    with H5File(path, "w") as hf:
+        labs = rng.integers(0, 50, (SIDE, SIDE), dtype=np.int32)
+        for name, nuc in [("varied", rng.integers(0, 4000, (SIDE, SIDE))), ("constant", np.full((SIDE, SIDE), 7))]:
+            grp = hf.create_group(name)
+            grp[CYT_KEY] = (labs * 40 + rng.integers(0, 40, labs.shape)).astype(np.uint16)
+            grp[NUC_KEY] = nuc.astype(np.uint16)
+            grp[LAB_KEY] = labs
+        # smaller than the crop side, padded
+        grp = hf.create_group("small")
+        grp[CYT_KEY] = rng.integers(100, 200, (20, 24), dtype=np.uint16)
+        grp[NUC_KEY] = rng.integers(100, 200, (20, 24), dtype=np.uint16)
+        grp[LAB_KEY] = rng.integers(1, 5, (20, 24), dtype=np.int32)
+        # unlabelled, never loaded
+        hf.create_group("unlabelled")[CYT_KEY] = np.zeros((SIDE, SIDE), np.uint16)
+    return path
+
+
+def reference(path, name: str) -> tuple[np.ndarray, np.ndarray]:
+    # normalized images and labels of a sample, zero-padded to the crop side after normalization
+    with H5File(path, "r") as hf:
+        grp = hf[name]
+        img = normalize(np.stack([grp[CYT_KEY][:], grp[NUC_KEY][:]]))
+        lab = grp[LAB_KEY][:]
+    pad = [(0, SIDE - lab.shape[0]), (0, SIDE - lab.shape[1])]
+    return np.pad(img, [(0, 0), *pad]), np.pad(lab, pad)
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_batches(train_file, workers):
+    with CropLoader(train_file, SIDE, 4, workers=workers, jitter=0.0, seed=0, names=["varied", "constant", "small"]) as loader:
+        assert len(loader) == 3
+        refs = [reference(train_file, name) for name in loader.names]
+        seen = set()
+        for _, (imgs, labs) in zip(range(20), loader):
+            assert imgs.shape == (4, 3, SIDE, SIDE) and imgs.dtype == np.float32
+            assert labs.shape == (4, SIDE, SIDE) and labs.dtype == np.int32
+            assert not imgs[:, 2].any()
+            for img, lab in zip(imgs, labs):
+                # images (normalized as in memory) and labels are flipped/transposed alike
+                found = [
+                    (i, k)
+                    for i, (ref_img, ref_lab) in enumerate(refs)
+                    for k, (o_img, o_lab) in enumerate(zip(orientations(ref_img), orientations(ref_lab)))
+                    if np.array_equal(o_lab, lab) and np.array_equal(o_img, img[:2])
+                ]
+                assert len(found) > 0
+                seen.add(found[0][1])
+    assert len(seen) > 4
+
+
+def test_no_samples(train_file):
+    with pytest.raises(ValueError):
+        CropLoader(train_file, SIDE, 2, workers=0, names=[])